@@ -0,0 +1,98 @@
+import json
+
+import metrics
+import telemetry
+import util
+import worker
+from model import MinioNotConnected, UfysError, UfysRequest, UfysResponse, serialize
+
+# async alternative to the flask app in main.py, with the same /video contract.
+# one process can hold many concurrent requests that are mostly waiting on the network:
+#   uvicorn asgi:APP --host 0.0.0.0 --port 80
+WORKER = worker.Worker(worker.ConfigStore.from_env())
+
+telemetry.init(service_name="embed-works.ufys")
+
+
+async def read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def send_body(send, status: int, body: bytes, content_type: str, headers: dict[str, str] | None = None):
+    await send(dict(
+        type="http.response.start",
+        status=status,
+        headers=[
+            (b"content-type", content_type.encode()),
+            (b"content-length", str(len(body)).encode()),
+            *((key.lower().encode(), value.encode()) for key, value in (headers or {}).items())
+        ]
+    ))
+    await send(dict(type="http.response.body", body=body))
+
+
+async def send_json(send, status: int, o, headers: dict[str, str] | None = None):
+    # same output as flask's default json provider
+    await send_body(send, status, json.dumps(serialize(o), sort_keys=True).encode("utf-8"), "application/json", headers)
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            WORKER.start_warm_up()
+            await send(dict(type="lifespan.startup.complete"))
+        elif message["type"] == "lifespan.shutdown":
+            for handler in WORKER.handlers:
+                await handler.close_async()
+            await send(dict(type="lifespan.shutdown.complete"))
+            return
+
+
+async def get_video_url(receive, send):
+    try:
+        req = util.dataclass_from_dict(UfysRequest, json.loads(await read_body(receive)))
+    except (ValueError, TypeError):
+        return await send_json(send, 400, [UfysError(code="bad-request", message="expected a json request")])
+    try:
+        resp = await WORKER.handle_request_async(req)
+        assert resp
+    except AssertionError:
+        return await send_json(send, 500, [
+            UfysError(
+                code="assertion-error",
+                message="an unknown error, thought to be impossible, has occured"
+            )
+        ])
+    except MinioNotConnected:
+        return await send_json(send, 500, [
+            UfysError(code="minio-error", message="an internal backend service is unavailable")
+        ])
+    success = any(isinstance(c, UfysResponse) for c in resp)
+    if not success and all(c.code == "overloaded" for c in resp):
+        return await send_json(send, 503, resp, {"Retry-After": str(WORKER.config.RETRY_AFTER)})
+    await send_json(send, 200 if success else 500, resp)
+
+
+async def APP(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        return await send_body(send, 200, metrics.render(), metrics.CONTENT_TYPE)
+    if scope["path"] == "/healthz" and scope["method"] == "GET":
+        return await send_json(send, 200, dict(status="ok"))
+    if scope["path"] == "/readyz" and scope["method"] == "GET":
+        readiness = WORKER.readiness()
+        return await send_json(send, 200 if readiness["ready"] else 503, readiness)
+    if scope["path"] != "/video":
+        return await send_json(send, 404, [UfysError(code="not-found", message="no such route")])
+    if scope["method"] != "POST":
+        return await send_json(send, 405, [UfysError(code="method-not-allowed", message="use POST")])
+    await get_video_url(receive, send)
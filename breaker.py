@@ -0,0 +1,46 @@
+import threading
+import time
+
+
+class CircuitBreaker:
+    # closed: everything goes through, consecutive failures are counted
+    # open: after `threshold` consecutive failures, nothing goes through for `cooldown` seconds
+    # half-open: after the cooldown, a single trial call decides whether to close or open again
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        with self.lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record(self, success: bool):
+        with self.lock:
+            self.trial_running = False
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.threshold:
+                # (re-)open, a failed trial restarts the cooldown
+                self.opened_at = time.monotonic()
@@ -0,0 +1,51 @@
+import dataclasses
+
+from config import ConfigStore
+from model import UfysError, UfysRequest
+
+
+@dataclasses.dataclass(frozen=True)
+class Budget:
+    # limits for a video, None -> unlimited. going over one fails the request with "budget-exceeded" as soon as we
+    # can tell: from yt-dlp's metadata up front, or while the bytes are coming in
+    filesize: int | None = None
+    # seconds
+    duration: float | None = None
+    height: int | None = None
+
+    @classmethod
+    def of(cls, req: UfysRequest, config: ConfigStore | None = None) -> "Budget":
+        # the request's own limits, tightened by the global ones if config is given. those only protect our disk
+        # and bandwidth, so they apply to what we download and reupload, not to links
+        def limit(requested, global_):
+            limits = [value for value in (requested, global_ or None) if value is not None]
+            return min(limits, default=None)
+
+        if config is None:
+            return cls(filesize=req.max_filesize, duration=req.max_duration, height=req.max_height)
+        return cls(
+            filesize=limit(req.max_filesize, config.MAX_FILESIZE),
+            duration=limit(req.max_duration, config.MAX_DURATION),
+            height=limit(req.max_height, config.MAX_HEIGHT)
+        )
+
+    def check(self, filesize: float | None = None, duration: float | None = None, height: int | None = None):
+        # unknown values pass, they're enforced later (filesize) or not at all
+        for name, value, limit in (
+            ("filesize", filesize, self.filesize),
+            ("duration", duration, self.duration),
+            ("height", height, self.height)
+        ):
+            if value is not None and limit is not None and value > limit:
+                raise self.exceeded(name, value, limit)
+
+    @property
+    def variant(self) -> str | None:
+        # what a reupload was limited to, uploads of the same video under different budgets aren't interchangeable.
+        # duration only decides whether there is an upload at all. None -> unlimited
+        limits = [f"{name}{value}" for name, value in (("filesize", self.filesize), ("height", self.height)) if value]
+        return "-".join(limits) or None
+
+    @staticmethod
+    def exceeded(name: str, value: float, limit: float) -> UfysError:
+        return UfysError("budget-exceeded", message=f"video exceeds the {name} budget ({value:g} > {limit:g})")
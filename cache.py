@@ -0,0 +1,227 @@
+import collections
+import io
+import json
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
+
+# noinspection PyPackageRequirements
+import minio.error
+from urllib3.exceptions import MaxRetryError
+
+import metrics
+import telemetry
+import util
+from config import ConfigStore
+from model import UfysError, UfysResponse, result_from_dict, serialize
+
+if TYPE_CHECKING:
+    from worker import Worker
+
+Results = list[UfysResponse | UfysError]
+
+
+def url_expiry(url: str) -> float | None:
+    # signed cdn urls carry their expiry as a query parameter, and every cdn has its own idea of how to name it
+    query = {
+        key.lower(): value
+        for key, value
+        in urllib.parse.parse_qsl(urllib.parse.urlparse(url).query)
+    }
+    try:
+        # youtube (googlevideo), tiktok/akamai, cloudfront
+        for key in ("expire", "x-expires", "expires"):
+            if key in query:
+                return float(query[key])
+        # facebook/instagram cdn - hex encoded unix timestamp
+        if "oe" in query:
+            return float(int(query["oe"], 16))
+        # s3 presigned urls
+        if "x-amz-date" in query and "x-amz-expires" in query:
+            signed = datetime.strptime(query["x-amz-date"], "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+            return signed.timestamp() + float(query["x-amz-expires"])
+    except ValueError:
+        pass
+    return None
+
+
+class CacheTier:
+    name: str
+
+    def get(self, key: str) -> tuple[Results, float] | None:
+        pass
+
+    def set(self, key: str, results: Results, expires: float):
+        pass
+
+
+class MemoryCache(CacheTier):
+    name = "memory"
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: collections.OrderedDict[str, tuple[Results, float]] = collections.OrderedDict()
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> tuple[Results, float] | None:
+        with self.lock:
+            if (entry := self.entries.get(key)) is None:
+                return None
+            if entry[1] <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key: str, results: Results, expires: float):
+        with self.lock:
+            self.entries[key] = (results, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+
+class MinioCache(CacheTier):
+    name = "minio"
+    PREFIX = "cache/"
+
+    def __init__(self, worker: "Worker"):
+        self.worker = worker
+
+    def object_name(self, key: str):
+        return f"{self.PREFIX}{key}.json"
+
+    def get(self, key: str) -> tuple[Results, float] | None:
+        if (client := self.worker.minio) is None:
+            return None
+        try:
+            r = client.get_object(self.worker.config.MINIO_BUCKET, self.object_name(key))
+            try:
+                entry = json.loads(r.data)
+            finally:
+                r.close()
+                r.release_conn()
+        except minio.error.S3Error:
+            return None
+        except MaxRetryError:
+            print("warning: shared cache unavailable (timeout)")
+            self.worker.storage.disconnect("timeout")
+            return None
+        if entry["expires"] <= time.time():
+            # just a cleanup, a miss either way
+            try:
+                client.remove_object(self.worker.config.MINIO_BUCKET, self.object_name(key))
+            except minio.error.S3Error:
+                pass
+            except MaxRetryError:
+                print("warning: shared cache unavailable (timeout)")
+                self.worker.storage.disconnect("timeout")
+            return None
+        return [result_from_dict(result) for result in entry["results"]], entry["expires"]
+
+    def set(self, key: str, results: Results, expires: float):
+        if (client := self.worker.minio) is None:
+            return
+        data = json.dumps(
+            dict(expires=expires, results=serialize(results)),
+            ensure_ascii=False
+        ).encode("utf-8")
+        try:
+            client.put_object(
+                bucket_name=self.worker.config.MINIO_BUCKET,
+                object_name=self.object_name(key),
+                data=io.BytesIO(data),
+                length=len(data),
+                content_type="application/json"
+            )
+        except MaxRetryError:
+            print("warning: shared cache unavailable (timeout)")
+            self.worker.storage.disconnect("timeout")
+
+
+class ResultCache:
+
+    def __init__(self, config: ConfigStore, tiers: list[CacheTier]):
+        self.config = config
+        self.tiers = tiers
+        self.hits = collections.Counter()
+        self.misses = 0
+        self.negative_ttls = {code: float(ttl) for code, ttl in util.parse_mapping(config.NEGATIVE_CACHE_TTLS).items()}
+        # consecutive failures per key, for backing off
+        self.failures: collections.OrderedDict[str, int] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_worker(cls, worker: "Worker"):
+        tiers = [MemoryCache(worker.config.CACHE_SIZE)]
+        if worker.config.CACHE_SHARED:
+            tiers.append(MinioCache(worker))
+        return cls(worker.config, tiers)
+
+    @telemetry.trace_function
+    def get(self, key: str) -> Results | None:
+        for index, tier in enumerate(self.tiers):
+            if (entry := tier.get(key)) is None:
+                continue
+            self.hits[tier.name] += 1
+            metrics.CACHE_LOOKUPS.labels(tier.name).inc()
+            # promote to all faster tiers
+            for faster in self.tiers[:index]:
+                faster.set(key, *entry)
+            return list(entry[0])
+        self.misses += 1
+        metrics.CACHE_LOOKUPS.labels("none").inc()
+        return None
+
+    @telemetry.trace_function
+    def set(self, key: str, results: Results) -> float | None:
+        # when the results expire, None if they weren't cached
+        if any(isinstance(result, UfysResponse) for result in results):
+            with self.lock:
+                self.failures.pop(key, None)
+            ttl = self.ttl_for(results)
+        else:
+            ttl = self.negative_ttl_for(key, results)
+        if ttl <= 0:
+            return None
+        expires = time.time() + ttl
+        for tier in self.tiers:
+            tier.set(key, list(results), expires)
+        return expires
+
+    def ttl_for(self, results: Results) -> float:
+        responses = [result for result in results if isinstance(result, UfysResponse)]
+        if not responses:
+            return 0
+        ttl = self.config.CACHE_TTL_REUPLOAD
+        for response in responses:
+            if response.reuploaded:
+                continue
+            ttl = min(ttl, self.config.CACHE_TTL_DIRECT)
+            if (expires := url_expiry(response.video_url)) is not None:
+                ttl = min(ttl, expires - time.time() - self.config.CACHE_EXPIRY_MARGIN)
+        return ttl
+
+    def negative_ttl_for(self, key: str, errors: Results) -> float:
+        # every error code has its own ttl (none -> not cached), doubled for every consecutive failure
+        ttl = min((self.negative_ttls.get(error.code, 0) for error in errors), default=0)
+        if ttl <= 0:
+            return 0
+        with self.lock:
+            failures = self.failures[key] = self.failures.get(key, 0) + 1
+            self.failures.move_to_end(key)
+            while len(self.failures) > self.config.CACHE_SIZE:
+                self.failures.popitem(last=False)
+        return min(ttl * 2 ** (failures - 1), self.config.NEGATIVE_CACHE_MAX_TTL)
+
+    def stats(self) -> dict:
+        return dict(
+            hits=dict(self.hits),
+            misses=self.misses,
+            entries=sum(len(tier.entries) for tier in self.tiers if isinstance(tier, MemoryCache)),
+            evictions=sum(tier.evictions for tier in self.tiers if isinstance(tier, MemoryCache)),
+        )
@@ -0,0 +1,23 @@
+import re
+import urllib.parse
+
+# query parameters that only identify who shared a link, not what it points to
+TRACKING_PARAMS = re.compile(
+    r"^(utm_.*|si|igsh|igshid|fbclid|gclid|dclid|msclkid|mc_[ce]id|feature|ref|ref_src|ref_url|share_.*|_r|_t)$"
+)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url: str) -> str:
+    parsed = urllib.parse.urlsplit(url.strip())
+    scheme = parsed.scheme.lower()
+    host = (parsed.hostname or "").rstrip(".")
+    if parsed.port is not None and parsed.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parsed.port}"
+    query = sorted(
+        (key, value)
+        for key, value
+        in urllib.parse.parse_qsl(parsed.query, keep_blank_values=True)
+        if not TRACKING_PARAMS.match(key.lower())
+    )
+    return urllib.parse.urlunsplit((scheme, host, parsed.path or "/", urllib.parse.urlencode(query), ""))
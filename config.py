@@ -11,14 +11,106 @@ class ConfigStore:
     MINIO_ENDPOINT: str = None
     MINIO_BUCKET: str = None
     MINIO_SECURE: bool = True
+    # seconds between attempts to (re)connect to an unreachable minio
+    MINIO_RETRY_INTERVAL: int = 10
     AAAS_ENDPOINT: str = None
     PROXY_URL: str = None
+    # seconds scraped asciinema titles and authors are reused for
+    ASCIINEMA_METADATA_TTL: int = 60 * 60
+    CACHE_SIZE: int = 1024
+    CACHE_SHARED: bool = False
+    CACHE_TTL_REUPLOAD: int = 7 * 24 * 60 * 60
+    CACHE_TTL_DIRECT: int = 60 * 60
+    CACHE_EXPIRY_MARGIN: int = 5 * 60
+    INFLIGHT_TIMEOUT: int = 10 * 60
+    # seconds before they expire that cached direct links are extracted again, if they're hot. 0 -> never
+    REFRESH_AHEAD: int = 5 * 60
+    # hot: at least REFRESH_MIN_HITS cache hits within REFRESH_WINDOW seconds (since the last refresh)
+    REFRESH_MIN_HITS: int = 3
+    REFRESH_WINDOW: int = 10 * 60
+    # background refreshes at a time, they're also held back while requests are queued
+    REFRESH_CONCURRENCY: int = 2
+    # seconds between checks for entries that are due
+    REFRESH_INTERVAL: float = 10.
+    PROBE_BYTES: int = 1024 * 1024
+    # limits for videos we download and reupload (bytes, seconds, pixels), requests can only go lower. 0 -> none
+    MAX_FILESIZE: int = 0
+    MAX_DURATION: int = 0
+    MAX_HEIGHT: int = 0
+    # kept-alive connections per upstream host, and overrides for busy ones, e.g. "i.instagram.com=32"
+    HTTP_POOL_SIZE: int = 16
+    HTTP_POOL_SIZES: str = ""
+    # seconds, 0 -> wait forever. the read timeout is between bytes, not for the whole response
+    HTTP_CONNECT_TIMEOUT: float = 10.
+    HTTP_READ_TIMEOUT: float = 60.
+    # retries of connections that couldn't be established
+    HTTP_RETRIES: int = 2
+    # x264 settings for reuploads that can't just be remuxed
+    TRANSCODE_PRESET: str = "veryfast"
+    TRANSCODE_CRF: int = 23
+    # 0 -> ffmpeg decides (one per cpu)
+    TRANSCODE_THREADS: int = 0
+    DISPATCH_MODE: str = "race"
+    DISPATCH_HEDGE_DELAY: float = 5.
+    STREAMING_REUPLOAD: bool = True
+    STREAM_BUFFER_SIZE: int = 8 * 1024 * 1024
+    UPLOAD_PART_SIZE: int = 16 * 1024 * 1024
+    JOB_WORKERS: int = 4
+    JOB_QUEUE_SIZE: int = 64
+    JOB_HISTORY: int = 1024
+    JOB_CALLBACK_TIMEOUT: int = 10
+    # where jobs may post their results to: hosts, or domains with their subdomains (".example.com"), and schemes.
+    # no hosts -> callbacks are refused, clients would otherwise make us post to internal services
+    JOB_CALLBACK_HOSTS: str = ""
+    JOB_CALLBACK_SCHEMES: str = "https"
+    BATCH_CONCURRENCY: int = 8
+    BATCH_MAX_SIZE: int = 100
+    # concurrent runs per upstream, by handler class or breaker key, e.g. "YTDLRequestHandler=4,
+    # InstagramRequestHandler=16,YTDLRequestHandler:Youtube=2". a class's limit applies to each of its keys (i.e.
+    # yt-dlp extractors) separately
+    HANDLER_CONCURRENCY: str = ""
+    YTDL_POOL_SIZE: int = 8
+    YTDL_POOL_MAX_USES: int = 100
+    YTDL_POOL_TIMEOUT: int = 60
+    # "thread" or "process"
+    EXECUTION_BACKEND: str = "thread"
+    # 0 -> one per cpu
+    PROCESS_POOL_SIZE: int = 0
+    PROCESS_MAX_TASKS: int = 100
+    PROCESS_MAX_RSS: int = 1024 * 1024 * 1024
+    # handlers look up whether a request was reuploaded before right before reuploading it again
+    REUPLOAD_PREFLIGHT: bool = True
+    CANONICALIZE_EXTRACTORS: bool = True
+    # seconds per error code, codes that aren't listed are never cached
+    NEGATIVE_CACHE_TTLS: str = (
+        "download-error=60,empty-playlist=300,unknown-playlist=300,unknown-type=300,no-handler=3600,"
+        "implementation-error=15,circuit-open=5,budget-exceeded=300"
+    )
+    NEGATIVE_CACHE_MAX_TTL: int = 60 * 60
+    BREAKER_THRESHOLD: int = 10
+    BREAKER_COOLDOWN: int = 30
+    # threads running handlers, shared by all requests
+    EXECUTOR_WORKERS: int = 32
+    # handler runs waiting for a thread before new ones are rejected
+    EXECUTOR_QUEUE_SIZE: int = 64
+    # threads per handler for the side calls of its runs (e.g. instagram's oembed), 0 -> one per executor thread,
+    # so every run gets its own
+    HANDLER_IO_WORKERS: int = 0
+    # seconds a handler run may wait for a thread (or its handler's slots) before it's dropped, 0 -> forever
+    EXECUTOR_QUEUE_TIMEOUT: float = 30.
+    # seconds clients are told to wait after being turned away
+    RETRY_AFTER: int = 5
+    # file to append request bodies to, for replaying real traffic with test/replay.py. empty -> off
+    REQUEST_LOG: str = ""
 
     @classmethod
     def from_env(cls):
         return util.dataclass_from_dict(cls, os.environ)
 
     def __post_init__(self):
+        # values from the environment are always strings
+        for key, field in self.__dataclass_fields__.items():  # type: ignore
+            self.__setattr__(key, util.coerce(self.__getattribute__(key), field.type))
         # run some checks and emit warnings if stuff goes wrong
         for key in self.__dataclass_fields__:  # type: ignore
             key: str
@@ -0,0 +1,370 @@
+import collections
+import concurrent.futures
+import contextvars
+import dataclasses
+import functools
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import threading
+import time
+import typing
+from typing import TYPE_CHECKING
+
+import metrics
+import telemetry
+from config import ConfigStore
+from model import UfysError, UfysRequest, UfysResponse
+
+if TYPE_CHECKING:
+    from handlers.base import RequestHandler
+    from worker import Worker
+
+# the worker living in a pool process, with its handlers (and yt-dlp) loaded once per process
+_child_worker: "Worker | None" = None
+
+
+def _init_child(config: ConfigStore):
+    global _child_worker
+    from worker import Worker
+    _child_worker = Worker(dataclasses.replace(config, EXECUTION_BACKEND="thread"))
+    _child_worker.warm_up()
+
+
+def _run_in_child(handler_name: str, req: UfysRequest) -> tuple[UfysResponse | UfysError, int]:
+    handler, = (handler for handler in _child_worker.handlers if handler.__class__.__name__ == handler_name)
+    result = _child_worker.dispatch_handler(handler, req)
+    # peak rss, in KiB on linux
+    return result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _child_main(config: ConfigStore, connection: multiprocessing.connection.Connection):
+    # runs (handler name, request) tasks until told to stop, or until it's due to be recycled. that's decided here,
+    # after sending the result, so only this process is replaced
+    _init_child(config)
+    tasks = 0
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            # the parent went away
+            return
+        if task is None:
+            return
+        result, rss = _run_in_child(*task)
+        tasks += 1
+        recycle = bool(
+            (config.PROCESS_MAX_RSS and rss > config.PROCESS_MAX_RSS)
+            or (config.PROCESS_MAX_TASKS and tasks >= config.PROCESS_MAX_TASKS)
+        )
+        connection.send((result, recycle))
+        if recycle:
+            return
+
+
+@dataclasses.dataclass
+class _Child:
+    process: multiprocessing.process.BaseProcess
+    connection: multiprocessing.connection.Connection
+
+    def stop(self):
+        self.connection.close()
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+
+
+class ProcessBackend:
+    # runs handlers in processes instead of threads, so cpu-heavy extraction and ffmpeg work isn't serialized by the
+    # GIL. each process runs one task at a time and exits after a number of tasks or once it grew too large, then a
+    # fresh one takes its place (the others keep running)
+
+    def __init__(self, config: ConfigStore):
+        self.config = config
+        self.size = config.PROCESS_POOL_SIZE or os.cpu_count()
+        # started on demand, up to `size`
+        self.children = 0
+        self.idle: list[_Child] = []
+        self.available = threading.Condition()
+        self.recycled = 0
+        # the child's imports don't work with fork
+        self.context = multiprocessing.get_context("spawn")
+
+    def spawn(self) -> _Child:
+        connection, child_connection = self.context.Pipe()
+        process = self.context.Process(
+            target=_child_main, args=(self.config, child_connection), name="handler-process", daemon=True
+        )
+        process.start()
+        child_connection.close()
+        return _Child(process, connection)
+
+    def checkout(self) -> _Child:
+        with self.available:
+            while not self.idle and self.children >= self.size:
+                self.available.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.children += 1
+        try:
+            return self.spawn()
+        except BaseException:
+            self.retire(None)
+            raise
+
+    def checkin(self, child: _Child):
+        with self.available:
+            self.idle.append(child)
+            self.available.notify()
+
+    def retire(self, child: _Child | None):
+        # None -> it didn't even start
+        if child is not None:
+            child.stop()
+        with self.available:
+            self.children -= 1
+            self.recycled += child is not None
+            self.available.notify()
+
+    @telemetry.trace_function
+    def run(self, handler: "RequestHandler", req: UfysRequest) -> UfysResponse | UfysError:
+        child = self.checkout()
+        try:
+            child.connection.send((handler.__class__.__name__, req))
+            result, recycle = child.connection.recv()
+        except (EOFError, OSError):
+            # e.g. killed for using too much memory
+            self.retire(child)
+            return UfysError(code="implementation-error", message="handler process died")
+        except BaseException:
+            # the child is still working on it (or the pipe is in an unknown state), it can't be reused
+            self.retire(child)
+            raise
+        if recycle:
+            self.retire(child)
+        else:
+            self.checkin(child)
+        return result
+
+    def shutdown(self):
+        with self.available:
+            idle, self.idle = self.idle, []
+        for child in idle:
+            try:
+                child.connection.send(None)
+            except OSError:
+                pass
+            child.stop()
+
+
+class Slots:
+    # a handler's HANDLER_CONCURRENCY. runs that don't get a slot right away wait in line without holding a thread
+    # (or polling) while they do: release() hands the slot straight to the oldest waiter
+
+    def __init__(self, limit: int):
+        self.free = limit
+        self.lock = threading.Lock()
+        self.waiters: collections.deque[typing.Callable[[], bool]] = collections.deque()
+
+    def acquire(self, waiter: typing.Callable[[], bool] | None = None) -> bool:
+        # True -> got a slot. otherwise waiter (if any) is called with one once it's released, from the releasing
+        # thread. it returns False if it doesn't want it anymore (cancelled, expired), the slot goes on to the next one
+        with self.lock:
+            if self.free > 0:
+                self.free -= 1
+                return True
+            if waiter is not None:
+                self.waiters.append(waiter)
+            return False
+
+    def release(self):
+        while True:
+            with self.lock:
+                if not self.waiters:
+                    self.free += 1
+                    return
+                waiter = self.waiters.popleft()
+            if waiter():
+                return
+
+
+@dataclasses.dataclass
+class _Task:
+    fn: typing.Callable
+    args: tuple
+    slots: Slots | None
+    # the submitter's, for the trace context
+    context: contextvars.Context = dataclasses.field(default_factory=contextvars.copy_context)
+    submitted: float = dataclasses.field(default_factory=time.monotonic)
+    future: concurrent.futures.Future = dataclasses.field(default_factory=concurrent.futures.Future)
+    # got its slot or expired waiting for it, whichever came first
+    settled: bool = False
+
+
+class BoundedExecutor:
+    # a long-lived thread pool shared by all requests. instead of queueing without bound, new tasks are
+    # rejected once `workers + queue_size` are pending, and tasks that waited longer than `queue_timeout`
+    # (for a thread or for their handler's slots) are dropped without running. tasks only get a thread once
+    # they have their slot, so a burst against one handler doesn't starve the others
+
+    def __init__(self, workers: int, queue_size: int, queue_timeout: float):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="handler")
+        self.capacity = threading.BoundedSemaphore(workers + queue_size)
+        self.queue_timeout = queue_timeout
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.started = 0
+        self.rejected = 0
+        self.expired = 0
+        self.wait_total = 0.
+        self.wait_max = 0.
+        # tasks waiting for slots, oldest first, so they can be expired on time. started on first use
+        self.waiting: collections.deque[_Task] = collections.deque()
+        self.waiting_changed = threading.Condition(self.lock)
+        self.expiry_thread: threading.Thread | None = None
+        self.closed = False
+
+    def submit(
+            self,
+            fn: typing.Callable,
+            *args,
+            slots: Slots | None = None
+    ) -> concurrent.futures.Future:
+        if not self.capacity.acquire(blocking=False):
+            with self.lock:
+                self.rejected += 1
+            metrics.EXECUTOR_SHED.labels("rejected").inc()
+            raise UfysError(code="overloaded", message="too many requests in flight, try again later")
+        with self.lock:
+            self.queued += 1
+        metrics.EXECUTOR_QUEUED.inc()
+        task = _Task(fn, args, slots)
+        task.future.add_done_callback(self.release_cancelled)
+        if slots is None or slots.acquire(functools.partial(self.slot_granted, task)):
+            self.start(task)
+        elif self.queue_timeout:
+            with self.lock:
+                self.waiting.append(task)
+                if self.expiry_thread is None:
+                    self.expiry_thread = threading.Thread(
+                        target=self.expire_waiting, name="handler-expiry", daemon=True
+                    )
+                    self.expiry_thread.start()
+                self.waiting_changed.notify()
+        return task.future
+
+    def slot_granted(self, task: _Task) -> bool:
+        with self.lock:
+            if task.settled or task.future.cancelled():
+                return False
+            task.settled = True
+        self.start(task)
+        return True
+
+    def start(self, task: _Task):
+        try:
+            self.executor.submit(task.context.run, self.run, task)
+        except RuntimeError:
+            # shut down
+            if task.slots is not None:
+                task.slots.release()
+            task.future.cancel()
+
+    def release_cancelled(self, future: concurrent.futures.Future):
+        # tasks that were cancelled before they started never get to release their capacity themselves
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+            metrics.EXECUTOR_QUEUED.dec()
+            self.capacity.release()
+
+    def admit(self, task: _Task, expired: bool = False) -> bool:
+        # done waiting, whether it may still run. expired -> gave up waiting for its slots
+        now = time.monotonic()
+        admitted = not expired and (not self.queue_timeout or now <= task.submitted + self.queue_timeout)
+        with self.lock:
+            self.queued -= 1
+            self.wait_total += now - task.submitted
+            self.wait_max = max(self.wait_max, now - task.submitted)
+            if admitted:
+                self.started += 1
+                self.running += 1
+            else:
+                self.expired += 1
+        metrics.EXECUTOR_QUEUED.dec()
+        metrics.EXECUTOR_WAIT.observe(now - task.submitted)
+        if not admitted:
+            metrics.EXECUTOR_SHED.labels("expired").inc()
+            task.future.set_exception(UfysError(code="overloaded", message="timed out waiting for a free worker"))
+        return admitted
+
+    def run(self, task: _Task):
+        if not task.future.set_running_or_notify_cancel():
+            # cancelled while queued, release_cancelled took care of the capacity
+            if task.slots is not None:
+                task.slots.release()
+            return
+        try:
+            if not self.admit(task):
+                if task.slots is not None:
+                    task.slots.release()
+                return
+            try:
+                with metrics.EXECUTOR_RUNNING.track_inprogress():
+                    result = task.fn(*task.args)
+            except BaseException as ex:
+                task.future.set_exception(ex)
+            else:
+                task.future.set_result(result)
+            finally:
+                with self.lock:
+                    self.running -= 1
+                if task.slots is not None:
+                    task.slots.release()
+        finally:
+            self.capacity.release()
+
+    def expire_waiting(self):
+        # tasks still waiting for slots after queue_timeout would otherwise only find out once a slot is released
+        while True:
+            expired = []
+            with self.lock:
+                if self.closed:
+                    return
+                while self.waiting and (self.waiting[0].settled or self.waiting[0].future.done()):
+                    self.waiting.popleft()
+                while self.waiting and self.waiting[0].submitted + self.queue_timeout <= time.monotonic():
+                    task = self.waiting.popleft()
+                    if not task.settled:
+                        task.settled = True
+                        expired.append(task)
+                if not expired:
+                    self.waiting_changed.wait(
+                        self.waiting[0].submitted + self.queue_timeout - time.monotonic() if self.waiting else None
+                    )
+            for task in expired:
+                if task.future.set_running_or_notify_cancel():
+                    try:
+                        self.admit(task, expired=True)
+                    finally:
+                        self.capacity.release()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(
+                queued=self.queued,
+                running=self.running,
+                started=self.started,
+                rejected=self.rejected,
+                expired=self.expired,
+                wait_avg=self.wait_total / max(1, self.started + self.expired),
+                wait_max=self.wait_max
+            )
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            self.waiting_changed.notify()
+        self.executor.shutdown(wait=False, cancel_futures=True)
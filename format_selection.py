@@ -0,0 +1,161 @@
+import dataclasses
+
+# picking a yt-dlp format we can hand out as is, so the video doesn't have to be reuploaded.
+# the checks run in this order, a format that is rejected later got closer to being linkable
+CHECKS = ("url", "audio", "codec", "container", "budget", "protocol")
+H264_CODECS = ("h264", "avc1", "avc3")
+# audio browsers play in an mp4, as yt-dlp names it
+WEB_AUDIO_CODECS = ("mp4a", "aac", "mp3")
+LINKABLE_PROTOCOLS = ("http", "https")
+# muxed alternatives we can't link, but can remux while streaming instead of letting yt-dlp download them
+REMUXABLE_PROTOCOLS = ("m3u8", "m3u8_native")
+
+
+@dataclasses.dataclass
+class Selection:
+    # the format to link, or to remux from if not `linkable`. None -> full reupload, see `reason`
+    format: dict | None
+    linkable: bool = False
+    # why the video can't be linked, e.g. "codec" if no format is h264
+    reason: str | None = None
+
+
+def codec_family(codec: str | None) -> str | None:
+    # "avc1.64001f" -> "avc1", "mp4a.40.2" -> "mp4a"
+    if not codec or codec == "none":
+        return None
+    return codec.split(".")[0].lower()
+
+
+def copy_video(fmt: dict) -> bool:
+    # whether a reupload can copy the video stream as is. codecs yt-dlp doesn't know are copied too, rather than
+    # transcoding whatever an extractor doesn't describe
+    return fmt.get("vcodec") is None or codec_family(fmt["vcodec"]) in H264_CODECS
+
+
+def copy_audio(fmt: dict) -> bool:
+    return fmt.get("acodec") is None or codec_family(fmt["acodec"]) in (None, *WEB_AUDIO_CODECS)
+
+
+def estimate_filesize(fmt: dict, duration: float | None) -> float | None:
+    if size := fmt.get("filesize") or fmt.get("filesize_approx"):
+        return size
+    if (tbr := fmt.get("tbr")) and duration:
+        # kbit/s
+        return tbr * 1000 / 8 * duration
+    return None
+
+
+def check(fmt: dict, duration: float | None, max_filesize: int | None, max_height: int | None) -> str | None:
+    # the first check this format fails, None if it's linkable
+    if not fmt.get("url"):
+        return "url"
+    if codec_family(fmt.get("acodec")) is None:
+        return "audio"
+    if codec_family(fmt.get("vcodec")) not in H264_CODECS:
+        return "codec"
+    if fmt.get("ext") != "mp4":
+        return "container"
+    if max_height is not None and (fmt.get("height") or 0) > max_height:
+        return "budget"
+    if max_filesize is not None and (estimate_filesize(fmt, duration) or 0) > max_filesize:
+        return "budget"
+    if fmt.get("protocol", "https") not in LINKABLE_PROTOCOLS:
+        return "protocol"
+    return None
+
+
+def score(index: int, fmt: dict) -> tuple:
+    # the highest resolution, then formats we don't have to probe for dimensions, then bitrate,
+    # then yt-dlp's own order (worst to best)
+    return (
+        fmt.get("height") or 0,
+        bool(fmt.get("width") and fmt.get("height")),
+        fmt.get("tbr") or 0,
+        index
+    )
+
+
+def select(info: dict, max_filesize: int | None = None, max_height: int | None = None) -> Selection:
+    formats = info.get("formats") or []
+    duration = info.get("duration")
+    linkable, remuxable = [], []
+    reason = None
+    for index, fmt in enumerate(formats):
+        failed = check(fmt, duration, max_filesize, max_height)
+        if failed is None:
+            linkable.append((index, fmt))
+            continue
+        if failed == "protocol" and fmt.get("protocol") in REMUXABLE_PROTOCOLS:
+            remuxable.append((index, fmt))
+        if reason is None or CHECKS.index(failed) > CHECKS.index(reason):
+            reason = failed
+    if linkable:
+        return Selection(max(linkable, key=lambda item: score(*item))[1], linkable=True)
+    if remuxable:
+        return Selection(max(remuxable, key=lambda item: score(*item))[1], reason=reason)
+    return Selection(None, reason=reason or "no-formats")
+
+
+def fits(formats: list[dict], duration: float | None, max_filesize: int | None, max_height: int | None) -> bool:
+    # whether formats reuploaded (merged) together stay within budget, unknown sizes and heights pass
+    sizes = [estimate_filesize(fmt, duration) for fmt in formats]
+    if max_filesize is not None and None not in sizes and sum(sizes) > max_filesize:
+        return False
+    if max_height is not None and max((fmt.get("height") or 0 for fmt in formats), default=0) > max_height:
+        return False
+    return True
+
+
+def over_budget(
+    info: dict, max_filesize: int | None = None, max_height: int | None = None
+) -> tuple[str, float, int] | None:
+    # the limit every listed video format goes over, as (name, smallest value, limit). a format with an unknown height
+    # or size might fit. None -> something might fit (or yt-dlp didn't list formats)
+    duration = info.get("duration")
+    videos = [fmt for fmt in info.get("formats") or [info] if fmt.get("vcodec") != "none"]
+    if not videos:
+        return None
+    heights = [fmt.get("height") for fmt in videos]
+    if max_height is not None and None not in heights and min(heights) > max_height:
+        return "height", min(heights), max_height
+    sizes = [estimate_filesize(fmt, duration) for fmt in videos]
+    if max_filesize is not None and None not in sizes and min(sizes) > max_filesize:
+        return "filesize", min(sizes), max_filesize
+    return None
+
+
+def select_streams(
+    info: dict, protocols: tuple[str, ...], max_filesize: int | None = None, max_height: int | None = None
+) -> list[dict] | None:
+    # formats to stream into a reupload: the best single format or video + audio pair that fits the budget and can be
+    # read over `protocols`. None -> nothing fits (or yt-dlp didn't list formats)
+    duration = info.get("duration")
+    formats = [
+        fmt for fmt in info.get("formats") or []
+        if fmt.get("url") and fmt.get("protocol") in protocols and codec_family(fmt.get("vcodec")) is not None
+    ]
+    audio = [
+        fmt for fmt in info.get("formats") or []
+        if fmt.get("url") and fmt.get("protocol") in protocols
+        and codec_family(fmt.get("acodec")) is not None and codec_family(fmt.get("vcodec")) is None
+    ]
+    candidates = [[fmt] for fmt in formats] + [
+        [video, audio_] for video in formats if codec_family(video.get("acodec")) is None for audio_ in audio
+    ]
+    candidates = [candidate for candidate in candidates if fits(candidate, duration, max_filesize, max_height)]
+    if not candidates:
+        return None
+
+    def stream_score(candidate: list[dict]) -> tuple:
+        # sound first, then h264 (like the download's format_sort) so the video doesn't have to be transcoded, then
+        # the highest resolution. transcoding audio is cheap, aac only breaks ties
+        return (
+            any(codec_family(fmt.get("acodec")) is not None for fmt in candidate),
+            all(copy_video(fmt) for fmt in candidate if codec_family(fmt.get("vcodec")) is not None),
+            max(fmt.get("height") or 0 for fmt in candidate),
+            all(copy_audio(fmt) for fmt in candidate),
+            sum(fmt.get("tbr") or 0 for fmt in candidate)
+        )
+
+    return max(candidates, key=stream_score)
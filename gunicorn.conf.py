@@ -0,0 +1,17 @@
+import os
+import pathlib
+
+from prometheus_client import multiprocess
+
+
+def on_starting(server):
+    # metrics of a previous run would be added to this one's
+    if directory := os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        pathlib.Path(directory).mkdir(parents=True, exist_ok=True)
+        for file in pathlib.Path(directory).glob("*.db"):
+            file.unlink()
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
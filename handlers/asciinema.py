@@ -1,52 +1,252 @@
+import asyncio
+import codecs
+import concurrent.futures
+import dataclasses
+import hashlib
+import html.parser
 import pathlib
+import re
+import time
 import urllib.parse
 from tempfile import TemporaryDirectory
 
-from bs4 import BeautifulSoup
+# noinspection PyPackageRequirements
+import ffmpeg
 
+import media
 import telemetry
+import transport
+from cache import MemoryCache
 from handlers.base import RequestHandler
 from model import UfysError, UfysRequest, UfysResponse, UfysResponseMetadata
 
 
+class PageParser(html.parser.HTMLParser):
+    # pulls the og:title, author link and first heading out of asciinema pages. there's no tree, and the caller
+    # stops reading the page once everything it wants was found (usually somewhere in the first chunk)
+    VOID_ELEMENTS = ("area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "wbr")
+
+    def __init__(self, *wanted: str):
+        super().__init__()
+        self.wanted = wanted
+        self.values: dict[str, str] = {}
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.in_avatar = False
+        # tags open inside the first h1, None outside of it
+        self.h1_depth: int | None = None
+
+    @property
+    def done(self) -> bool:
+        return all(key in self.values for key in self.wanted)
+
+    def feed_bytes(self, data: bytes):
+        self.feed(self.decoder.decode(data))
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.h1_depth is not None and tag not in self.VOID_ELEMENTS:
+            self.h1_depth += 1
+        if tag == "meta" and attrs.get("property") == "og:title":
+            self.values.setdefault("title", attrs.get("content"))
+        elif tag == "span" and "author-avatar" in (attrs.get("class") or "").split():
+            self.in_avatar = True
+        elif tag == "a" and self.in_avatar:
+            self.values.setdefault("user_href", attrs.get("href"))
+        elif tag == "h1" and "heading" not in self.values:
+            self.h1_depth = 0
+
+    def handle_endtag(self, tag):
+        if tag == "span":
+            self.in_avatar = False
+        if self.h1_depth is not None:
+            self.h1_depth = None if self.h1_depth == 0 else self.h1_depth - 1
+
+    def handle_data(self, data):
+        # the heading's own text, not that of nested tags
+        if self.h1_depth == 0 and data.strip():
+            self.values.setdefault("heading", data.strip())
+
+
 class AsciinemaRequestHandler(RequestHandler):
     hostnames = ["asciinema.org"]
+    priority = 10
+    deadline = 120.
+    SCRAPE_CHUNK_SIZE = 16 * 1024
 
-    def handle_request(self, req: UfysRequest) -> UfysResponse:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # cast id -> [UfysResponseMetadata]
+        self.metadata_cache = MemoryCache(self.config.CACHE_SIZE)
+
+    def canonicalize(self, url: str) -> str | None:
+        if match := re.match(r"^/a/([^/]+)/?$", urllib.parse.urlparse(url).path):
+            return f"https://asciinema.org/a/{match.group(1)}"
+        return None
+
+    @staticmethod
+    def cast_id(req: UfysRequest) -> str:
         id_, = urllib.parse.urlparse(req.url).path.removeprefix("/a/").split("/")
+        return id_
+
+    def render_index_key(self, cast: bytes) -> str:
+        # renders only depend on the recording, unchanged ones (under any id) share one upload
+        return self.worker.video_index_key("asciinema", hashlib.sha256(cast).hexdigest())
+
+    def handle_request(self, req: UfysRequest) -> UfysResponse:
+        id_ = self.cast_id(req)
+        self.check_config()
+        # every request ends up as a reupload
+        if (existing := self.worker.find_reupload(req)) is not None:
+            return existing
+        # overlaps with fetching and rendering the cast
+        meta = self.submit_scrape(id_)
+        cast = self.request(**self.cast_request(id_)).content
+        index_key = self.render_index_key(cast)
+        if (existing := self.worker.find_upload(index_key)) is not None:
+            return dataclasses.replace(existing, **dataclasses.asdict(meta.result()))
+        with telemetry.stage("render"):
+            gif = self.request(**self.render_request(cast)).content
+        return self.render(req, gif, meta.result(), [index_key])
+
+    async def handle_request_async(self, req: UfysRequest) -> UfysResponse:
+        # same as handle_request
+        id_ = self.cast_id(req)
+        self.check_config()
+        if (existing := await self.run_blocking(self.worker.find_reupload, req)) is not None:
+            return existing
+        meta = asyncio.ensure_future(self.scrape_metadata_async(id_))
+        # don't leave a failed scrape unretrieved if we bail out before awaiting it
+        meta.add_done_callback(lambda task: task.cancelled() or task.exception())
+        try:
+            cast = (await self.request_async(**self.cast_request(id_))).content
+            index_key = self.render_index_key(cast)
+            if (existing := await self.run_blocking(self.worker.find_upload, index_key)) is not None:
+                return dataclasses.replace(existing, **dataclasses.asdict(await meta))
+            with telemetry.stage("render"):
+                gif = (await self.request_async(**self.render_request(cast))).content
+            # ffmpeg and the upload are blocking
+            return await self.run_blocking(self.render, req, gif, await meta, [index_key])
+        finally:
+            meta.cancel()
+
+    def check_config(self):
         if self.config.AAAS_ENDPOINT is None:
             raise UfysError(code="config-error", message="AAAS_ENDPOINT not set")
-        r = self.session.get(f"https://asciinema.org/a/{id_}.cast?dl=1")
-        r.raise_for_status()
-        r = self.session.post(self.config.AAAS_ENDPOINT, data=r.content)
-        r.raise_for_status()
+
+    @staticmethod
+    def cast_request(id_: str) -> dict:
+        return dict(method="GET", url=f"https://asciinema.org/a/{id_}.cast?dl=1")
+
+    def render_request(self, cast: bytes) -> dict:
+        # aaas doesn't send a byte before the gif is done, HTTP_READ_TIMEOUT would cut long renders short
+        return dict(method="POST", url=self.config.AAAS_ENDPOINT, data=cast, timeout=self.render_timeout())
+
+    def render_timeout(self) -> tuple[float | None, float]:
+        connect, _ = transport.timeouts(self.config)
+        return connect, self.deadline
+
+    def render(self, req: UfysRequest, gif: bytes, meta: UfysResponseMetadata, index_keys: list[str]) -> UfysResponse:
+        if self.config.STREAMING_REUPLOAD:
+            return self.render_streaming(req, gif, meta, index_keys)
+        return self.render_file(req, gif, meta, index_keys)
+
+    def render_file(
+        self, req: UfysRequest, gif: bytes, meta: UfysResponseMetadata, index_keys: list[str]
+    ) -> UfysResponse:
         with TemporaryDirectory() as _tmp:
-            gif = pathlib.Path(_tmp) / "render.gif"
-            mp4 = pathlib.Path(_tmp) / "render.mp4"
-            with open(gif, "wb") as file:
-                file.write(r.content)
-            self.convert_video_to_mp4(source=gif, dest=mp4)
-            return self.upload_file(
-                path=mp4,
-                hash_=req.hash,
-                dim=self.find_video_dimensions_from_file(mp4),
-                meta=self.scrape_metadata(id_=id_)
+            gif_path = pathlib.Path(_tmp) / "render.gif"
+            with open(gif_path, "wb") as file:
+                file.write(gif)
+            mp4, dim = self.prepare_mp4(source=gif_path, dest=pathlib.Path(_tmp) / "render.mp4")
+            return self.upload_file(path=mp4, hash_=req.key, dim=dim, meta=meta, index_keys=index_keys)
+
+    def render_streaming(
+        self, req: UfysRequest, gif: bytes, meta: UfysResponseMetadata, index_keys: list[str]
+    ) -> UfysResponse:
+        width, height = media.gif_dimensions(gif)
+        stream_spec = ffmpeg.input(
+            "pipe:",
+            format="gif",
+            vsync="0"
+        ).filter_(
+            "scale",
+            "trunc(iw/2)*2",
+            "trunc(ih/2)*2"
+        ).output(
+            "pipe:",
+            pix_fmt="yuv420p",
+            **self.encoder_args(),
+            **self.FRAGMENTED_MP4
+        )
+        with self.stream_ffmpeg(stream_spec, stdin=gif) as stream:
+            return self.upload_stream(
+                stream=stream,
+                hash_=req.key,
+                # same as the scale filter above
+                dim=(width // 2 * 2, height // 2 * 2),
+                meta=meta,
+                index_keys=index_keys
             )
 
-    @telemetry.trace_function
-    def scrape_metadata(self, id_) -> UfysResponseMetadata:
-        # TODO marie is looking into an api for this
-        r = self.session.get(f"https://asciinema.org/a/{id_}")
-        r.raise_for_status()
-        soup = BeautifulSoup(r.content, "html.parser")
-        title = soup.find("meta", dict(property="og:title")).attrs.get("content")
-        user_href = soup.find("span", {"class": "author-avatar"}).find("a").attrs.get("href")
-        r = self.session.get(f"https://asciinema.org{user_href}")
-        r.raise_for_status()
-        soup = BeautifulSoup(r.content, "html.parser")
-        user_string = soup.find("h1").find(string=True, recursive=False).get_text().strip()
+    def cached_metadata(self, id_: str) -> UfysResponseMetadata | None:
+        if (entry := self.metadata_cache.get(id_)) is None:
+            return None
+        return entry[0][0]
+
+    def cache_metadata(self, id_: str, meta: UfysResponseMetadata) -> UfysResponseMetadata:
+        self.metadata_cache.set(id_, [meta], time.time() + self.config.ASCIINEMA_METADATA_TTL)
+        return meta
+
+    def submit_scrape(self, id_: str) -> concurrent.futures.Future[UfysResponseMetadata]:
+        if (meta := self.cached_metadata(id_)) is not None:
+            future = concurrent.futures.Future()
+            future.set_result(meta)
+            return future
+        return self.submit_io(self.scrape_metadata, id_)
+
+    def scrape_page(self, url: str, *wanted: str) -> dict[str, str]:
+        parser = PageParser(*wanted)
+        with self.session.get(url, stream=True) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(self.SCRAPE_CHUNK_SIZE):
+                parser.feed_bytes(chunk)
+                if parser.done:
+                    break
+        return parser.values
+
+    async def scrape_page_async(self, url: str, *wanted: str) -> dict[str, str]:
+        parser = PageParser(*wanted)
+        async with self.get_async_session().stream("GET", url) as r:
+            r.raise_for_status()
+            async for chunk in r.aiter_bytes(self.SCRAPE_CHUNK_SIZE):
+                parser.feed_bytes(chunk)
+                if parser.done:
+                    break
+        return parser.values
+
+    @staticmethod
+    def metadata(page: dict[str, str], user_page: dict[str, str]) -> UfysResponseMetadata:
         return UfysResponseMetadata(
-            title=title,
-            creator=user_string,
+            title=page.get("title"),
+            creator=user_page.get("heading"),
             site="asciinema"
         )
+
+    @telemetry.trace_function
+    def scrape_metadata(self, id_) -> UfysResponseMetadata:
+        # TODO marie is looking into an api for this
+        page = self.scrape_page(f"https://asciinema.org/a/{id_}", "title", "user_href")
+        user_page = {}
+        if user_href := page.get("user_href"):
+            user_page = self.scrape_page(f"https://asciinema.org{user_href}", "heading")
+        return self.cache_metadata(id_, self.metadata(page, user_page))
+
+    @telemetry.trace_function
+    async def scrape_metadata_async(self, id_) -> UfysResponseMetadata:
+        if (meta := self.cached_metadata(id_)) is not None:
+            return meta
+        page = await self.scrape_page_async(f"https://asciinema.org/a/{id_}", "title", "user_href")
+        user_page = {}
+        if user_href := page.get("user_href"):
+            user_page = await self.scrape_page_async(f"https://asciinema.org{user_href}", "heading")
+        return self.cache_metadata(id_, self.metadata(page, user_page))
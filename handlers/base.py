@@ -1,5 +1,12 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
 import dataclasses
 import re
+import subprocess
+import threading
+import typing
 import urllib.parse
 from pathlib import Path
 from tempfile import TemporaryDirectory
@@ -7,9 +14,17 @@ from typing import TYPE_CHECKING
 
 # noinspection PyPackageRequirements
 import ffmpeg
+import httpx
 import requests
 
+import execution
+import media
+import metrics
+import streams
 import telemetry
+import transport
+import util
+from budget import Budget
 from model import UfysRequest, UfysResponse, UfysResponseMetadata
 
 if TYPE_CHECKING:
@@ -19,18 +34,100 @@ if TYPE_CHECKING:
 class RequestHandler:
     regex: re.Pattern | None = None
     hostnames: list[str] | None = None
+    # handlers with a higher priority are preferred, lower ones only run as a (hedged) fallback
+    priority: int = 0
+    # seconds after which a racing handler's result is no longer awaited
+    deadline: float | None = None
+    # ffmpeg output options for streaming: a regular mp4 needs a seekable output to write the moov atom
+    FRAGMENTED_MP4 = dict(format="mp4", movflags="frag_keyframe+empty_moov")
+    # handlers doing their network i/o natively async override this with a coroutine, everything else runs
+    # handle_request on the worker's executor when serving through the asgi app
+    handle_request_async: typing.Callable[[UfysRequest], typing.Awaitable[UfysResponse]] | None = None
 
     def __init__(self, worker: "Worker"):
         self.worker = worker
         self.config = self.worker.config
+        # can_handle runs for every handler on every request and is too cheap to be worth a span
         self.handle_request = telemetry.trace_function(self.handle_request)
-        self.can_handle = telemetry.trace_function(self.can_handle)
-        self.session = requests.Session()
-        self.session.headers.update({"User-Agent": "ufys/0.0.0 (https://github.com/jemand771/ufys)"})
+        if self.handle_request_async is not None:
+            self.handle_request_async = telemetry.trace_function(self.handle_request_async)
+        self.session = transport.make_session(self.config, self.__class__.__name__)
+        # independent upstream calls of one request run side by side here, threads are only started when needed
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(
+            self.config.HANDLER_IO_WORKERS or self.config.EXECUTOR_WORKERS,
+            thread_name_prefix=f"{self.__class__.__name__}-io"
+        )
+        # created on first use, it's bound to the event loop it's used on
+        self.async_session: httpx.AsyncClient | None = None
+        self.concurrency = util.parse_mapping(self.config.HANDLER_CONCURRENCY)
+        # per breaker key, created on first use
+        self.slots: dict[str, execution.Slots] = {}
+        self.slots_lock = threading.Lock()
 
     def handle_request(self, req: UfysRequest) -> UfysResponse:
         pass
 
+    def warm_up(self):
+        # slow setup (imports, instances) that shouldn't hold up startup, run by Worker.warm_up
+        pass
+
+    def canonicalize(self, url: str) -> str | None:
+        # a stable form of an (already normalized) url this handler can handle, or None if there is none
+        return None
+
+    def breaker_key(self, req: UfysRequest) -> str:
+        # requests sharing a circuit breaker, i.e. the same upstream
+        return self.__class__.__name__
+
+    def slots_for(self, req: UfysRequest) -> execution.Slots | None:
+        # acquired by the worker before the handler runs. limited per upstream (e.g. per yt-dlp extractor), by its
+        # breaker key's HANDLER_CONCURRENCY or else the handler class's. None -> unlimited
+        if not self.concurrency:
+            return None
+        key = self.breaker_key(req)
+        if not (limit := self.concurrency.get(key) or self.concurrency.get(self.__class__.__name__)):
+            return None
+        with self.slots_lock:
+            if (slots := self.slots.get(key)) is None:
+                slots = self.slots[key] = execution.Slots(int(limit))
+        return slots
+
+    def get_async_session(self) -> httpx.AsyncClient:
+        if self.async_session is None:
+            self.async_session = transport.make_async_client(self.config)
+        return self.async_session
+
+    def request(
+        self, method: str, url: str, data: bytes | None = None, timeout: tuple | None = None, **kwargs
+    ) -> requests.Response:
+        # raises for error statuses. timeout is (connect, read), None -> the session's defaults
+        r = self.session.request(method, url, data=data, timeout=timeout, **kwargs)
+        r.raise_for_status()
+        return r
+
+    async def request_async(
+        self, method: str, url: str, data: bytes | None = None, timeout: tuple | None = None, **kwargs
+    ) -> httpx.Response:
+        # takes the same arguments as request, so both variants of a handler can share them
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(None, connect=timeout[0], read=timeout[1])
+        r = await self.get_async_session().request(method, url, content=data, **kwargs)
+        r.raise_for_status()
+        return r
+
+    async def close_async(self):
+        if self.async_session is not None:
+            await self.async_session.aclose()
+            self.async_session = None
+
+    def submit_io(self, func: typing.Callable, *args) -> concurrent.futures.Future:
+        # keeps the request's trace context
+        return self.io_executor.submit(contextvars.copy_context().run, func, *args)
+
+    async def run_blocking(self, func: typing.Callable, *args):
+        # keeps the event loop free, subject to the same admission control as blocking handlers
+        return await asyncio.wrap_future(self.worker.executor.submit(func, *args))
+
     def can_handle(self, req: UfysRequest) -> bool:
         if self.regex and self.regex.match(req.url) is None:
             return False
@@ -38,33 +135,192 @@ class RequestHandler:
             return False
         return True
 
+    @telemetry.stage("upload")
     def upload_file(
-        self, path: Path, hash_: str, meta: UfysResponseMetadata, dim: tuple[int, int]
+        self, path: Path, hash_: str, meta: UfysResponseMetadata, dim: tuple[int, int], index_keys: list[str] = ()
     ) -> UfysResponse:
+        response = self.reuploaded_response(meta, dim)
+        response.video_url = self.worker.reupload(path, hash_, metadata=self.worker.upload_metadata(response))
+        self.worker.index_upload([self.worker.hash_index_key(hash_), *index_keys], response)
+        return response
+
+    @telemetry.stage("upload")
+    def upload_stream(
+        self,
+        stream: typing.BinaryIO,
+        hash_: str,
+        meta: UfysResponseMetadata,
+        dim: tuple[int, int],
+        index_keys: list[str] = ()
+    ) -> UfysResponse:
+        response = self.reuploaded_response(meta, dim)
+        response.video_url = self.worker.reupload_stream(stream, hash_, metadata=self.worker.upload_metadata(response))
+        self.worker.index_upload([self.worker.hash_index_key(hash_), *index_keys], response)
+        return response
+
+    @staticmethod
+    def reuploaded_response(meta: UfysResponseMetadata, dim: tuple[int, int]) -> UfysResponse:
+        # video_url is filled in once the upload is done
         return UfysResponse(
             **dataclasses.asdict(meta),
-            video_url=self.worker.reupload(path, hash_),
+            video_url=None,
             width=dim[0],
             height=dim[1],
             reuploaded=True
         )
 
+    @staticmethod
+    def check_length(headers, max_bytes: int | None):
+        # fail before reading anything if the server tells us it's too much
+        if max_bytes is not None and (length := headers.get("Content-Length", "")).isdigit():
+            if int(length) > max_bytes:
+                raise Budget.exceeded("filesize", int(length), max_bytes)
+
+    @staticmethod
+    @contextlib.contextmanager
+    def limit_stream(max_bytes: int | None):
+        try:
+            yield
+        except streams.LimitExceeded as ex:
+            raise Budget.exceeded("filesize", ex.args[0], max_bytes)
+
+    @contextlib.contextmanager
+    def stream_url(
+        self, url: str, headers: dict[str, str] | None = None, max_bytes: int | None = None
+    ) -> typing.Iterator[typing.BinaryIO]:
+        with self.session.get(url, stream=True, headers=headers) as r:
+            r.raise_for_status()
+            self.check_length(r.headers, max_bytes)
+            r.raw.decode_content = True
+            with self.limit_stream(max_bytes), streams.PrefetchStream(
+                r.raw, buffer_size=self.config.STREAM_BUFFER_SIZE, max_bytes=max_bytes
+            ) as stream:
+                try:
+                    yield stream
+                finally:
+                    metrics.DOWNLOADED_BYTES.inc(stream.bytes_read)
+
+    @contextlib.contextmanager
+    def stream_ffmpeg(
+        self, stream_spec, stdin: bytes | None = None, max_bytes: int | None = None
+    ) -> typing.Iterator[typing.BinaryIO]:
+        process = subprocess.Popen(
+            ffmpeg.compile(stream_spec.global_args("-loglevel", "error", "-nostats")),
+            stdin=subprocess.PIPE if stdin is not None else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+
+        def feed():
+            try:
+                process.stdin.write(stdin)
+                process.stdin.close()
+            except BrokenPipeError:
+                # ffmpeg exited early, finish() reports why
+                pass
+
+        def finish():
+            # make a failed (and therefore truncated) conversion fail the upload instead of completing it
+            stderr = process.stderr.read()
+            if process.wait() != 0:
+                raise ffmpeg.Error("ffmpeg", None, stderr)
+
+        if stdin is not None:
+            threading.Thread(target=feed, daemon=True).start()
+        try:
+            with self.limit_stream(max_bytes), streams.PrefetchStream(
+                process.stdout, buffer_size=self.config.STREAM_BUFFER_SIZE, finish=finish, max_bytes=max_bytes
+            ) as stream:
+                yield stream
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    @telemetry.stage("download")
     @telemetry.trace_function
-    def download_file(self, url: str, path: Path):
+    def download_file(self, url: str, path: Path, max_bytes: int | None = None):
         with self.session.get(url, stream=True) as r:
             r.raise_for_status()
+            self.check_length(r.headers, max_bytes)
+            size = 0
             with open(path, "wb") as f:
                 for chunk in r.iter_content(chunk_size=8 * 1024):
+                    size += len(chunk)
+                    metrics.DOWNLOADED_BYTES.inc(len(chunk))
+                    if max_bytes is not None and size > max_bytes:
+                        # Content-Length was missing (or lied), stop right here instead of filling the disk
+                        raise Budget.exceeded("filesize", size, max_bytes)
                     f.write(chunk)
 
+    @telemetry.trace_function
+    def download_range(self, url: str, start: int, length: int) -> bytes:
+        with self.session.get(url, stream=True, headers=dict(Range=f"bytes={start}-{start + length - 1}")) as r:
+            r.raise_for_status()
+            if r.status_code != 206 and start != 0:
+                raise ValueError("server does not support range requests")
+            data = bytearray()
+            for chunk in r.iter_content(chunk_size=8 * 1024):
+                data += chunk
+                if len(data) >= length:
+                    break
+            metrics.DOWNLOADED_BYTES.inc(len(data))
+            return bytes(data[:length])
+
+    @telemetry.stage("probe")
     @telemetry.trace_function
     def find_dimensions_from_url(self, url: str):
+        if self.config.PROBE_BYTES > 0:
+            try:
+                return self.probe_dimensions_from_url(url)
+            except (ffmpeg.Error, AssertionError, ValueError, requests.RequestException):
+                pass
         with TemporaryDirectory() as _tmp:
             tmp = Path(_tmp)
             file = tmp / "video"
-            self.download_file(url, file)
+            self.download_file(url, file, max_bytes=self.config.MAX_FILESIZE or None)
+            telemetry.set_attributes(**{"probe.mode": "full", "probe.bytes": file.stat().st_size})
             return self.find_video_dimensions_from_file(file)
 
+    @telemetry.trace_function
+    def probe_dimensions_from_url(self, url: str):
+        # only fetch the container header instead of the whole video
+        head = self.download_range(url, 0, self.config.PROBE_BYTES)
+        bytes_read = len(head)
+        mode = "head"
+        if media.is_mp4(head) and not any(
+            box.type == b"moov" and box.end <= len(head)
+            for box in media.iter_boxes(head)
+        ):
+            # moov atom isn't at the front (no faststart), hop over the top level boxes until we find it
+            ftyp = next(media.iter_boxes(head))
+            moov, bytes_read = self.locate_mp4_box(url, head, b"moov")
+            bytes_read += len(head)
+            head = head[:ftyp.end] + moov
+            mode = "tail"
+        telemetry.set_attributes(**{"probe.mode": mode, "probe.bytes": bytes_read})
+        with TemporaryDirectory() as _tmp:
+            file = Path(_tmp) / "video"
+            file.write_bytes(head)
+            return self.find_video_dimensions_from_file(file)
+
+    def locate_mp4_box(self, url: str, head: bytes, type_: bytes, max_hops: int = 16) -> tuple[bytes, int]:
+        offset = 0
+        bytes_read = 0
+        for _ in range(max_hops):
+            if offset + 16 <= len(head):
+                header = head[offset:offset + 16]
+            else:
+                header = self.download_range(url, offset, 16)
+                bytes_read += len(header)
+            if (box := media.parse_box_header(header, offset)) is None or box.size == 0:
+                break
+            if box.type == type_:
+                data = self.download_range(url, box.offset, box.size)
+                return data, bytes_read + len(data)
+            offset = box.end
+        raise ValueError(f"unable to locate {type_} box")
+
     @staticmethod
     @telemetry.trace_function
     def find_video_dimensions_from_file(path: Path):
@@ -72,17 +328,49 @@ class RequestHandler:
         assert len(streams) == 1
         return streams[0].get("width"), streams[0].get("height")
 
+    @staticmethod
+    @telemetry.stage("probe")
+    @telemetry.trace_function
+    def probe_file(path: Path) -> media.Probe:
+        return media.Probe.from_ffprobe(ffmpeg.probe(str(path)))
+
+    def encoder_args(self) -> dict:
+        # software x264, fast presets are several times cheaper than the default "medium" at a slightly larger size
+        args = dict(vcodec="libx264", preset=self.config.TRANSCODE_PRESET, crf=self.config.TRANSCODE_CRF)
+        if self.config.TRANSCODE_THREADS > 0:
+            args["threads"] = self.config.TRANSCODE_THREADS
+        return args
+
     @telemetry.trace_function
-    def convert_video_to_mp4(self, source: Path, dest: Path):
-        ffmpeg.input(
-            str(source),
-            vsync="0"
-        ).filter_(
-            "scale",
-            "trunc(iw/2)*2",
-            "trunc(ih/2)*2"
-        ).output(
-            str(dest),
-            pix_fmt="yuv420p",
-            movflags="faststart"
-        ).run()
+    def prepare_mp4(self, source: Path, dest: Path) -> tuple[Path, tuple[int, int]]:
+        # turns whatever we downloaded into a faststart mp4 as cheaply as possible: streams browsers can play are
+        # copied, only the others are transcoded. returns the file to upload (source if it's fine as is) and
+        # its dimensions, from the same probe
+        probe = self.probe_file(source)
+        with open(source, "rb") as file:
+            head = file.read(64 * 1024)
+        if probe.copy_video and probe.copy_audio and media.is_faststart(head):
+            telemetry.set_attributes(**{"pipeline.mode": "none"})
+            return source, (probe.width, probe.height)
+        mode = "remux" if probe.copy_video else "transcode"
+        telemetry.set_attributes(**{"pipeline.mode": mode, "pipeline.copy_audio": probe.copy_audio})
+        input_ = ffmpeg.input(str(source), **({} if probe.copy_video else dict(vsync="0")))
+        if probe.copy_video:
+            video, video_args = input_["v:0"], dict(vcodec="copy")
+            dim = probe.width, probe.height
+        else:
+            # yuv420p needs even dimensions
+            video = input_["v:0"].filter_("scale", "trunc(iw/2)*2", "trunc(ih/2)*2")
+            video_args = self.encoder_args() | dict(pix_fmt="yuv420p")
+            dim = probe.width // 2 * 2, probe.height // 2 * 2
+        audio = [input_["a:0"]] if probe.audio_codec is not None else []
+        with telemetry.stage(mode):
+            ffmpeg.output(
+                video,
+                *audio,
+                str(dest),
+                **video_args,
+                acodec="copy" if probe.copy_audio else "aac",
+                movflags="faststart"
+            ).global_args("-loglevel", "error", "-nostats").run(overwrite_output=True)
+        return dest, dim
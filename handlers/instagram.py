@@ -1,31 +1,60 @@
+import asyncio
+import re
+import urllib.parse
+
+import telemetry
 from handlers.base import RequestHandler
 from model import UfysRequest, UfysResponse
 
 
 class InstagramRequestHandler(RequestHandler):
     hostnames = ["instagram.com", "www.instagram.com"]
+    priority = 10
+    deadline = 30.
+    # posts, reels and igtv videos share their shortcodes
+    POST_REGEX = re.compile(r"^/(?:[^/]+/)?(?:p|reels?|tv)/([^/]+)")
+
+    def canonicalize(self, url: str) -> str | None:
+        if match := self.POST_REGEX.match(urllib.parse.urlparse(url).path):
+            return f"https://www.instagram.com/p/{match.group(1)}/"
+        return None
+
+    OEMBED_URL = "https://i.instagram.com/api/v1/oembed/"
+    COBALT_URL = "https://api.cobalt.tools/api/json"
 
+    @telemetry.stage("extract")
     def handle_request(self, req: UfysRequest) -> UfysResponse:
-        r = self.session.get("https://i.instagram.com/api/v1/oembed/", params=dict(
-            url=req.url
-        ))
-        r.raise_for_status()
-        meta = r.json()
-
-        r = self.session.post(
-            "https://api.cobalt.tools/api/json",
-            json=dict(url=req.url),
-            headers=dict(Accept="application/json")
-        )
-        r.raise_for_status()
-        video_url = r.json()["url"]
-        width, height = self.find_dimensions_from_url(video_url)
+        # oembed and cobalt don't depend on each other, the slower of the two (plus the probe) is what we wait for
+        meta = self.submit_io(lambda: self.request(**self.oembed(req.url)).json())
+        video_url = self.request(**self.cobalt(req.url)).json()["url"]
+        return self.response(meta.result(), video_url, self.find_dimensions_from_url(video_url))
+
+    async def handle_request_async(self, req: UfysRequest) -> UfysResponse:
+        # same as handle_request
+        async def meta():
+            return (await self.request_async(**self.oembed(req.url))).json()
+
+        async def video() -> tuple[str, tuple[int, int]]:
+            video_url = (await self.request_async(**self.cobalt(req.url))).json()["url"]
+            return video_url, await self.run_blocking(self.find_dimensions_from_url, video_url)
+
+        with telemetry.stage("extract"):
+            meta, (video_url, dim) = await asyncio.gather(meta(), video())
+        return self.response(meta, video_url, dim)
+
+    def oembed(self, url: str) -> dict:
+        return dict(method="GET", url=self.OEMBED_URL, params=dict(url=url))
+
+    def cobalt(self, url: str) -> dict:
+        return dict(method="POST", url=self.COBALT_URL, json=dict(url=url), headers=dict(Accept="application/json"))
 
+    @staticmethod
+    def response(meta: dict, video_url: str, dim: tuple[int, int]) -> UfysResponse:
         return UfysResponse(
             title=meta["title"],
             creator=meta["author_name"],
             site="Instagram",
             video_url=video_url,
-            width=width,
-            height=height
+            width=dim[0],
+            height=dim[1]
         )
@@ -1,33 +1,105 @@
 import dataclasses
+import functools
 import re
+import typing
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
-from yt_dlp import YoutubeDL
-from yt_dlp.utils import DownloadError
+# noinspection PyPackageRequirements
+import ffmpeg
+import requests
 
+import format_selection
+import metrics
 import telemetry
-import util
+from budget import Budget
 from handlers.base import RequestHandler
 from model import UfysError, UfysRequest, UfysResponse, UfysResponseMetadata
+from pool import ObjectPool
+
+if typing.TYPE_CHECKING:
+    from yt_dlp import YoutubeDL
 
 
 class YTDLRequestHandler(RequestHandler):
+    # yt-dlp is imported by warm_up (or the first request), importing it is most of what makes startup slow
     regex = re.compile(r".*")
     YTDL_OPTS = dict(
         progress_with_newline=True,
     )
+    # formats we can remux instead of transcoding, if there are any
+    YTDL_DOWNLOAD_OPTS = dict(
+        format_sort=["vcodec:h264", "acodec:aac"],
+        merge_output_format="mp4",
+    )
+    # protocols ffmpeg (or requests) can read from directly, without yt-dlp's downloaders
+    STREAMABLE_PROTOCOLS = ("http", "https", "m3u8", "m3u8_native")
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.ytdl = YoutubeDL(self.YTDL_OPTS)
-        self.ytdl.extract_info = telemetry.trace_function(self.ytdl.extract_info)
+        # YoutubeDL instances carry per-extraction state, so every thread gets its own
+        self.ytdl_pool = ObjectPool(
+            lambda: self.make_ytdl(self.YTDL_OPTS),
+            size=self.config.YTDL_POOL_SIZE,
+            max_uses=self.config.YTDL_POOL_MAX_USES,
+            # yt-dlp's download errors are turned into these while the instance is checked out
+            keep_on=(UfysError,)
+        )
 
-    def handle_request(self, req: UfysRequest) -> UfysResponse:
+    def warm_up(self):
+        self.ytdl_pool.warm()
+
+    def canonicalize(self, url: str) -> str | None:
+        if not self.config.CANONICALIZE_EXTRACTORS:
+            return None
+        extractor, id_ = self.match_extractor(url)
+        if id_ is None:
+            return None
+        return f"ytdl:{extractor}:{id_}"
+
+    def breaker_key(self, req: UfysRequest) -> str:
+        # one broken extractor shouldn't take all of yt-dlp down with it
+        extractor, _ = self.match_extractor(req.url)
+        return f"{super().breaker_key(req)}:{extractor}"
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def match_extractor(url: str) -> tuple[str, str | None]:
+        from yt_dlp.extractor import gen_extractor_classes
+        # same matching yt-dlp does before extracting, minus the network: extractor + video id
+        for ie in gen_extractor_classes():
+            if ie.ie_key() == "Generic" or not ie.suitable(url):
+                continue
+            return ie.ie_key(), ie.get_temp_id(url)
+        return "Generic", None
+
+    @staticmethod
+    def make_ytdl(opts: dict) -> "YoutubeDL":
+        from yt_dlp import YoutubeDL
+        ytdl = YoutubeDL(opts)
+        ytdl.extract_info = telemetry.trace_function(ytdl.extract_info, attributes=("url", "download"))
+        return ytdl
+
+    @staticmethod
+    def extract_info(ytdl: "YoutubeDL", url: str, download: bool = True) -> dict:
+        from yt_dlp.networking.exceptions import TransportError
+        from yt_dlp.utils import DownloadError
         try:
-            info = self.ytdl.extract_info(req.url, download=False)
-        except DownloadError:
+            return ytdl.extract_info(url, download=download)
+        except DownloadError as ex:
+            cause = ex.exc_info[1] if ex.exc_info else None
+            if isinstance(cause, TransportError) or isinstance(getattr(cause, "cause", None), TransportError):
+                # the site, not the video: this one counts toward the circuit breaker
+                raise UfysError("upstream-error", message=f"yt-dlp couldn't reach the site ({cause})")
+            # deleted, private, geo-blocked, ...
             raise UfysError("download-error", message="yt-dlp failed to download this video")
+
+    def handle_request(self, req: UfysRequest) -> UfysResponse:
+        try:
+            with telemetry.stage("extract"), self.ytdl_pool.checkout(self.config.YTDL_POOL_TIMEOUT) as ytdl:
+                info = self.extract_info(ytdl, req.url, download=False)
+        except TimeoutError:
+            raise UfysError("overloaded", message="no yt-dlp instance became available in time")
         type_ = info.get("_type", "video")
         if type_ == "video":
             return self.handle_video(req, info)
@@ -43,32 +115,24 @@ class YTDLRequestHandler(RequestHandler):
             raise UfysError("unknown-playlist", message="playlist detected, but unable to process")
         raise UfysError(code="unknown-type", message="unknown media type")
 
-    @telemetry.trace_function
+    @telemetry.trace_function(attributes=("req.url", "info.id", "info.extractor_key", "info.webpage_url"))
     def handle_video(self, req: UfysRequest, info):
-        # sort best to worst
-        formats = info.get("formats")[::-1]
-        # we're looking for h264 mp4 with audio
-        for fmt in formats:
-            try:
-                if fmt["acodec"] == "none":
-                    continue
-                if fmt["vcodec"] != "h264":
-                    continue
-                if fmt["ext"] != "mp4":
-                    continue
-                # TODO fall back if this is _too_ bad
-                # _maybe_ split this handler into two - one for direct linking, one for reuploads
-                if not (direct_url := fmt.get("url")):
-                    continue
-                return self.handle_direct_url(direct_url, info)
-            except KeyError:
-                # incomplete info -> we probably didn't want this anyway
-                continue
-        return self.reupload_ytdl(req)
+        # what the client asked for applies to links too
+        Budget.of(req).check(duration=info.get("duration"))
+        selection = format_selection.select(info, max_filesize=req.max_filesize, max_height=req.max_height)
+        if selection.linkable:
+            return self.handle_direct_url(selection.format["url"], info, selection.format)
+        # every reupload is a full download and upload, keep track of why we couldn't link
+        telemetry.set_attributes(**{"reupload.reason": selection.reason})
+        metrics.REUPLOADS.labels(selection.reason).inc()
+        # with a muxed h264 stream to remux (selection.format), only the container needs to change
+        return self.reupload_ytdl(req, info, selection.format)
 
-    @telemetry.trace_function
-    def handle_direct_url(self, url: str, info):
-        if not (width := info.get("width")) or not (height := info.get("height")):
+    @telemetry.trace_function(attributes=("url", "info.id", "info.extractor_key", "info.webpage_url"))
+    def handle_direct_url(self, url: str, info, fmt: dict | None = None):
+        # the linked format's dimensions, or the video's if we're linking what yt-dlp picked
+        dims = fmt if fmt is not None else info
+        if not (width := dims.get("width")) or not (height := dims.get("height")):
             # we don't know the dimensions
             width, height = self.find_dimensions_from_url(url)
         return UfysResponse(
@@ -78,25 +142,167 @@ class YTDLRequestHandler(RequestHandler):
             height=height
         )
 
-    def reupload_ytdl(self, req: UfysRequest):
-        # TODO size limit - pass in via request param? (support for external overrides)
+    @telemetry.trace_function(attributes=("req.url", "info.id", "info.extractor_key", "info.webpage_url"))
+    def reupload_ytdl(self, req: UfysRequest, info, fmt: dict | None = None):
+        # info already has yt-dlp's format selection applied, either as a single format or as formats to merge,
+        # unless handle_video found a better `fmt` to remux
+        budget = Budget.of(req, self.config)
+        budget.check(duration=info.get("duration"))
+        if (existing := self.worker.find_reupload(req)) is not None:
+            return existing
+        index_keys = []
+        if (extractor := info.get("extractor_key")) and (id_ := info.get("id")):
+            # different urls for the same video (and budget) share one upload
+            index_keys.append(self.worker.video_index_key(extractor, id_, budget.variant))
+            existing = self.worker.find_upload(index_keys[0])
+            if existing is not None and (budget.height is None or existing.height <= budget.height):
+                return existing
+        formats = [fmt] if fmt is not None else [] if info.get("formats") else [info]
+        if not format_selection.fits(formats, info.get("duration"), budget.filesize, budget.height):
+            formats = []
+        if not formats:
+            # preferring h264/aac like the download path does, and within budget. the download path (with its res:
+            # preference) if nothing streamable fits
+            formats = format_selection.select_streams(
+                info, self.STREAMABLE_PROTOCOLS, budget.filesize, budget.height
+            ) or []
+        if self.config.STREAMING_REUPLOAD and formats and all(
+            fmt_.get("url") and fmt_.get("protocol") in self.STREAMABLE_PROTOCOLS
+            for fmt_ in formats
+        ) and (dim := self.stream_dimensions(info, formats)) is not None:
+            return self.reupload_ytdl_streaming(req, info, formats, dim, index_keys, budget)
+        # whatever yt-dlp downloads is one of the listed formats, don't download anything if none of them fit
+        if (exceeded := format_selection.over_budget(info, budget.filesize, budget.height)) is not None:
+            raise Budget.exceeded(*exceeded)
+        return self.reupload_ytdl_download(req, index_keys, budget)
+
+    def stream_dimensions(self, info, formats: list[dict]) -> tuple[int, int] | None:
+        # the video format's dimensions if yt-dlp listed them, the merged ones otherwise, a probe if neither.
+        # None if probing failed too, the download path probes the file it downloaded instead
+        width = next((fmt["width"] for fmt in formats if fmt.get("width")), info.get("width"))
+        height = next((fmt["height"] for fmt in formats if fmt.get("height")), info.get("height"))
+        if width is not None and height is not None:
+            return width, height
+        video = next((fmt for fmt in formats if fmt.get("vcodec") != "none"), formats[0])
+        try:
+            if video["protocol"] in ("http", "https"):
+                return self.find_dimensions_from_url(video["url"])
+            return self.probe_playlist_dimensions(video)
+        except (ffmpeg.Error, AssertionError, ValueError, requests.RequestException):
+            return None
+
+    @telemetry.stage("probe")
+    @telemetry.trace_function
+    def probe_playlist_dimensions(self, fmt: dict) -> tuple[int, int]:
+        # the playlist itself is just text, ffprobe follows it to the first segment
+        streams = ffmpeg.probe(fmt["url"], select_streams="v", **self.ffmpeg_input_args(fmt)).get("streams", [])
+        assert len(streams) == 1
+        return streams[0]["width"], streams[0]["height"]
+
+    def reupload_ytdl_streaming(
+        self,
+        req: UfysRequest,
+        info,
+        formats: list[dict],
+        dim: tuple[int, int],
+        index_keys: list[str],
+        budget: Budget = Budget()
+    ):
+        width, height = dim
+        meta = self.meta_from_info(info)
+        video_index = next((index for index, fmt in enumerate(formats) if fmt.get("vcodec") != "none"), 0)
+        # the audio format if there's a separate one, otherwise whatever audio the video format has
+        audio_index = next(
+            (index for index, fmt in enumerate(formats) if index != video_index and fmt.get("acodec") != "none"),
+            video_index
+        )
+        copy_video = format_selection.copy_video(formats[video_index])
+        copy_audio = all(format_selection.copy_audio(fmt) for fmt in formats)
+        if (
+            len(formats) == 1 and formats[0].get("ext") == "mp4" and formats[0]["protocol"] in ("http", "https")
+            and copy_video and copy_audio
+        ):
+            # a single progressive mp4 browsers can play - no need to touch it
+            telemetry.set_attributes(**{"pipeline.mode": "none"})
+            with self.stream_url(
+                formats[0]["url"], headers=formats[0].get("http_headers"), max_bytes=budget.filesize
+            ) as stream:
+                return self.upload_stream(
+                    stream=stream, hash_=req.key, meta=meta, dim=(width, height), index_keys=index_keys
+                )
+        # same decision as prepare_mp4, made from yt-dlp's codecs instead of a probe
+        mode = "remux" if copy_video else "transcode"
+        telemetry.set_attributes(**{"pipeline.mode": mode, "pipeline.copy_audio": copy_audio})
+        inputs = [ffmpeg.input(fmt["url"], **self.ffmpeg_input_args(fmt)) for fmt in formats]
+        if copy_video:
+            video, video_args = inputs[video_index]["v:0"], dict(vcodec="copy")
+        else:
+            # yuv420p needs even dimensions
+            video = inputs[video_index]["v:0"].filter_("scale", "trunc(iw/2)*2", "trunc(ih/2)*2")
+            video_args = self.encoder_args() | dict(pix_fmt="yuv420p")
+            width, height = width // 2 * 2, height // 2 * 2
+        audio = [inputs[audio_index]["a:0?"]] if formats[audio_index].get("acodec") != "none" else []
+        stream_spec = ffmpeg.output(
+            video,
+            *audio,
+            "pipe:",
+            **video_args,
+            acodec="copy" if copy_audio else "aac",
+            **self.FRAGMENTED_MP4
+        )
+        with self.stream_ffmpeg(stream_spec, max_bytes=budget.filesize) as stream:
+            return self.upload_stream(
+                stream=stream, hash_=req.key, meta=meta, dim=(width, height), index_keys=index_keys
+            )
+
+    @staticmethod
+    def ffmpeg_input_args(fmt: dict) -> dict[str, str]:
+        if not (headers := fmt.get("http_headers")):
+            return {}
+        return dict(headers="".join(f"{key}: {value}\r\n" for key, value in headers.items()))
+
+    def reupload_ytdl_download(self, req: UfysRequest, index_keys: list[str], budget: Budget = Budget()):
         with TemporaryDirectory() as tmp:
-            with util.chdir(tmp):
-                info = self.ytdl.extract_info(req.url)
+            # a dedicated instance, downloads are rare and the output path is instance state
+            with telemetry.stage("download"):
+                opts = self.YTDL_OPTS | self.YTDL_DOWNLOAD_OPTS | dict(paths=dict(home=tmp))
+                if budget.height is not None:
+                    # the best formats up to that height, instead of rejecting the video after downloading it.
+                    # formats with an unknown height are allowed, the check after the download catches those
+                    opts["format"] = f"bv*[height<=?{budget.height}]+ba/b[height<=?{budget.height}]"
+                if budget.filesize is not None:
+                    opts["progress_hooks"] = [self.download_limit(budget.filesize)]
+                info = self.extract_info(self.make_ytdl(opts), req.url)
+            budget.check(duration=info.get("duration"), height=info.get("height"))
             downloads = info.get("requested_downloads", [])
             assert len(downloads) == 1
             path = Path(downloads[0]["filepath"])
-            width = downloads[0].get("width")
-            height = downloads[0].get("height")
-            if width is None or height is None:
-                width, height = self.find_video_dimensions_from_file(path)
+            metrics.DOWNLOADED_BYTES.inc(path.stat().st_size)
+            path, dim = self.prepare_mp4(path, Path(tmp) / "upload.mp4")
             return self.upload_file(
                 path=path,
-                hash_=req.hash,
+                hash_=req.key,
                 meta=self.meta_from_info(info),
-                dim=(width, height)
+                dim=dim,
+                index_keys=index_keys
             )
 
+    @staticmethod
+    def download_limit(max_bytes: int) -> typing.Callable[[dict], None]:
+        # a yt-dlp progress hook aborting the download once it's over budget. merged formats are downloaded one
+        # after the other, each to its own file
+        downloaded: dict[str, int] = {}
+
+        def hook(progress: dict):
+            # total_bytes is only there if the server told us, and then it's exact
+            downloaded[progress.get("filename")] = max(
+                progress.get("downloaded_bytes") or 0, progress.get("total_bytes") or 0
+            )
+            if (size := sum(downloaded.values())) > max_bytes:
+                raise Budget.exceeded("filesize", size, max_bytes)
+
+        return hook
+
     @staticmethod
     def meta_from_info(info):
         return UfysResponseMetadata(
@@ -0,0 +1,102 @@
+import collections
+import concurrent.futures
+import json
+import threading
+import urllib.parse
+import uuid
+from typing import TYPE_CHECKING
+
+import requests
+
+import telemetry
+import transport
+from model import UfysError, UfysJob, UfysRequest, UfysResponse, serialize
+
+if TYPE_CHECKING:
+    from worker import Worker
+
+
+class JobManager:
+
+    def __init__(self, worker: "Worker"):
+        self.worker = worker
+        self.config = worker.config
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.config.JOB_WORKERS, thread_name_prefix="job")
+        self.jobs: collections.OrderedDict[str, UfysJob] = collections.OrderedDict()
+        # request key -> id of the queued/running job for it
+        self.active: dict[str, str] = {}
+        # job id -> webhooks of everyone who submitted it while it was queued/running
+        self.callbacks: dict[str, list[str]] = {}
+        self.lock = threading.Lock()
+        self.session = transport.make_session(self.config, "jobs")
+
+    def submit(self, req: UfysRequest, callback_url: str | None = None) -> UfysJob:
+        if callback_url is not None:
+            self.check_callback(callback_url)
+        self.worker.canonicalize(req)
+        key = req.key
+        with self.lock:
+            if (id_ := self.active.get(key)) is not None:
+                if callback_url is not None and callback_url not in self.callbacks[id_]:
+                    self.callbacks[id_].append(callback_url)
+                return self.jobs[id_]
+            if len(self.active) >= self.config.JOB_QUEUE_SIZE:
+                raise UfysError(code="overloaded", message="too many jobs in flight, try again later")
+            job = UfysJob(id=uuid.uuid4().hex)
+            self.jobs[job.id] = job
+            self.active[key] = job.id
+            self.callbacks[job.id] = [callback_url] if callback_url is not None else []
+            self.prune()
+        self.executor.submit(self.run, job, req, key)
+        return job
+
+    def check_callback(self, callback_url: str):
+        url = urllib.parse.urlparse(callback_url)
+        schemes = [scheme.strip() for scheme in self.config.JOB_CALLBACK_SCHEMES.split(",") if scheme.strip()]
+        hosts = [host.strip().lower() for host in self.config.JOB_CALLBACK_HOSTS.split(",") if host.strip()]
+        if url.scheme not in schemes or not url.hostname or not any(
+            url.hostname == host or (host.startswith(".") and url.hostname.endswith(host))
+            for host in hosts
+        ):
+            raise UfysError(code="bad-callback", message="callback_url is not an allowed callback host")
+
+    def get(self, id_: str) -> UfysJob | None:
+        return self.jobs.get(id_)
+
+    def prune(self):
+        # forget the oldest finished jobs
+        for id_ in list(self.jobs):
+            if len(self.jobs) <= self.config.JOB_HISTORY:
+                break
+            if self.jobs[id_].state in ("done", "failed"):
+                del self.jobs[id_]
+
+    def run(self, job: UfysJob, req: UfysRequest, key: str):
+        job.state = "running"
+        try:
+            with telemetry.listen_stages(lambda stage: setattr(job, "stage", stage)):
+                job.results = self.worker.handle_request(req)
+        except Exception as ex:
+            job.results = [UfysError(code="implementation-error", message=f"job crashed ({str(ex)})")]
+        job.stage = None
+        job.state = "done" if any(isinstance(result, UfysResponse) for result in job.results) else "failed"
+        with self.lock:
+            del self.active[key]
+            callback_urls = self.callbacks.pop(job.id)
+        for callback_url in callback_urls:
+            self.notify(job, callback_url)
+
+    @telemetry.trace_function
+    def notify(self, job: UfysJob, callback_url: str):
+        try:
+            r = self.session.post(
+                callback_url,
+                data=json.dumps(serialize(job), ensure_ascii=False).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+                timeout=self.config.JOB_CALLBACK_TIMEOUT,
+                # an allowed host mustn't be able to send us elsewhere
+                allow_redirects=False
+            )
+            r.raise_for_status()
+        except requests.RequestException as ex:
+            print(f"warning: job callback to {callback_url} failed ({ex})")
@@ -1,18 +1,24 @@
-import dataclasses
+import json
+import threading
+import time
 
 import flask.json.provider
-from flask import Flask, request
+from flask import Flask, Response, request, stream_with_context
 from flask.json import jsonify
 from opentelemetry.instrumentation.flask import FlaskInstrumentor
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
 
+import jobs
+import metrics
 import telemetry
 import util
 import worker
-from model import MinioNotConnected, UfysError, UfysRequest, UfysResponse
+from model import MinioNotConnected, UfysError, UfysRequest, UfysResponse, serialize
 
 APP = Flask(__name__)
 WORKER = worker.Worker(worker.ConfigStore.from_env())
+WORKER.start_warm_up()
+JOBS = jobs.JobManager(WORKER)
 
 telemetry.init(service_name="embed-works.ufys")
 FlaskInstrumentor().instrument_app(APP)
@@ -21,28 +27,85 @@ RequestsInstrumentor().instrument()
 
 class CustomJsonProvider(flask.json.provider.DefaultJSONProvider):
     def dumps(self, o, **kwargs):
-        if not isinstance(o, list) or not all(dataclasses.is_dataclass(c) for c in o):
-            return super().dumps(o, **kwargs)
-        return super().dumps(
-            [
-                dataclasses.asdict(c) | dict(_class=c.__class__.__name__)
-                for c in o
-            ], **kwargs
-        )
+        return super().dumps(serialize(o), **kwargs)
 
 
 APP.json = CustomJsonProvider(APP)
+REQUEST_LOG_LOCK = threading.Lock()
+
+
+def log_request(body):
+    if not WORKER.config.REQUEST_LOG:
+        return
+    line = json.dumps(dict(time=time.time(), request=body), ensure_ascii=False)
+    # one short write per line, so lines of several gunicorn workers don't interleave
+    with REQUEST_LOG_LOCK, open(WORKER.config.REQUEST_LOG, "a", encoding="utf-8") as file:
+        file.write(line + "\n")
 
 
 @APP.post("/video")
 def get_video_url():
+    log_request(request.json)
     req = util.dataclass_from_dict(UfysRequest, request.json)
     resp = WORKER.handle_request(req)
     assert resp
     success = any(isinstance(c, UfysResponse) for c in resp)
+    if not success and all(c.code == "overloaded" for c in resp):
+        return jsonify(resp), 503, {"Retry-After": str(WORKER.config.RETRY_AFTER)}
     return jsonify(resp), 200 if success else 500
 
 
+@APP.post("/videos")
+def get_video_urls():
+    if not isinstance(request.json, list):
+        return jsonify([UfysError(code="bad-request", message="expected a list of requests")]), 400
+    if len(request.json) > WORKER.config.BATCH_MAX_SIZE:
+        return jsonify([UfysError(code="bad-request", message="too many requests in this batch")]), 400
+    for item in request.json:
+        log_request(item)
+    reqs = [util.dataclass_from_dict(UfysRequest, item) for item in request.json]
+    return Response(
+        stream_with_context(APP.json.dumps(item) + "\n" for item in WORKER.handle_batch(reqs)),
+        mimetype="application/x-ndjson"
+    )
+
+
+@APP.post("/jobs")
+def submit_job():
+    log_request({key: value for key, value in request.json.items() if key != "callback_url"})
+    req = util.dataclass_from_dict(UfysRequest, request.json)
+    try:
+        job = JOBS.submit(req, callback_url=request.json.get("callback_url"))
+    except UfysError as ex:
+        if ex.code == "bad-callback":
+            return jsonify([ex]), 400
+        return jsonify([ex]), 503, {"Retry-After": str(WORKER.config.RETRY_AFTER)}
+    return jsonify(job), 202, {"Location": f"/jobs/{job.id}"}
+
+
+@APP.get("/jobs/<id_>")
+def get_job(id_: str):
+    if (job := JOBS.get(id_)) is None:
+        return jsonify([UfysError(code="job-not-found", message="no job with this id")]), 404
+    return jsonify(job)
+
+
+@APP.get("/metrics")
+def get_metrics():
+    return Response(metrics.render(), mimetype=metrics.CONTENT_TYPE)
+
+
+@APP.get("/healthz")
+def get_health():
+    return jsonify(dict(status="ok"))
+
+
+@APP.get("/readyz")
+def get_readiness():
+    readiness = WORKER.readiness()
+    return jsonify(readiness), 200 if readiness["ready"] else 503
+
+
 @APP.errorhandler(AssertionError)
 def handle_assertionerror(ex):
     return jsonify(
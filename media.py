@@ -0,0 +1,110 @@
+import struct
+import typing
+
+
+class Box(typing.NamedTuple):
+    type: bytes
+    offset: int
+    size: int
+    header_size: int
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+
+def parse_box_header(data: bytes, offset: int = 0) -> Box | None:
+    # iso base media (mp4/mov) box: 32-bit size + fourcc, optionally followed by a 64-bit size
+    if len(data) < 8:
+        return None
+    size, type_ = struct.unpack(">I4s", data[:8])
+    header_size = 8
+    if size == 1:
+        if len(data) < 16:
+            return None
+        size, = struct.unpack(">Q", data[8:16])
+        header_size = 16
+    if size != 0 and size < header_size:
+        return None
+    if not type_.isascii():
+        return None
+    # size 0 means "until the end of the file"
+    return Box(type=type_, offset=offset, size=size, header_size=header_size)
+
+
+def iter_boxes(data: bytes) -> typing.Iterator[Box]:
+    offset = 0
+    while (box := parse_box_header(data[offset:offset + 16], offset)) is not None:
+        yield box
+        if box.size == 0:
+            return
+        offset = box.end
+
+
+def is_mp4(data: bytes) -> bool:
+    return (box := parse_box_header(data[:16])) is not None and box.type == b"ftyp"
+
+
+def gif_dimensions(data: bytes) -> tuple[int, int]:
+    # logical screen descriptor, right after the 6 byte signature
+    if data[:6] not in (b"GIF87a", b"GIF89a"):
+        raise ValueError("not a gif")
+    width, height = struct.unpack("<HH", data[6:10])
+    return width, height
+
+
+def is_faststart(data: bytes) -> bool:
+    # an mp4 with the moov atom ahead of the media data, players can start before it's fully downloaded
+    if not is_mp4(data):
+        return False
+    for box in iter_boxes(data):
+        if box.type == b"moov":
+            return True
+        if box.type == b"mdat":
+            return False
+    return False
+
+
+# what every browser plays inside an mp4, anything else has to be transcoded
+WEB_VIDEO_CODECS = ("h264",)
+WEB_PIXEL_FORMATS = ("yuv420p", "yuvj420p")
+WEB_AUDIO_CODECS = ("aac", "mp3")
+
+
+class Probe(typing.NamedTuple):
+    video_codec: str | None
+    pixel_format: str | None
+    width: int | None
+    height: int | None
+    # None -> no audio
+    audio_codec: str | None
+
+    @classmethod
+    def from_ffprobe(cls, result: dict) -> "Probe":
+        streams = result.get("streams", [])
+        video = next(
+            (
+                stream for stream in streams
+                # cover art is a video stream too
+                if stream.get("codec_type") == "video" and not stream.get("disposition", {}).get("attached_pic")
+            ),
+            None
+        )
+        if video is None:
+            raise ValueError("no video stream")
+        audio = next((stream for stream in streams if stream.get("codec_type") == "audio"), {})
+        return cls(
+            video_codec=video.get("codec_name"),
+            pixel_format=video.get("pix_fmt"),
+            width=video.get("width"),
+            height=video.get("height"),
+            audio_codec=audio.get("codec_name")
+        )
+
+    @property
+    def copy_video(self) -> bool:
+        return self.video_codec in WEB_VIDEO_CODECS and self.pixel_format in WEB_PIXEL_FORMATS
+
+    @property
+    def copy_audio(self) -> bool:
+        return self.audio_codec is None or self.audio_codec in WEB_AUDIO_CODECS
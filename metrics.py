@@ -0,0 +1,98 @@
+import functools
+import inspect
+import os
+
+import prometheus_client
+import prometheus_client.multiprocess
+from prometheus_client import Counter, Gauge, Histogram
+
+from model import UfysResponse
+
+# with several gunicorn workers (or the process execution backend), every process writes its metrics to
+# PROMETHEUS_MULTIPROC_DIR and /metrics aggregates them. without it, metrics are per process
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
+if directory := os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+    # gunicorn's on_starting creates (and empties) it, other entrypoints (uvicorn, tests) may get here first
+    os.makedirs(directory, exist_ok=True)
+
+# seconds, from cache hits to slow reuploads
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REQUESTS_IN_FLIGHT = Gauge(
+    "ufys_requests_in_flight", "requests currently being handled", multiprocess_mode="livesum"
+)
+RESPONSES = Counter(
+    "ufys_responses", "results returned, by kind (direct, reupload, error)", ["kind"]
+)
+HANDLER_DURATION = Histogram(
+    "ufys_handler_duration_seconds", "time spent in handlers, by outcome (ok or error code)",
+    ["handler", "outcome"], buckets=LATENCY_BUCKETS
+)
+STAGE_DURATION = Histogram(
+    "ufys_stage_duration_seconds", "time spent in pipeline stages", ["stage"], buckets=LATENCY_BUCKETS
+)
+CACHE_LOOKUPS = Counter(
+    "ufys_cache_lookups", "result cache lookups, by the tier that had it (none -> miss)", ["tier"]
+)
+REUPLOADS = Counter(
+    "ufys_reuploads", "videos reuploaded instead of linked, by the reason no format was linkable", ["reason"]
+)
+REFRESHES = Counter(
+    "ufys_refreshes", "background refreshes of hot cached direct links (refreshed, failed, deferred)", ["outcome"]
+)
+DOWNLOADED_BYTES = Counter("ufys_downloaded_bytes", "bytes fetched from upstream")
+UPLOADED_BYTES = Counter("ufys_uploaded_bytes", "bytes reuploaded to minio")
+HTTP_REQUESTS = Counter("ufys_http_requests", "upstream http requests, by client", ["client"])
+HTTP_CONNECTIONS = Counter(
+    "ufys_http_connections", "upstream connections opened, by client (fewer than requests -> reused)", ["client"]
+)
+EXECUTOR_QUEUED = Gauge(
+    "ufys_executor_queued", "handler runs waiting for a thread", multiprocess_mode="livesum"
+)
+EXECUTOR_RUNNING = Gauge(
+    "ufys_executor_running", "handler runs on a thread", multiprocess_mode="livesum"
+)
+EXECUTOR_WAIT = Histogram(
+    "ufys_executor_wait_seconds", "time handler runs spent queued", buckets=LATENCY_BUCKETS
+)
+EXECUTOR_SHED = Counter(
+    "ufys_executor_shed", "handler runs turned away, by reason (rejected, expired)", ["reason"]
+)
+
+
+def count_results(results: list):
+    for result in results:
+        if not isinstance(result, UfysResponse):
+            RESPONSES.labels("error").inc()
+        else:
+            RESPONSES.labels("reupload" if result.reuploaded else "direct").inc()
+
+
+def track_requests(func):
+    # in-flight count and result kinds of Worker.handle_request(_async)
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with REQUESTS_IN_FLIGHT.track_inprogress():
+                results = await func(*args, **kwargs)
+            count_results(results)
+            return results
+
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with REQUESTS_IN_FLIGHT.track_inprogress():
+            results = func(*args, **kwargs)
+        count_results(results)
+        return results
+
+    return wrapper
+
+
+def render() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return prometheus_client.generate_latest()
+    registry = prometheus_client.CollectorRegistry()
+    prometheus_client.multiprocess.MultiProcessCollector(registry)
+    return prometheus_client.generate_latest(registry)
@@ -1,17 +1,41 @@
 import hashlib
 import json
-from dataclasses import asdict, dataclass
+from dataclasses import asdict, dataclass, fields, is_dataclass
+
+import util
 
 
 @dataclass
 class UfysRequest:
     url: str
+    # optional budgets for the returned video: linked formats above them are skipped, videos we'd have to reupload
+    # fail with "budget-exceeded" (see budget.py)
+    max_filesize: int | None = None
+    max_height: int | None = None
+    # seconds
+    max_duration: float | None = None
+    # set by the worker: a form of url that is the same for all urls pointing to the same media.
+    # deliberately not a field, clients can't provide it
+    canonical_url = None
 
     @property
     def hash(self):
+        return self.hash_dict(self.fields_dict())
+
+    @property
+    def key(self):
+        # like hash, but stable across tracking params, mirrors, short links etc. once canonical_url is set
+        return self.hash_dict(self.fields_dict() | dict(url=self.canonical_url or self.url))
+
+    def fields_dict(self) -> dict:
+        # unset options are left out, so adding one doesn't change the hash of existing requests
+        return {key: value for key, value in asdict(self).items() if value is not None}
+
+    @staticmethod
+    def hash_dict(dict_: dict) -> str:
         return hashlib.sha1(
             json.dumps(
-                asdict(self),
+                dict_,
                 ensure_ascii=False
             ).encode("utf-8")
         ).hexdigest()
@@ -37,6 +61,49 @@ class UfysError(Exception):
     code: str
     message: str = ""
 
+    def __reduce__(self):
+        # Exception pickles its args, which are empty when constructed with keyword arguments
+        return self.__class__, (self.code, self.message)
+
+
+@dataclass
+class UfysJob:
+    id: str
+    # queued -> running -> done | failed
+    state: str = "queued"
+    # the pipeline stage a running job is currently in (extract, probe, download, upload, ...)
+    stage: str | None = None
+    results: list[UfysResponse | UfysError] | None = None
+
+
+@dataclass
+class UfysBatchItem:
+    # position of the request in the batch, items are returned in completion order
+    index: int
+    results: list[UfysResponse | UfysError]
+
 
 class MinioNotConnected(Exception):
     pass
+
+
+def serialize(o):
+    # like asdict, but tags every dataclass with its class name
+    if is_dataclass(o):
+        return {
+            field.name: serialize(getattr(o, field.name))
+            for field in fields(o)
+        } | dict(_class=o.__class__.__name__)
+    if isinstance(o, (list, tuple)):
+        return [serialize(c) for c in o]
+    if isinstance(o, dict):
+        return {key: serialize(value) for key, value in o.items()}
+    return o
+
+
+def result_from_dict(dict_: dict) -> UfysResponse | UfysError:
+    cls = {
+        UfysResponse.__name__: UfysResponse,
+        UfysError.__name__: UfysError,
+    }[dict_["_class"]]
+    return util.dataclass_from_dict(cls, dict_)
@@ -0,0 +1,99 @@
+import contextlib
+import threading
+import time
+import typing
+
+import telemetry
+
+T = typing.TypeVar("T")
+
+
+class _Entry(typing.Generic[T]):
+
+    def __init__(self, obj: T):
+        self.obj = obj
+        self.uses = 0
+
+
+class ObjectPool(typing.Generic[T]):
+    # bounded pool of reusable objects that aren't safe to share between threads.
+    # objects are replaced after max_uses checkouts, or when a caller raised while holding one
+    # (unless the exception is one of keep_on, i.e. expected and harmless to the object's state)
+
+    def __init__(
+        self,
+        factory: typing.Callable[[], T],
+        size: int,
+        max_uses: int | None = None,
+        keep_on: tuple[type[BaseException], ...] = ()
+    ):
+        self.factory = factory
+        self.size = size
+        self.max_uses = max_uses
+        self.keep_on = keep_on
+        self.idle: list[_Entry[T]] = []
+        self.created = 0
+        self.in_use = 0
+        self.waiting = 0
+        self.recycled = 0
+        self.checkouts = 0
+        self.wait_time = 0.
+        self.condition = threading.Condition()
+
+    def warm(self, count: int = 1):
+        for _ in range(min(count, self.size - self.created)):
+            entry = _Entry(self.factory())
+            with self.condition:
+                self.created += 1
+                self.idle.append(entry)
+                self.condition.notify()
+
+    @contextlib.contextmanager
+    def checkout(self, timeout: float | None = None) -> typing.Iterator[T]:
+        start = time.monotonic()
+        with self.condition:
+            self.waiting += 1
+            try:
+                if not self.condition.wait_for(lambda: self.idle or self.created < self.size, timeout):
+                    raise TimeoutError("timed out waiting for a pooled object")
+            finally:
+                self.waiting -= 1
+            # most recently used first, it's the warmest
+            entry = self.idle.pop() if self.idle else None
+            if entry is None:
+                self.created += 1
+            self.in_use += 1
+            self.checkouts += 1
+            self.wait_time += (waited := time.monotonic() - start)
+        telemetry.set_attributes(**{"pool.wait": waited, "pool.in_use": self.in_use})
+        keep = True
+        try:
+            if entry is None:
+                entry = _Entry(self.factory())
+            yield entry.obj
+        except BaseException as ex:
+            keep = isinstance(ex, self.keep_on)
+            raise
+        finally:
+            with self.condition:
+                self.in_use -= 1
+                if entry is not None:
+                    entry.uses += 1
+                if entry is None or not keep or (self.max_uses and entry.uses >= self.max_uses):
+                    self.created -= 1
+                    self.recycled += entry is not None
+                else:
+                    self.idle.append(entry)
+                self.condition.notify()
+
+    def stats(self) -> dict:
+        return dict(
+            size=self.size,
+            created=self.created,
+            in_use=self.in_use,
+            idle=len(self.idle),
+            waiting=self.waiting,
+            recycled=self.recycled,
+            checkouts=self.checkouts,
+            wait_time=self.wait_time,
+        )
@@ -0,0 +1,133 @@
+import collections
+import concurrent.futures
+import copy
+import dataclasses
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import metrics
+from model import UfysError, UfysRequest, UfysResponse
+
+if TYPE_CHECKING:
+    from worker import Worker
+
+
+@dataclasses.dataclass
+class RefreshEntry:
+    req: UfysRequest
+    key: str
+    # when the cached results expire (unix time)
+    expires: float
+    # monotonic times of the latest hits since the last refresh
+    hits: collections.deque[float]
+
+
+class Refresher:
+    # stale-while-revalidate for direct links: signed cdn urls expire, and the cache goes cold right when a video is
+    # popular. hot entries are extracted again in the background shortly before they expire, requests keep getting
+    # the cached results until the new ones are in. reuploads don't expire, so they're never tracked
+
+    def __init__(self, worker: "Worker"):
+        self.worker = worker
+        self.config = worker.config
+        self.entries: collections.OrderedDict[str, RefreshEntry] = collections.OrderedDict()
+        self.refreshing: set[str] = set()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max(1, self.config.REFRESH_CONCURRENCY), thread_name_prefix="refresh"
+        )
+        # started with the first tracked entry
+        self.thread: threading.Thread | None = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.config.REFRESH_AHEAD > 0 and self.config.REFRESH_CONCURRENCY > 0
+
+    @staticmethod
+    def refreshable(results: list[UfysResponse | UfysError]) -> bool:
+        return any(isinstance(result, UfysResponse) and not result.reuploaded for result in results)
+
+    def track(self, req: UfysRequest, key: str, results: list[UfysResponse | UfysError], expires: float | None):
+        if not self.enabled:
+            return
+        with self.lock:
+            if expires is None or not self.refreshable(results):
+                self.entries.pop(key, None)
+                return
+            if (entry := self.entries.get(key)) is None:
+                entry = self.entries[key] = RefreshEntry(
+                    req=copy.copy(req),
+                    key=key,
+                    expires=expires,
+                    hits=collections.deque(maxlen=self.config.REFRESH_MIN_HITS)
+                )
+            entry.expires = expires
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.config.CACHE_SIZE:
+                self.entries.popitem(last=False)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="refresher", daemon=True)
+                self.thread.start()
+
+    def hit(self, key: str):
+        with self.lock:
+            if (entry := self.entries.get(key)) is not None:
+                entry.hits.append(time.monotonic())
+                self.entries.move_to_end(key)
+
+    def hot(self, entry: RefreshEntry) -> bool:
+        # REFRESH_MIN_HITS hits within REFRESH_WINDOW seconds
+        return (
+            len(entry.hits) >= self.config.REFRESH_MIN_HITS
+            and entry.hits[0] >= time.monotonic() - self.config.REFRESH_WINDOW
+        )
+
+    def due(self) -> list[RefreshEntry]:
+        now = time.time()
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if entry.expires <= now]:
+                # expired without being refreshed, the next request extracts (and tracks) it again
+                del self.entries[key]
+            return sorted(
+                (
+                    entry for entry in self.entries.values()
+                    if entry.expires - now <= self.config.REFRESH_AHEAD
+                    and entry.key not in self.refreshing
+                    and self.hot(entry)
+                ),
+                key=lambda entry: entry.expires
+            )
+
+    def run(self):
+        while True:
+            time.sleep(self.config.REFRESH_INTERVAL)
+            self.schedule()
+
+    def schedule(self):
+        for entry in self.due():
+            # refreshes run handlers on the same executor as requests, they only get what requests leave over
+            if len(self.refreshing) >= self.config.REFRESH_CONCURRENCY or self.worker.executor.stats()["queued"]:
+                metrics.REFRESHES.labels("deferred").inc()
+                return
+            with self.lock:
+                self.refreshing.add(entry.key)
+                entry.hits.clear()
+            self.executor.submit(self.refresh, entry)
+
+    def refresh(self, entry: RefreshEntry):
+        try:
+            results = self.worker.run_handlers(copy.copy(entry.req))
+            if not any(isinstance(result, UfysResponse) for result in results):
+                # keep serving what we have until it expires
+                metrics.REFRESHES.labels("failed").inc()
+                return
+            self.track(entry.req, entry.key, results, self.worker.cache.set(entry.key, results))
+            metrics.REFRESHES.labels("refreshed").inc()
+        except Exception as ex:
+            print(f"warning: failed to refresh {entry.key} ({ex})")
+            metrics.REFRESHES.labels("failed").inc()
+        finally:
+            with self.lock:
+                self.refreshing.discard(entry.key)
+
@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import typing
+
+T = typing.TypeVar("T")
+
+
+class _Call:
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+# deduplicates concurrent calls with the same key:
+# the first caller runs the function, everyone else waits for and shares its result (or exception)
+class SingleFlight:
+
+    def __init__(self):
+        self.calls: dict[str, _Call] = {}
+        self.lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key: str, func: typing.Callable[[], T], timeout: float | None = None) -> T:
+        with self.lock:
+            call = self.calls.get(key)
+            if leader := call is None:
+                call = self.calls[key] = _Call()
+            else:
+                self.shared += 1
+        if not leader:
+            if not call.done.wait(timeout):
+                raise TimeoutError(f"timed out waiting for in-flight call {key}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func()
+        except BaseException as ex:
+            call.error = ex
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self) -> int:
+        return len(self.calls)
+
+
+class _AsyncCall:
+
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        # callers still awaiting the task, the leader included
+        self.waiters = 0
+
+
+# SingleFlight for coroutines, all callers are expected to run on the same event loop.
+# the function runs as a task of its own, so a caller going away (client disconnect, timeout) doesn't take it down
+# for the others. only once nobody is waiting anymore, it's cancelled
+class AsyncSingleFlight:
+
+    def __init__(self):
+        self.calls: dict[str, _AsyncCall] = {}
+        self.shared = 0
+
+    async def do(self, key: str, func: typing.Callable[[], typing.Awaitable[T]], timeout: float | None = None) -> T:
+        if leader := (call := self.calls.get(key)) is None:
+            call = self.calls[key] = _AsyncCall(asyncio.ensure_future(func()))
+            call.task.add_done_callback(lambda task: self.finished(key, call))
+        else:
+            self.shared += 1
+        call.waiters += 1
+        try:
+            # only waiters time out, like SingleFlight
+            return await asyncio.wait_for(asyncio.shield(call.task), None if leader else timeout)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+                # right away, the next caller has to start over instead of joining the cancelled task
+                self.finished(key, call)
+
+    def finished(self, key: str, call: _AsyncCall):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+        # mark a failure as retrieved, whoever still waits raises it anyway
+        if call.task.done() and not call.task.cancelled():
+            call.task.exception()
+
+    def in_flight(self) -> int:
+        return len(self.calls)
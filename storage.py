@@ -0,0 +1,88 @@
+import threading
+import time
+
+# noinspection PyPackageRequirements
+import minio
+import minio.error
+import urllib3
+from urllib3.exceptions import HTTPError
+
+from config import ConfigStore
+
+
+class MinioConnection:
+    # connects during the worker's warm-up instead of blocking startup, and doesn't give up for good when minio is
+    # unreachable: failed connects and failed requests are retried after MINIO_RETRY_INTERVAL, in the background
+
+    def __init__(self, config: ConfigStore):
+        self.config = config
+        self.client: minio.Minio | None = None
+        # why we aren't connected, None once we are
+        self.error: str | None = "not connected yet"
+        self.next_attempt = 0.
+        # held while connecting
+        self.lock = threading.Lock()
+
+    def get(self, wait: bool = False) -> minio.Minio | None:
+        # requests never wait for a connect (up to a connect timeout per retry), they go without minio until the
+        # background one is done. wait -> connect right here, for the warm-up
+        if (client := self.client) is not None:
+            return client
+        if time.monotonic() < self.next_attempt:
+            return None
+        if wait:
+            with self.lock:
+                if self.client is None and time.monotonic() >= self.next_attempt:
+                    self.connect()
+            return self.client
+        if self.lock.acquire(blocking=False):
+            threading.Thread(target=self.connect_in_background, name="minio-connect", daemon=True).start()
+        return None
+
+    def connect_in_background(self):
+        try:
+            if self.client is None:
+                self.connect()
+        finally:
+            self.lock.release()
+
+    def connect(self):
+        try:
+            client = minio.Minio(
+                endpoint=self.config.MINIO_ENDPOINT,
+                access_key=self.config.MINIO_ACCESS_KEY,
+                secret_key=self.config.MINIO_SECRET_KEY,
+                secure=self.config.MINIO_SECURE,
+                # minio's default waits minutes for a connection that will never come
+                http_client=urllib3.PoolManager(
+                    timeout=urllib3.Timeout(connect=self.config.HTTP_CONNECT_TIMEOUT or None, read=5 * 60),
+                    retries=urllib3.Retry(total=2, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+                )
+            )
+            if client.bucket_exists(self.config.MINIO_BUCKET):
+                self.client = client
+                self.error = None
+                print("minio connected")
+                return
+            error = f"bucket {self.config.MINIO_BUCKET} doesn't exist"
+        except TypeError:
+            error = "configuration error"
+        except (AttributeError, minio.error.S3Error):
+            error = "bucket error"
+        except HTTPError:
+            error = "timeout"
+        self.failed(error)
+
+    def failed(self, error: str):
+        # only warn about changes, a minio that stays down would flood the log otherwise
+        if error != self.error:
+            print(f"warning: minio not connected ({error})")
+        self.error = error
+        self.next_attempt = time.monotonic() + self.config.MINIO_RETRY_INTERVAL
+
+    def disconnect(self, error: str):
+        # a request failed to reach minio, don't send it any more until the next connect attempt succeeds.
+        # without the lock, requests mustn't wait for a connect in progress
+        if self.client is not None:
+            self.client = None
+            self.failed(error)
@@ -0,0 +1,89 @@
+import io
+import queue
+import threading
+import typing
+
+
+class LimitExceeded(Exception):
+    pass
+
+
+class PrefetchStream(io.RawIOBase):
+    # reads from the source on a background thread so producing (download, ffmpeg) overlaps with consuming (upload),
+    # while never holding more than buffer_size bytes in memory
+
+    def __init__(
+        self,
+        source: typing.BinaryIO,
+        chunk_size: int = 64 * 1024,
+        buffer_size: int = 8 * 1024 * 1024,
+        finish: typing.Callable[[], None] | None = None,
+        max_bytes: int | None = None
+    ):
+        super().__init__()
+        self.source = source
+        self.chunk_size = chunk_size
+        self.finish = finish
+        # the source is abandoned once it produced more than this, the reader gets LimitExceeded instead of the rest
+        self.max_bytes = max_bytes
+        self.queue: queue.Queue[bytes | BaseException | None] = queue.Queue(maxsize=max(1, buffer_size // chunk_size))
+        self.pending = b""
+        self.eof = False
+        self.stopped = threading.Event()
+        self.bytes_read = 0
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        total = 0
+        try:
+            while chunk := self.source.read(self.chunk_size):
+                total += len(chunk)
+                if self.max_bytes is not None and total > self.max_bytes:
+                    raise LimitExceeded(total)
+                if not self.put(chunk):
+                    return
+            if self.finish is not None:
+                self.finish()
+        except BaseException as ex:
+            self.put(ex)
+        self.put(None)
+
+    def put(self, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def readable(self):
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(self.chunk_size), b""))
+        while not self.pending:
+            if self.eof:
+                return b""
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+                return b""
+            if isinstance(item, BaseException):
+                self.eof = True
+                raise item
+            self.pending = item
+        data, self.pending = self.pending[:size], self.pending[size:]
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.stopped.set()
+        super().close()
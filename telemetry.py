@@ -1,13 +1,29 @@
+import collections
+import contextlib
+import contextvars
 import dataclasses
 import functools
+import inspect
 import os
+import random
+import threading
+import time
 import typing
 
 import opentelemetry.trace
-from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.sdk.resources import Resource
-from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace import ReadableSpan, SpanProcessor, TracerProvider
 from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.sampling import ParentBasedTraceIdRatio
+
+import metrics
+
+# span attributes per traced call, and the length strings are cut to
+ATTRIBUTE_LIMIT = int(os.environ.get("OTEL_ATTRIBUTE_LIMIT", 32))
+ATTRIBUTE_MAX_LENGTH = int(os.environ.get("OTEL_ATTRIBUTE_MAX_LENGTH", 256))
+
+# set by init(), until then (and without an endpoint) traced functions are called directly
+_enabled = False
 
 
 def get_endpoint():
@@ -17,63 +33,184 @@ def get_endpoint():
 
 
 def init(service_name: str):
+    global _enabled
     if (endpoint := get_endpoint()) is None:
         print("skipping trace initialization")
         return
+    # the exporter (protobuf and all) is only imported when it's actually used
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
     tracer = TracerProvider(
         resource=Resource(
             attributes={
                 "service.name": service_name
             }
-        )
+        ),
+        # head sampling: the fraction of requests that are traced at all
+        sampler=ParentBasedTraceIdRatio(float(os.environ.get("OTEL_SAMPLE_RATIO", 1.)))
     )
     opentelemetry.trace.set_tracer_provider(tracer)
-    tracer.add_span_processor(
-        BatchSpanProcessor(
-            OTLPSpanExporter(endpoint=endpoint)
-        )
+    processor = BatchSpanProcessor(
+        OTLPSpanExporter(endpoint=endpoint)
     )
+    if (tail_latency := os.environ.get("OTEL_TAIL_LATENCY")) is not None:
+        processor = TailSamplingProcessor(
+            processor,
+            min_duration=float(tail_latency),
+            ratio=float(os.environ.get("OTEL_TAIL_RATIO", 0.))
+        )
+    tracer.add_span_processor(processor)
+    _enabled = True
+
+
+class TailSamplingProcessor(SpanProcessor):
+    # tail sampling: holds back the spans of a trace until its local root span ends, then only exports
+    # traces that were slow, failed, or made the `ratio` cut
+
+    def __init__(self, next_: SpanProcessor, min_duration: float, ratio: float = 0., max_traces: int = 1024):
+        self.next = next_
+        self.min_duration = min_duration
+        self.ratio = ratio
+        self.max_traces = max_traces
+        self.traces: collections.OrderedDict[int, list[ReadableSpan]] = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def on_end(self, span: ReadableSpan):
+        with self.lock:
+            spans = self.traces.setdefault(span.context.trace_id, [])
+            spans.append(span)
+            if span.parent is not None and not span.parent.is_remote:
+                # spans that end after their root (e.g. discarded racing handlers) are never exported
+                while len(self.traces) > self.max_traces:
+                    self.traces.popitem(last=False)
+                return
+            del self.traces[span.context.trace_id]
+        if self.keep(span, spans):
+            for span_ in spans:
+                self.next.on_end(span_)
+
+    def keep(self, root: ReadableSpan, spans: list[ReadableSpan]) -> bool:
+        if (root.end_time - root.start_time) / 1e9 >= self.min_duration:
+            return True
+        if any(not span_.status.is_ok for span_ in spans):
+            return True
+        return random.random() < self.ratio
+
+    def shutdown(self):
+        self.next.shutdown()
+
+    def force_flush(self, timeout_millis: int = 30000) -> bool:
+        return self.next.force_flush(timeout_millis)
+
 
+def set_attributes(**attributes):
+    if _enabled:
+        opentelemetry.trace.get_current_span().set_attributes(attributes)
 
-def prefix_dict(prefix: str, dict_: dict[str, typing.Any]) -> dict[str, typing.Any]:
-    return {
-        f"{prefix}.{key}": value
-        for key, value
-        in dict_.items()
-    }
 
+_stage_listeners: contextvars.ContextVar[tuple[typing.Callable[[str], None], ...]] = contextvars.ContextVar(
+    "stage_listeners", default=()
+)
 
-def flatten_attributes(attributes: dict) -> dict[str, typing.Any]:
+
+@contextlib.contextmanager
+def stage(name: str):
+    # marks a pipeline stage (extract, probe, download, transcode, upload, ...) of the current request
+    for listener in _stage_listeners.get():
+        listener(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.STAGE_DURATION.labels(name).observe(time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def listen_stages(listener: typing.Callable[[str], None]):
+    token = _stage_listeners.set(_stage_listeners.get() + (listener,))
+    try:
+        yield
+    finally:
+        _stage_listeners.reset(token)
+
+
+def flatten_attributes(
+        attributes: dict,
+        allow: tuple[str, ...] | None = None,
+        limit: int = ATTRIBUTE_LIMIT
+) -> dict[str, typing.Any]:
+    # nested dataclasses, dicts and lists become dotted keys, e.g. req.url or info.formats.0.url.
+    # `allow` restricts the result to these keys (and everything below them)
     results = {}
-    # importing here to prevent circular dependency
-    from worker import Worker
+
+    def visit(key: str, value):
+        if len(results) >= limit:
+            return
+        if allow is not None and not any(
+            key == allowed or key.startswith(allowed + ".") or allowed.startswith(key + ".")
+            for allowed in allow
+        ):
+            return
+        if isinstance(value, (bool, int, float)):
+            results[key] = value
+        elif isinstance(value, str):
+            results[key] = value[:ATTRIBUTE_MAX_LENGTH]
+        elif dataclasses.is_dataclass(value) and not isinstance(value, type):
+            for field in dataclasses.fields(value):
+                visit(f"{key}.{field.name}", getattr(value, field.name))
+        elif isinstance(value, dict):
+            for child_key, child in value.items():
+                visit(f"{key}.{child_key}", child)
+        elif isinstance(value, (list, tuple)):
+            for index, child in enumerate(value):
+                visit(f"{key}.{index}", child)
+
     for key, value in attributes.items():
-        if isinstance(value, Worker):
-            continue
-        if dataclasses.is_dataclass(value):
-            results.update(prefix_dict(key, flatten_attributes(dataclasses.asdict(value))))
-            continue
-        if isinstance(value, dict):
-            results.update(prefix_dict(key, flatten_attributes(value)))
-            continue
-        if isinstance(value, list):
-            results.update(prefix_dict(key, flatten_attributes(dict(enumerate(value)))))
-            continue
+        visit(str(key), value)
     return results
 
 
-def trace_function(func):
+def trace_function(func=None, *, attributes: tuple[str, ...] | None = None):
+    # use as @trace_function, or as @trace_function(attributes=("req.url", ...)) to only record some arguments
+    if func is None:
+        return functools.partial(trace_function, attributes=attributes)
+    # bound methods don't list self, unbound ones do but it's never recorded
+    arg_names = [
+        parameter.name
+        for parameter in inspect.signature(func).parameters.values()
+        if parameter.kind in (inspect.Parameter.POSITIONAL_ONLY, inspect.Parameter.POSITIONAL_OR_KEYWORD)
+    ]
+    if arg_names[:1] == ["self"]:
+        arg_names[0] = None
+
+    @contextlib.contextmanager
+    def traced(args, kwargs):
+        with opentelemetry.trace.get_tracer(__name__).start_as_current_span(func.__name__) as span:
+            # sampled out spans don't record anything, so don't bother flattening
+            if span.is_recording():
+                arg_attrs = {
+                    key: value
+                    for key, value
+                    in zip(arg_names, args)
+                    if key is not None
+                }
+                span.set_attributes(flatten_attributes(arg_attrs | kwargs, allow=attributes))
+            yield
+
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not _enabled:
+                return await func(*args, **kwargs)
+            with traced(args, kwargs):
+                return await func(*args, **kwargs)
+
+        return async_wrapper
+
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        arg_attrs = {
-            key: value
-            for key, value
-            in zip(func.__code__.co_varnames, args)
-        }
-        with opentelemetry.trace.get_tracer(__name__).start_as_current_span(
-            func.__name__,
-            attributes=flatten_attributes(arg_attrs | kwargs)
-        ):
+        if not _enabled:
+            return func(*args, **kwargs)
+        with traced(args, kwargs):
             return func(*args, **kwargs)
 
     return wrapper
@@ -0,0 +1,350 @@
+"""
+offline benchmark: runs the worker against local stand-ins for every upstream and prints json results, e.g.
+
+    python test/benchmark.py --requests 200 --concurrency 16 --output before.json
+
+everything runs in this process: a fake http server (videos, oembed, cobalt, asciinema, AAAS),
+an S3 server (moto) in place of minio and a stubbed yt-dlp extractor. needs ffmpeg and ffprobe.
+"""
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests.adapters
+from minio import Minio
+from moto.server import ThreadedMotoServer
+from yt_dlp import YoutubeDL
+from yt_dlp.extractor.common import InfoExtractor
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import worker  # noqa: E402
+from handlers.ytdl import YTDLRequestHandler  # noqa: E402
+from model import UfysRequest, UfysResponse  # noqa: E402
+from stats import percentile  # noqa: E402
+
+VIDEO_SIZE = (640, 360)
+SCENARIOS = ["direct", "probe", "reupload", "instagram", "asciinema", "cached"]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_media(directory: pathlib.Path) -> dict[str, bytes]:
+    video = directory / "video.mp4"
+    gif = directory / "render.gif"
+    subprocess.run([
+        "ffmpeg", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc=size={VIDEO_SIZE[0]}x{VIDEO_SIZE[1]}:rate=30",
+        "-f", "lavfi", "-i", "sine",
+        "-t", "10", "-c:v", "libx264", "-c:a", "aac", "-pix_fmt", "yuv420p", str(video)
+    ], check=True)
+    subprocess.run([
+        "ffmpeg", "-loglevel", "error", "-y", "-f", "lavfi", "-i", "testsrc=size=321x241:rate=10", "-t", "3", str(gif)
+    ], check=True)
+    return {"/media/video.mp4": video.read_bytes(), "/media/render.gif": gif.read_bytes()}
+
+
+class FakeUpstream(BaseHTTPRequestHandler):
+    # one server for all upstreams, told apart by path
+    media: dict[str, bytes] = {}
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format_, *args):
+        pass
+
+    def send_body(self, body: bytes, content_type: str, status: int = 200, headers: dict[str, str] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, o):
+        self.send_body(json.dumps(o).encode(), "application/json")
+
+    def do_GET(self):
+        path = urllib.parse.urlsplit(self.path).path
+        if (data := self.media.get(path)) is not None:
+            if match := re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", "")):
+                start = int(match.group(1))
+                end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+                return self.send_body(
+                    data[start:end + 1], "video/mp4", 206, {"Content-Range": f"bytes {start}-{end}/{len(data)}"}
+                )
+            return self.send_body(data, "video/mp4", headers={"Accept-Ranges": "bytes"})
+        if path == "/api/v1/oembed/":
+            return self.send_json(dict(title="benchmark post", author_name="bench"))
+        if re.match(r"^/a/\d+\.cast$", path):
+            # every cast is different, so each one is rendered
+            cast = f'{{"version": 2, "width": 80, "height": 24}}\n[0.1, "o", "hello from {path}"]\n'
+            return self.send_body(cast.encode(), "text/plain")
+        if re.match(r"^/a/\d+$", path):
+            return self.send_body(
+                b'<html><head><meta property="og:title" content="benchmark cast"></head>'
+                b'<body><span class="author-avatar"><a href="/~bench">bench</a></span></body></html>',
+                "text/html"
+            )
+        if path == "/~bench":
+            return self.send_body(b"<html><body><h1>bench <small>user</small></h1></body></html>", "text/html")
+        self.send_body(b"not found", "text/plain", 404)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = urllib.parse.urlsplit(self.path).path
+        if path == "/api/json":
+            return self.send_json(dict(url=f"http://{self.headers['Host']}/media/video.mp4"))
+        if path == "/render":
+            return self.send_body(self.media["/media/render.gif"], "image/gif")
+        self.send_body(b"not found", "text/plain", 404)
+
+
+class LocalAdapter(requests.adapters.HTTPAdapter):
+    # sends every request to the fake upstream, whatever host it was meant for
+
+    def __init__(self, netloc: str):
+        super().__init__()
+        self.netloc = netloc
+
+    def send(self, request, **kwargs):
+        parsed = urllib.parse.urlsplit(request.url)
+        request.url = urllib.parse.urlunsplit(("http", self.netloc, parsed.path, parsed.query, ""))
+        return super().send(request, **kwargs)
+
+
+class BenchIE(InfoExtractor):
+    # /watch/<kind>-<n>: direct -> linkable h264, probe -> no dimensions, reupload -> codec that isn't linked
+    IE_NAME = "bench"
+    _VALID_URL = r"(?P<base>http://127\.0\.0\.1:\d+)/watch/(?P<id>(?P<kind>[a-z]+)-\d+)"
+
+    def _real_extract(self, url):
+        base, id_, kind = self._match_valid_url(url).group("base", "id", "kind")
+        fmt = dict(format_id="mp4", url=f"{base}/media/video.mp4", ext="mp4", vcodec="h264", acodec="aac")
+        if kind != "probe":
+            fmt |= dict(width=VIDEO_SIZE[0], height=VIDEO_SIZE[1])
+        if kind == "reupload":
+            fmt["vcodec"] = "hev1.1.6.L93.B0"
+        return dict(id=id_, title=f"benchmark {id_}", uploader="bench", formats=[fmt])
+
+
+class BenchYTDLRequestHandler(YTDLRequestHandler):
+
+    @staticmethod
+    def make_ytdl(opts: dict) -> YoutubeDL:
+        ytdl = YTDLRequestHandler.make_ytdl(opts | dict(quiet=True))
+        # ahead of the generic extractor, which matches everything
+        ytdl._ies = {BenchIE.ie_key(): BenchIE} | ytdl._ies
+        ytdl._ies_instances[BenchIE.ie_key()] = BenchIE(ytdl)
+        return ytdl
+
+
+class Sampler:
+    # peak rss of this process and peak size of the temp directory while a scenario runs
+
+    def __init__(self, tmp: pathlib.Path, interval: float = 0.05):
+        self.tmp = tmp
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_tmp_bytes = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def sample(self):
+        with open("/proc/self/statm") as file:
+            self.peak_rss = max(self.peak_rss, int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+        size = sum(path.stat().st_size for path in self.tmp.rglob("*") if path.is_file())
+        self.peak_tmp_bytes = max(self.peak_tmp_bytes, size)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except FileNotFoundError:
+                # temp files come and go
+                pass
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self.stopped.set()
+        self.thread.join()
+        # short runs might not have been sampled at all
+        self.sample()
+
+
+class Benchmark:
+
+    def __init__(self, tmp: pathlib.Path, target: str):
+        (tmp / "media").mkdir()
+        FakeUpstream.media = make_media(tmp / "media")
+        # handlers' temp files end up here, see main()
+        self.tmp = tmp / "work"
+        self.tmp.mkdir()
+        self.upstream = ThreadingHTTPServer(("127.0.0.1", 0), FakeUpstream)
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.upstream.server_port}"
+
+        s3_port = free_port()
+        self.s3 = ThreadedMotoServer(ip_address="127.0.0.1", port=s3_port, verbose=False)
+        self.s3.start()
+        self.minio = Minio(f"127.0.0.1:{s3_port}", "test", "test", secure=False)
+        self.minio.make_bucket("bench")
+        self.worker = worker.Worker(worker.ConfigStore(
+            MINIO_ENDPOINT=f"127.0.0.1:{s3_port}",
+            MINIO_ACCESS_KEY="test",
+            MINIO_SECRET_KEY="test",
+            MINIO_BUCKET="bench",
+            MINIO_SECURE=False,
+            AAAS_ENDPOINT=f"{self.base}/render",
+            # real extractors go to the internet, only fall back to them when the stand-ins failed
+            DISPATCH_HEDGE_DELAY=3600
+        ))
+        self.worker.handlers[-1] = BenchYTDLRequestHandler(self.worker)
+        for handler in self.worker.handlers:
+            handler.session.mount("https://", LocalAdapter(f"127.0.0.1:{self.upstream.server_port}"))
+        self.call = self.call_worker
+        if target == "flask":
+            import main
+            main.WORKER = self.worker
+            self.app = main.APP
+            self.call = self.call_flask
+
+    # both return the error codes of failed requests, None on success
+
+    def call_worker(self, url: str) -> list[str] | None:
+        results = self.worker.handle_request(UfysRequest(url=url))
+        if any(isinstance(result, UfysResponse) for result in results):
+            return None
+        return [result.code for result in results]
+
+    def call_flask(self, url: str) -> list[str] | None:
+        r = self.app.test_client().post("/video", json=dict(url=url))
+        if r.status_code == 200:
+            return None
+        return [result.get("code") for result in r.json]
+
+    def url(self, scenario: str, index: int) -> str:
+        if scenario == "instagram":
+            return f"https://www.instagram.com/p/bench{index}/"
+        if scenario == "asciinema":
+            return f"https://asciinema.org/a/{index}"
+        if scenario == "cached":
+            return f"{self.base}/watch/direct-0"
+        return f"{self.base}/watch/{scenario}-{index}"
+
+    def bucket_bytes(self) -> int:
+        return sum(obj.size or 0 for obj in self.minio.list_objects("bench", recursive=True))
+
+    def timed_call(self, url: str) -> tuple[float, list[str] | None]:
+        start = time.perf_counter()
+        try:
+            errors = self.call(url)
+        except Exception as ex:
+            errors = [ex.__class__.__name__]
+        return time.perf_counter() - start, errors
+
+    def run(self, scenario: str, count: int, concurrency: int) -> dict:
+        # unique urls (and therefore cache keys) per run, except for the cache scenario
+        offset = time.time_ns()
+        # failures of one scenario shouldn't trip the breakers for the next one
+        self.worker.breakers.clear()
+        # not measured: first use of a code path, and what the cache scenario hits
+        self.timed_call(self.url(scenario, offset + count))
+        bucket_before = self.bucket_bytes()
+        with Sampler(self.tmp) as sampler, concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            start = time.perf_counter()
+            results = list(executor.map(self.timed_call, (self.url(scenario, offset + i) for i in range(count))))
+            duration = time.perf_counter() - start
+        latencies = [latency for latency, _ in results]
+        return dict(
+            requests=count,
+            concurrency=concurrency,
+            errors=sum(errors is not None for _, errors in results),
+            error_codes=collections.Counter(code for _, errors in results for code in errors or ()),
+            duration=duration,
+            throughput=count / duration,
+            latency=dict(
+                p50=percentile(latencies, 50),
+                p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99),
+                max=max(latencies)
+            ),
+            peak_rss=sampler.peak_rss,
+            peak_tmp_bytes=sampler.peak_tmp_bytes,
+            uploaded_bytes=self.bucket_bytes() - bucket_before
+        )
+
+    def close(self):
+        self.upstream.shutdown()
+        self.s3.stop()
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=pathlib.Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated, default: all")
+    parser.add_argument("--requests", type=int, default=50, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--target", choices=["worker", "flask"], default="worker")
+    parser.add_argument("--output", type=pathlib.Path, help="write results here instead of stdout")
+    args = parser.parse_args()
+    # the S3 stand-in logs every request
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    # the worker prints warnings, keep stdout for the results
+    with tempfile.TemporaryDirectory() as _tmp, contextlib.redirect_stdout(sys.stderr):
+        tmp = pathlib.Path(_tmp)
+        benchmark = Benchmark(tmp, args.target)
+        # so the sampler sees the handlers' temp files
+        tempfile.tempdir = str(benchmark.tmp)
+        try:
+            results = dict(
+                commit=git_commit(),
+                target=args.target,
+                scenarios={
+                    scenario: benchmark.run(scenario, args.requests, args.concurrency)
+                    for scenario in args.scenarios.split(",")
+                }
+            )
+        finally:
+            benchmark.close()
+            tempfile.tempdir = None
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
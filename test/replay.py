@@ -0,0 +1,195 @@
+"""
+replays logged requests (see REQUEST_LOG) and reports latency per site and cache effectiveness, e.g.
+
+    python test/replay.py requests.log --target http://localhost:5004 --speed 10
+
+every line is {"time": <unix time>, "request": <UfysRequest body>}, or just a request body (no timing).
+--target is a running instance, or "worker" for an in-process worker configured from the environment.
+timing: "original" keeps the gaps between requests (divided by --speed),
+"closed" sends the next request as soon as one of --concurrency finishes.
+"""
+import argparse
+import collections
+import concurrent.futures
+import contextlib
+import json
+import pathlib
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+import requests
+import requests.adapters
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import util  # noqa: E402
+import worker  # noqa: E402
+from model import UfysRequest, UfysResponse  # noqa: E402
+from stats import percentile  # noqa: E402
+
+
+def load(path: pathlib.Path) -> list[tuple[float | None, dict]]:
+    entries = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "request" in entry:
+                entries.append((entry.get("time"), entry["request"]))
+            else:
+                entries.append((None, entry))
+    return entries
+
+
+def site(body: dict) -> str:
+    return (urllib.parse.urlsplit(body.get("url", "")).hostname or "unknown").removeprefix("www.")
+
+
+class WorkerTarget:
+
+    def __init__(self):
+        self.worker = worker.Worker(worker.ConfigStore.from_env())
+
+    def call(self, body: dict) -> bool:
+        results = self.worker.handle_request(util.dataclass_from_dict(UfysRequest, body))
+        return any(isinstance(result, UfysResponse) for result in results)
+
+    def cache_lookups(self) -> dict[str, int]:
+        stats = self.worker.cache.stats()
+        return stats["hits"] | dict(none=stats["misses"])
+
+
+class HttpTarget:
+    LOOKUPS = re.compile(r'^ufys_cache_lookups_total\{tier="([^"]+)"} ([0-9.e+]+)$', re.MULTILINE)
+
+    def __init__(self, base: str, pool_size: int):
+        self.base = base.rstrip("/")
+        self.session = requests.Session()
+        self.session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+        self.session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=pool_size))
+
+    def call(self, body: dict) -> bool:
+        return self.session.post(f"{self.base}/video", json=body).status_code == 200
+
+    def cache_lookups(self) -> dict[str, int]:
+        # as seen by the server, summed over all its workers
+        try:
+            r = self.session.get(f"{self.base}/metrics")
+            r.raise_for_status()
+        except requests.RequestException:
+            return {}
+        return {tier: int(float(count)) for tier, count in self.LOOKUPS.findall(r.text)}
+
+
+class Replay:
+
+    def __init__(self, target, entries: list[tuple[float | None, dict]]):
+        self.target = target
+        self.entries = entries
+        self.results: list[tuple[str, float, bool]] = []
+        self.lock = threading.Lock()
+        # how far behind schedule requests were sent, the client was too slow if this grows
+        self.max_lag = 0.
+
+    def call(self, body: dict):
+        start = time.perf_counter()
+        try:
+            ok = self.target.call(body)
+        except Exception:
+            ok = False
+        with self.lock:
+            self.results.append((site(body), time.perf_counter() - start, ok))
+
+    def run_closed(self, concurrency: int):
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(self.call, (body for _, body in self.entries)))
+
+    def run_original(self, speed: float, max_in_flight: int):
+        first = next((time_ for time_, _ in self.entries if time_ is not None), 0)
+        start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_in_flight) as executor:
+            for time_, body in self.entries:
+                if time_ is not None:
+                    due = start + (time_ - first) / speed
+                    if (wait := due - time.monotonic()) > 0:
+                        time.sleep(wait)
+                    self.max_lag = max(self.max_lag, time.monotonic() - due)
+                executor.submit(self.call, body)
+
+    def report(self, duration: float, lookups_before: dict[str, int], lookups_after: dict[str, int]) -> dict:
+        lookups = {tier: lookups_after[tier] - lookups_before.get(tier, 0) for tier in lookups_after}
+        hits = sum(count for tier, count in lookups.items() if tier != "none")
+        keys = [UfysRequest.hash_dict(body) for _, body in self.entries]
+        by_site = collections.defaultdict(list)
+        for site_, latency, ok in self.results:
+            by_site[site_].append((latency, ok))
+        return dict(
+            requests=len(self.results),
+            errors=sum(not ok for _, _, ok in self.results),
+            duration=duration,
+            throughput=len(self.results) / duration,
+            max_lag=self.max_lag,
+            cache=dict(
+                lookups=lookups,
+                hit_ratio=hits / total if (total := sum(lookups.values())) else None,
+                # the best any cache could do: requests that are exact repeats of an earlier one
+                repeat_ratio=1 - len(set(keys)) / len(keys) if keys else None
+            ),
+            sites={
+                site_: dict(
+                    requests=len(results),
+                    errors=sum(not ok for _, ok in results),
+                    p50=percentile([latency for latency, _ in results], 50),
+                    p95=percentile([latency for latency, _ in results], 95),
+                    p99=percentile([latency for latency, _ in results], 99),
+                    max=max(latency for latency, _ in results)
+                )
+                for site_, results in sorted(by_site.items(), key=lambda item: -len(item[1]))
+            }
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("log", type=pathlib.Path)
+    parser.add_argument("--target", default="worker", help='base url of a running instance, or "worker"')
+    parser.add_argument("--timing", choices=["original", "closed"], default="original")
+    parser.add_argument("--speed", type=float, default=1., help="speedup for original timing")
+    parser.add_argument("--concurrency", type=int, default=8, help="requests in flight for closed timing")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="upper bound for original timing")
+    parser.add_argument("--limit", type=int, help="only replay the first n requests")
+    parser.add_argument("--output", type=pathlib.Path, help="write results here instead of stdout")
+    args = parser.parse_args()
+
+    entries = load(args.log)[:args.limit]
+    # the worker prints warnings, keep stdout for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        target = (
+            WorkerTarget() if args.target == "worker"
+            else HttpTarget(args.target, max(args.concurrency, args.max_in_flight))
+        )
+        replay = Replay(target, entries)
+        lookups_before = target.cache_lookups()
+        start = time.perf_counter()
+        if args.timing == "closed":
+            replay.run_closed(args.concurrency)
+        else:
+            replay.run_original(args.speed, args.max_in_flight)
+    results = dict(
+        timing=args.timing,
+        speed=args.speed if args.timing == "original" else None,
+        **replay.report(time.perf_counter() - start, lookups_before, target.cache_lookups())
+    )
+    output = json.dumps(results, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        args.output.write_text(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
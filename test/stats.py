@@ -0,0 +1,6 @@
+# helpers shared by benchmark.py and replay.py, kept free of their (heavy) dependencies
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))]
@@ -0,0 +1,112 @@
+import unittest
+from unittest import mock
+
+import worker
+from handlers.asciinema import AsciinemaRequestHandler, PageParser
+from model import UfysRequest, UfysResponse
+
+CAST_PAGE = (
+    b'<html><head><meta property="og:title" content="a cast \xe2\x9c\xa8"></head><body>'
+    b'<span class="author-avatar"><a href="/~someone"><img src="avatar.png"></a></span>'
+    + b"<p>filler</p>" * 10000 +
+    b'</body></html>'
+)
+USER_PAGE = b"<html><body><h1>\n  <img src=\"avatar.png\"> someone <small>joined 2020</small></h1></body></html>"
+
+
+class FakeResponse:
+
+    def __init__(self, content: bytes):
+        self.content = content
+        self.chunks_read = 0
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size: int):
+        for offset in range(0, len(self.content), chunk_size):
+            self.chunks_read += 1
+            yield self.content[offset:offset + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        pass
+
+
+class TestPageParser(unittest.TestCase):
+
+    def parse(self, page: bytes, *wanted: str, chunk_size: int = 7) -> dict[str, str]:
+        parser = PageParser(*wanted)
+        for offset in range(0, len(page), chunk_size):
+            parser.feed_bytes(page[offset:offset + chunk_size])
+            if parser.done:
+                break
+        return parser.values
+
+    def test_cast_page(self):
+        self.assertEqual(
+            dict(title="a cast ✨", user_href="/~someone"),
+            self.parse(CAST_PAGE, "title", "user_href")
+        )
+
+    def test_heading(self):
+        # only the heading's own text, nested tags are skipped
+        self.assertEqual(dict(heading="someone"), self.parse(USER_PAGE, "heading"))
+
+
+class TestAsciinemaHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.Worker(worker.ConfigStore(AAAS_ENDPOINT="https://aaas/render"))
+        self.handler, = (handler for handler in self.worker.handlers if isinstance(handler, AsciinemaRequestHandler))
+        self.pages = {
+            "https://asciinema.org/a/123.cast?dl=1": FakeResponse(b'{"version": 2}\n'),
+            "https://asciinema.org/a/123": FakeResponse(CAST_PAGE),
+            "https://asciinema.org/~someone": FakeResponse(USER_PAGE),
+        }
+        self.rendered = []
+        patcher = mock.patch.multiple(self.handler.session, get=self.get, request=self.request)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, url: str, **_) -> FakeResponse:
+        return self.pages[url]
+
+    def request(self, method: str, url: str, data: bytes | None = None, **_) -> FakeResponse:
+        if method == "POST":
+            self.rendered.append(data)
+        return self.pages[url]
+
+    def test_unchanged_cast(self):
+        existing = UfysResponse(
+            title="old title", creator="someone", site="asciinema", video_url="https://minio/render.mp4",
+            width=640, height=480, reuploaded=True
+        )
+        index_key = self.handler.render_index_key(b'{"version": 2}\n')
+        with mock.patch.object(self.worker, "find_upload", {index_key: existing}.get):
+            response = self.handler.handle_request(UfysRequest(url="https://asciinema.org/a/123"))
+        self.assertEqual([], self.rendered)
+        self.assertEqual(("a cast ✨", "https://minio/render.mp4"), (response.title, response.video_url))
+        # the cast page was only read until the author link
+        self.assertEqual(1, self.pages["https://asciinema.org/a/123"].chunks_read)
+
+    def test_reuploaded_request(self):
+        req = UfysRequest(url="https://asciinema.org/a/123")
+        existing = UfysResponse(
+            title="a cast", creator=None, site="asciinema", video_url="https://minio/render.mp4", width=640, height=480,
+            reuploaded=True
+        )
+        self.pages.clear()
+        with mock.patch.object(self.worker, "find_upload", {self.worker.hash_index_key(req.key): existing}.get):
+            self.assertEqual(existing, self.handler.handle_request(req))
+
+    def test_metadata_cache(self):
+        self.assertEqual("someone", self.handler.scrape_metadata("123").creator)
+        self.pages.clear()
+        self.assertEqual("someone", self.handler.submit_scrape("123").result().creator)
+
+    def test_render_timeout(self):
+        # renders may take as long as the handler's deadline, not just HTTP_READ_TIMEOUT
+        self.assertEqual((10., 120.), self.handler.render_timeout())
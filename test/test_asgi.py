@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+import httpx
+
+import asgi
+from model import UfysError, UfysResponse
+
+
+class TestAsgi(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.client = httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi.APP), base_url="http://ufys")
+        self.addAsyncCleanup(self.client.aclose)
+
+    async def post(self, results):
+        async def handle_request_async(req):
+            return results(req)
+
+        with mock.patch.object(asgi.WORKER, "handle_request_async", handle_request_async):
+            return await self.client.post("/video", json=dict(url="https://example.com"))
+
+    async def test_success(self):
+        r = await self.post(
+            lambda req: [UfysResponse(title=None, creator=None, site=None, video_url=req.url, width=1, height=1)]
+        )
+        self.assertEqual(200, r.status_code)
+        self.assertEqual("https://example.com", r.json()[0]["video_url"])
+        self.assertEqual("UfysResponse", r.json()[0]["_class"])
+
+    async def test_error(self):
+        r = await self.post(lambda req: [UfysError(code="download-error")])
+        self.assertEqual(500, r.status_code)
+        self.assertEqual("download-error", r.json()[0]["code"])
+
+    async def test_overloaded(self):
+        r = await self.post(lambda req: [UfysError(code="overloaded")])
+        self.assertEqual(503, r.status_code)
+        self.assertIn("retry-after", r.headers)
+
+    async def test_unknown_route(self):
+        self.assertEqual(404, (await self.client.post("/nope")).status_code)
+        self.assertEqual(405, (await self.client.get("/video")).status_code)
@@ -0,0 +1,68 @@
+import time
+import unittest
+
+import requests
+
+import worker
+from breaker import CircuitBreaker
+from handlers.base import RequestHandler
+from model import UfysError, UfysRequest
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+
+    def test_opens_after_threshold(self):
+        self.breaker.record(False)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual("open", self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets(self):
+        self.breaker.record(False)
+        self.breaker.record(True)
+        self.breaker.record(False)
+        self.assertEqual("closed", self.breaker.state)
+
+    def test_half_open_single_trial(self):
+        self.breaker.record(False)
+        self.breaker.record(False)
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record(False)
+        self.assertEqual("open", self.breaker.state)
+        time.sleep(0.06)
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True)
+        self.assertEqual("closed", self.breaker.state)
+
+
+class FailingHandler(RequestHandler):
+
+    def __init__(self, worker_, error: Exception):
+        super().__init__(worker_)
+        self.error = error
+
+    def handle_request(self, req: UfysRequest):
+        raise self.error
+
+
+class TestWorkerBreaker(unittest.TestCase):
+
+    def codes(self, error: Exception) -> list[str]:
+        worker_ = worker.Worker(worker.ConfigStore(BREAKER_THRESHOLD=2))
+        handler = FailingHandler(worker_, error)
+        return [worker_.execute_handler(handler, UfysRequest(url="https://example.com")).code for _ in range(3)]
+
+    def test_broken_video(self):
+        # a dead link says nothing about the site
+        self.assertEqual(["download-error"] * 3, self.codes(UfysError("download-error")))
+
+    def test_unreachable_upstream(self):
+        self.assertEqual(
+            ["upstream-error", "upstream-error", "circuit-open"], self.codes(requests.ConnectionError("refused"))
+        )
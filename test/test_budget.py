@@ -0,0 +1,76 @@
+import http.server
+import threading
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import worker
+from budget import Budget
+from handlers.ytdl import YTDLRequestHandler
+from model import UfysError, UfysRequest
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    # chunked, no Content-Length to go by
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for _ in range(100):
+            self.wfile.write(b"2000\r\n" + b"\0" * 0x2000 + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, *_):
+        pass
+
+
+class TestBudget(unittest.TestCase):
+
+    def test_global_limits(self):
+        config = worker.ConfigStore(MAX_FILESIZE="1000", MAX_DURATION="600")
+        req = UfysRequest(url="https://example.com/video", max_filesize=2000, max_height=720)
+        self.assertEqual(Budget(filesize=2000, height=720), Budget.of(req))
+        self.assertEqual(Budget(filesize=1000, duration=600, height=720), Budget.of(req, config))
+
+    def test_check(self):
+        budget = Budget(filesize=1000, duration=60)
+        budget.check(filesize=None, duration=60, height=4320)
+        with self.assertRaises(UfysError) as ctx:
+            budget.check(filesize=1001)
+        self.assertEqual("budget-exceeded", ctx.exception.code)
+
+    def test_download_limit(self):
+        hook = YTDLRequestHandler.download_limit(1000)
+        hook(dict(filename="video", downloaded_bytes=600))
+        hook(dict(filename="video", downloaded_bytes=900))
+        # merged formats add up
+        self.assertRaises(UfysError, hook, dict(filename="audio", downloaded_bytes=200))
+        self.assertRaises(UfysError, YTDLRequestHandler.download_limit(1000), dict(filename="x", total_bytes=2000))
+
+
+class TestDownloadFile(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+        self.handler = worker.Worker(worker.ConfigStore()).handlers[0]
+
+    def test_aborted(self):
+        with TemporaryDirectory() as tmp:
+            path = Path(tmp) / "video"
+            with self.assertRaises(UfysError) as ctx:
+                self.handler.download_file(self.url, path, max_bytes=100_000)
+            self.assertEqual("budget-exceeded", ctx.exception.code)
+            # nothing past the budget made it to disk
+            self.assertLessEqual(path.stat().st_size, 100_000)
+
+    def test_within_budget(self):
+        with TemporaryDirectory() as tmp:
+            path = Path(tmp) / "video"
+            self.handler.download_file(self.url, path, max_bytes=100 * 0x2000)
+            self.assertEqual(100 * 0x2000, path.stat().st_size)
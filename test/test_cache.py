@@ -0,0 +1,109 @@
+import json
+import time
+import unittest
+from unittest import mock
+
+from urllib3.exceptions import MaxRetryError
+
+import cache
+from config import ConfigStore
+from model import UfysError, UfysResponse
+
+
+def make_response(video_url: str, reuploaded: bool = False):
+    return UfysResponse(
+        title=None, creator=None, site=None, video_url=video_url, width=1, height=1, reuploaded=reuploaded
+    )
+
+
+class TestUrlExpiry(unittest.TestCase):
+
+    def test_youtube(self):
+        self.assertEqual(
+            1700000000,
+            cache.url_expiry("https://rr1---sn-abc.googlevideo.com/videoplayback?expire=1700000000&ei=x")
+        )
+
+    def test_facebook_hex(self):
+        self.assertEqual(0x6553F100, cache.url_expiry("https://scontent.cdninstagram.com/v.mp4?oe=6553F100"))
+
+    def test_s3(self):
+        self.assertEqual(
+            1704067200 + 3600,
+            cache.url_expiry("https://s3.example.com/v.mp4?X-Amz-Date=20240101T000000Z&X-Amz-Expires=3600")
+        )
+
+    def test_unsigned(self):
+        self.assertIsNone(cache.url_expiry("https://v.redd.it/abc/DASH_720.mp4"))
+
+
+class TestMemoryCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        tier = cache.MemoryCache(size=2)
+        expires = time.time() + 60
+        tier.set("a", [], expires)
+        tier.set("b", [], expires)
+        tier.get("a")
+        tier.set("c", [], expires)
+        self.assertIsNotNone(tier.get("a"))
+        self.assertIsNone(tier.get("b"))
+        self.assertEqual(1, tier.evictions)
+
+    def test_expired(self):
+        tier = cache.MemoryCache(size=2)
+        tier.set("a", [], time.time() - 1)
+        self.assertIsNone(tier.get("a"))
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.config = ConfigStore(
+            CACHE_TTL_REUPLOAD=1000,
+            CACHE_TTL_DIRECT=100,
+            CACHE_EXPIRY_MARGIN=10,
+            NEGATIVE_CACHE_TTLS="download-error=10,no-handler=100",
+            NEGATIVE_CACHE_MAX_TTL=50
+        )
+        self.cache = cache.ResultCache(self.config, [cache.MemoryCache(size=8)])
+
+    def test_ttl(self):
+        self.assertEqual(1000, self.cache.ttl_for([make_response("https://minio/x.mp4", reuploaded=True)]))
+        self.assertEqual(100, self.cache.ttl_for([make_response("https://cdn/x.mp4")]))
+        self.assertAlmostEqual(
+            40,
+            self.cache.ttl_for([make_response(f"https://cdn/x.mp4?expire={int(time.time()) + 50}")]),
+            delta=1
+        )
+        self.assertEqual(0, self.cache.ttl_for([UfysError("download-error")]))
+
+    def test_negative_backoff(self):
+        errors = [UfysError("download-error")]
+        self.assertEqual([10, 20, 40, 50], [self.cache.negative_ttl_for("key", errors) for _ in range(4)])
+        self.cache.set("key", [make_response("https://cdn/x.mp4")])
+        self.assertEqual(10, self.cache.negative_ttl_for("key", errors))
+
+    def test_negative_codes(self):
+        self.assertEqual(0, self.cache.negative_ttl_for("key", [UfysError("overloaded")]))
+        self.assertEqual(0, self.cache.negative_ttl_for("key", [UfysError("no-handler"), UfysError("timeout")]))
+        self.cache.set("other", [UfysError("no-handler")])
+        self.assertEqual([UfysError("no-handler")], self.cache.get("other"))
+
+    def test_hit_miss(self):
+        results = [make_response("https://cdn/x.mp4")]
+        self.assertIsNone(self.cache.get("key"))
+        self.cache.set("key", results)
+        self.assertEqual(results, self.cache.get("key"))
+        self.assertEqual(dict(memory=1), self.cache.stats()["hits"])
+        self.assertEqual(1, self.cache.stats()["misses"])
+
+
+class TestMinioCache(unittest.TestCase):
+
+    def test_failed_cleanup_is_a_miss(self):
+        worker = mock.Mock(config=ConfigStore(MINIO_BUCKET="bucket"))
+        worker.minio.get_object.return_value.data = json.dumps(dict(expires=time.time() - 1, results=[]))
+        worker.minio.remove_object.side_effect = MaxRetryError(None, "/cache/key.json")
+        self.assertIsNone(cache.MinioCache(worker).get("key"))
+        worker.storage.disconnect.assert_called_once_with("timeout")
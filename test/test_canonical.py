@@ -0,0 +1,61 @@
+import unittest
+
+import canonical
+import worker
+from model import UfysRequest
+
+
+class TestNormalizeUrl(unittest.TestCase):
+
+    def test_tracking_params(self):
+        self.assertEqual(
+            "https://www.youtube.com/watch?t=10&v=abc",
+            canonical.normalize_url("https://WWW.YouTube.com:443/watch?v=abc&si=xyz&utm_source=share&t=10#comments")
+        )
+
+    def test_path(self):
+        self.assertEqual("https://example.com/", canonical.normalize_url("https://example.com"))
+
+
+class TestCanonicalKey(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.Worker(worker.ConfigStore())
+
+    def key(self, url: str) -> str:
+        req = UfysRequest(url=url)
+        self.worker.canonicalize(req)
+        return req.key
+
+    def test_extractor_id(self):
+        self.assertEqual(
+            self.key("https://www.youtube.com/watch?v=dQw4w9WgXcQ"),
+            self.key("https://youtu.be/dQw4w9WgXcQ?si=abc"),
+        )
+        self.assertEqual(
+            self.key("https://www.youtube.com/watch?v=dQw4w9WgXcQ"),
+            self.key("https://m.youtube.com/watch?v=dQw4w9WgXcQ&feature=share"),
+        )
+        self.assertNotEqual(
+            self.key("https://www.youtube.com/watch?v=dQw4w9WgXcQ"),
+            self.key("https://www.youtube.com/watch?v=something"),
+        )
+
+    def test_instagram(self):
+        self.assertEqual(
+            self.key("https://www.instagram.com/p/ABC123/"),
+            self.key("https://instagram.com/reel/ABC123/?igsh=tracking"),
+        )
+
+    def test_hash_unchanged(self):
+        req = UfysRequest(url="https://youtu.be/dQw4w9WgXcQ?si=abc")
+        hash_ = req.hash
+        self.worker.canonicalize(req)
+        self.assertEqual(hash_, req.hash)
+        self.assertNotEqual(hash_, req.key)
+
+    def test_unset_options(self):
+        # options added later don't change the hashes of requests that don't use them
+        req = UfysRequest(url="https://example.com/video")
+        self.assertEqual(UfysRequest.hash_dict(dict(url="https://example.com/video")), req.hash)
+        self.assertNotEqual(req.hash, UfysRequest(url="https://example.com/video", max_height=720).hash)
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+import unittest
+
+import worker
+from execution import Slots
+from handlers.base import RequestHandler
+from model import UfysError, UfysRequest, UfysResponse
+
+
+class FakeHandler(RequestHandler):
+
+    def __init__(self, worker_, name: str, priority: int = 0, delay: float = 0., fail: bool = False,
+                 deadline: float | None = None):
+        super().__init__(worker_)
+        self.name = name
+        self.priority = priority
+        self.delay = delay
+        self.fail = fail
+        self.deadline = deadline
+        self.started = threading.Event()
+
+    def handle_request(self, req: UfysRequest) -> UfysResponse:
+        self.started.set()
+        time.sleep(self.delay)
+        if self.fail:
+            raise UfysError(code="fake-error", message=self.name)
+        return UfysResponse(title=self.name, creator=None, site=None, video_url=req.url, width=1, height=1)
+
+
+class TestRaceDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.Worker(worker.ConfigStore(DISPATCH_HEDGE_DELAY=0.2))
+
+    def race(self, *handlers: FakeHandler):
+        self.worker.handlers = list(handlers)
+        return self.worker.run_handlers(UfysRequest(url="https://example.com"))
+
+    def test_preferred_wins_without_waiting(self):
+        slow = FakeHandler(self.worker, "slow", priority=0, delay=2)
+        start = time.monotonic()
+        result, = self.race(FakeHandler(self.worker, "fast", priority=10), slow)
+        self.assertEqual("fast", result.title)
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertFalse(slow.started.is_set())
+
+    def test_fallback_after_failure(self):
+        result, = self.race(
+            FakeHandler(self.worker, "broken", priority=10, fail=True),
+            FakeHandler(self.worker, "fallback", priority=0),
+        )
+        self.assertEqual("fallback", result.title)
+
+    def test_hedged_fallback(self):
+        result, = self.race(
+            FakeHandler(self.worker, "stuck", priority=10, delay=2),
+            FakeHandler(self.worker, "fallback", priority=0),
+        )
+        self.assertEqual("fallback", result.title)
+
+    def test_all_failed(self):
+        results = self.race(
+            FakeHandler(self.worker, "a", priority=10, fail=True),
+            FakeHandler(self.worker, "b", priority=0, fail=True),
+        )
+        self.assertEqual(["a", "b"], [result.message for result in results])
+
+    def test_deadline(self):
+        result, = self.race(FakeHandler(self.worker, "stuck", delay=2, deadline=0.1))
+        self.assertIsInstance(result, UfysError)
+        self.assertEqual("timeout", result.code)
+
+
+class AsyncFakeHandler(FakeHandler):
+
+    async def handle_request_async(self, req: UfysRequest) -> UfysResponse:
+        self.started.set()
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.fail:
+            raise UfysError(code="fake-error", message=self.name)
+        return UfysResponse(title=self.name, creator=None, site=None, video_url=req.url, width=1, height=1)
+
+
+class TestAsyncRaceDispatch(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.worker = worker.Worker(worker.ConfigStore(DISPATCH_HEDGE_DELAY=0.2))
+
+    async def race(self, *handlers: FakeHandler):
+        self.worker.handlers = list(handlers)
+        return await self.worker.run_handlers_async(UfysRequest(url="https://example.com"))
+
+    async def test_hedged_fallback(self):
+        stuck = AsyncFakeHandler(self.worker, "stuck", priority=10, delay=2)
+        result, = await self.race(stuck, AsyncFakeHandler(self.worker, "fallback", priority=0))
+        self.assertEqual("fallback", result.title)
+        await asyncio.sleep(0)
+        # losing handlers are cancelled, not left running
+        self.assertTrue(stuck.cancelled)
+
+    async def test_blocking_handler(self):
+        result, = await self.race(FakeHandler(self.worker, "blocking", delay=0.1))
+        self.assertEqual("blocking", result.title)
+
+    async def test_deadline(self):
+        result, = await self.race(AsyncFakeHandler(self.worker, "stuck", delay=2, deadline=0.1))
+        self.assertEqual("timeout", result.code)
+
+    async def test_error(self):
+        result, = await self.race(AsyncFakeHandler(self.worker, "broken", fail=True))
+        self.assertEqual(UfysError(code="fake-error", message="broken"), result)
+
+    async def test_handler_slots(self):
+        self.worker.config.EXECUTOR_QUEUE_TIMEOUT = 0.1
+        self.worker.config.HANDLER_CONCURRENCY = "AsyncFakeHandler=1"
+        handler = AsyncFakeHandler(self.worker, "limited", delay=0.5)
+        req = UfysRequest(url="https://example.com")
+        first, second = await asyncio.gather(
+            self.worker.execute_handler_async(handler, req), self.worker.execute_handler_async(handler, req)
+        )
+        self.assertEqual(("limited", "overloaded"), (first.title, second.code))
+        # released again
+        self.assertTrue(handler.slots_for(req).acquire())
+
+    async def test_slot_handed_over(self):
+        self.worker.config.EXECUTOR_QUEUE_TIMEOUT = 1
+        slots = Slots(1)
+        slots.acquire()
+        first = asyncio.ensure_future(self.worker.acquire_slot_async(slots))
+        second = asyncio.ensure_future(self.worker.acquire_slot_async(slots))
+        await asyncio.sleep(0)
+        # released by a blocking run, in line order
+        await asyncio.to_thread(slots.release)
+        self.assertTrue(await first)
+        self.assertFalse(second.done())
+        slots.release()
+        self.assertTrue(await second)
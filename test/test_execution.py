@@ -0,0 +1,102 @@
+import pickle
+import threading
+import time
+import unittest
+
+import worker
+from execution import BoundedExecutor, Slots
+from model import UfysError, UfysRequest
+
+
+class TestProcessBackend(unittest.TestCase):
+
+    def test_error_pickles(self):
+        error = UfysError(code="some-error", message="details")
+        self.assertEqual(error, pickle.loads(pickle.dumps(error)))
+
+    def test_run_in_process(self):
+        worker_ = worker.Worker(worker.ConfigStore(EXECUTION_BACKEND="process", PROCESS_POOL_SIZE=1))
+        self.addCleanup(worker_.process_backend.shutdown)
+        handler, = (handler for handler in worker_.handlers if handler.__class__.__name__ == "AsciinemaRequestHandler")
+        # AAAS_ENDPOINT isn't configured, so this fails without touching the network
+        result = worker_.execute_handler(handler, UfysRequest(url="https://asciinema.org/a/123"))
+        self.assertEqual(UfysError(code="config-error", message="AAAS_ENDPOINT not set"), result)
+        # kept for the next task
+        self.assertEqual((1, 0), (len(worker_.process_backend.idle), worker_.process_backend.recycled))
+
+    def test_recycle_grown_child(self):
+        worker_ = worker.Worker(worker.ConfigStore(EXECUTION_BACKEND="process", PROCESS_POOL_SIZE=2, PROCESS_MAX_RSS=1))
+        self.addCleanup(worker_.process_backend.shutdown)
+        handler, = (handler for handler in worker_.handlers if handler.__class__.__name__ == "AsciinemaRequestHandler")
+        for _ in range(2):
+            result = worker_.execute_handler(handler, UfysRequest(url="https://asciinema.org/a/123"))
+            self.assertEqual("config-error", result.code)
+        # only the child that ran the task exited
+        self.assertEqual((0, 2), (worker_.process_backend.children, worker_.process_backend.recycled))
+
+
+class TestBoundedExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = BoundedExecutor(workers=1, queue_size=1, queue_timeout=0.2)
+        self.addCleanup(self.executor.shutdown)
+        self.release = threading.Event()
+
+    def test_reject_when_full(self):
+        running = self.executor.submit(self.release.wait)
+        queued = self.executor.submit(lambda: "queued")
+        with self.assertRaises(UfysError) as cm:
+            self.executor.submit(lambda: "rejected")
+        self.assertEqual("overloaded", cm.exception.code)
+        self.release.set()
+        self.assertTrue(running.result())
+        self.assertEqual("queued", queued.result())
+        self.assertEqual(1, self.executor.stats()["rejected"])
+
+    def test_queue_timeout(self):
+        self.executor.submit(time.sleep, 0.4)
+        expired = self.executor.submit(lambda: "too late")
+        with self.assertRaises(UfysError) as cm:
+            expired.result()
+        self.assertEqual("overloaded", cm.exception.code)
+        self.assertEqual(1, self.executor.stats()["expired"])
+
+    def test_cancel_releases_capacity(self):
+        self.executor.submit(self.release.wait)
+        self.executor.submit(lambda: None).cancel()
+        self.assertEqual(0, self.executor.stats()["queued"])
+        # the cancelled task's place is free again
+        self.executor.submit(lambda: None)
+        self.release.set()
+
+    def test_slots(self):
+        executor = BoundedExecutor(workers=2, queue_size=0, queue_timeout=0.2)
+        self.addCleanup(executor.shutdown)
+        slots = Slots(1)
+        executor.submit(time.sleep, 0.4, slots=slots)
+        with self.assertRaises(UfysError):
+            executor.submit(lambda: None, slots=slots).result()
+        self.assertEqual(1, executor.stats()["expired"])
+
+    def test_waiting_for_slots_takes_no_thread(self):
+        executor = BoundedExecutor(workers=2, queue_size=4, queue_timeout=1)
+        self.addCleanup(executor.shutdown)
+        slots = Slots(1)
+        running = executor.submit(self.release.wait, slots=slots)
+        waiting = [executor.submit(lambda: "limited", slots=slots) for _ in range(3)]
+        # the second thread is still free for other handlers
+        self.assertEqual("other", executor.submit(lambda: "other").result(timeout=0.5))
+        self.release.set()
+        self.assertTrue(running.result())
+        self.assertEqual(["limited"] * 3, [future.result() for future in waiting])
+        self.assertTrue(slots.acquire())
+
+    def test_cancel_waiting_for_slots(self):
+        slots = Slots(1)
+        running = self.executor.submit(self.release.wait, slots=slots)
+        self.executor.submit(lambda: None, slots=slots).cancel()
+        self.assertEqual(0, self.executor.stats()["queued"])
+        self.release.set()
+        running.result()
+        # the cancelled task passed its slot on
+        self.assertTrue(slots.acquire())
@@ -0,0 +1,100 @@
+import unittest
+
+import format_selection
+
+
+def fmt(**kwargs) -> dict:
+    return dict(url="https://cdn/video", ext="mp4", protocol="https", vcodec="avc1.64001f", acodec="mp4a.40.2") | kwargs
+
+
+class TestSelect(unittest.TestCase):
+
+    def test_codec_families(self):
+        for vcodec in ("h264", "avc1.4d401f", "avc3.640028"):
+            self.assertTrue(format_selection.select(dict(formats=[fmt(vcodec=vcodec)])).linkable)
+        selection = format_selection.select(dict(formats=[fmt(vcodec="vp09.00.40.08"), fmt(vcodec="hev1.1.6")]))
+        self.assertFalse(selection.linkable)
+        self.assertEqual("codec", selection.reason)
+
+    def test_needs_audio(self):
+        selection = format_selection.select(dict(formats=[fmt(acodec="none"), fmt(acodec=None)]))
+        self.assertEqual((None, "audio"), (selection.format, selection.reason))
+
+    def test_best_format(self):
+        formats = [
+            fmt(url="https://cdn/360", height=360, width=640),
+            fmt(url="https://cdn/1080", height=1080),
+            fmt(url="https://cdn/1080-dims", height=1080, width=1920),
+            fmt(url="https://cdn/720", height=720, width=1280),
+        ]
+        # known dimensions save a probe
+        self.assertEqual("https://cdn/1080-dims", format_selection.select(dict(formats=formats)).format["url"])
+
+    def test_budget(self):
+        formats = [
+            fmt(url="https://cdn/480", height=480, tbr=1000),
+            fmt(url="https://cdn/720", height=720, tbr=2500),
+            fmt(url="https://cdn/1080", height=1080, filesize=50_000_000),
+        ]
+        info = dict(formats=formats, duration=60)
+        self.assertEqual("https://cdn/720", format_selection.select(info, max_height=720).format["url"])
+        # 2500 kbit/s for a minute is ~19mb
+        self.assertEqual("https://cdn/480", format_selection.select(info, max_filesize=10_000_000).format["url"])
+        selection = format_selection.select(info, max_height=240)
+        self.assertEqual((None, "budget"), (selection.format, selection.reason))
+
+    def test_remux_hls(self):
+        formats = [
+            fmt(url="https://cdn/video.webm", ext="webm", vcodec="vp9"),
+            fmt(url="https://cdn/720.m3u8", protocol="m3u8_native", height=720),
+        ]
+        selection = format_selection.select(dict(formats=formats))
+        self.assertFalse(selection.linkable)
+        self.assertEqual(("https://cdn/720.m3u8", "protocol"), (selection.format["url"], selection.reason))
+
+    def test_no_formats(self):
+        self.assertEqual("no-formats", format_selection.select(dict()).reason)
+
+
+class TestSelectStreams(unittest.TestCase):
+    PROTOCOLS = ("https", "m3u8_native")
+
+    def test_within_budget(self):
+        info = dict(duration=60, formats=[
+            fmt(url="https://cdn/audio", acodec="opus", vcodec="none", tbr=128),
+            fmt(url="https://cdn/720", acodec="none", height=720, tbr=2500),
+            fmt(url="https://cdn/1080", acodec="none", height=1080, tbr=5000),
+            fmt(url="https://cdn/360-muxed", height=360, tbr=800),
+            fmt(url="https://cdn/480", protocol="http_dash_segments", acodec="none", height=480),
+        ])
+        streams = format_selection.select_streams(info, self.PROTOCOLS, max_height=720)
+        self.assertEqual(["https://cdn/720", "https://cdn/audio"], [stream["url"] for stream in streams])
+        streams = format_selection.select_streams(info, self.PROTOCOLS, max_filesize=10_000_000)
+        self.assertEqual(["https://cdn/360-muxed"], [stream["url"] for stream in streams])
+        self.assertIsNone(format_selection.select_streams(info, self.PROTOCOLS, max_height=240))
+
+    def test_prefers_h264(self):
+        info = dict(formats=[
+            fmt(url="https://cdn/audio", acodec="opus", vcodec="none"),
+            fmt(url="https://cdn/1080-vp9", acodec="none", vcodec="vp09.00.40.08", height=1080),
+            fmt(url="https://cdn/720", acodec="none", height=720),
+        ])
+        # copying 720p beats transcoding 1080p
+        streams = format_selection.select_streams(info, self.PROTOCOLS)
+        self.assertEqual(["https://cdn/720", "https://cdn/audio"], [stream["url"] for stream in streams])
+        self.assertEqual((True, False), tuple(format_selection.copy_audio(stream) for stream in streams))
+
+    def test_over_budget(self):
+        info = dict(duration=60, formats=[
+            fmt(url="https://cdn/audio", acodec="opus", vcodec="none", tbr=128),
+            fmt(url="https://cdn/720", acodec="none", height=720, tbr=2500),
+            fmt(url="https://cdn/1080", acodec="none", height=1080, tbr=5000),
+        ])
+        self.assertEqual(("height", 720, 480), format_selection.over_budget(info, max_height=480))
+        self.assertEqual(
+            ("filesize", 18_750_000, 1_000_000), format_selection.over_budget(info, max_filesize=1_000_000)
+        )
+        self.assertIsNone(format_selection.over_budget(info, max_filesize=20_000_000, max_height=720))
+        # one format of unknown height might fit
+        info["formats"].append(fmt(url="https://cdn/unknown"))
+        self.assertIsNone(format_selection.over_budget(info, max_height=480))
@@ -0,0 +1,65 @@
+import struct
+import unittest
+
+import media
+
+
+def box(type_: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", len(payload) + 8, type_) + payload
+
+
+class TestBoxParsing(unittest.TestCase):
+
+    def test_iter_boxes(self):
+        data = box(b"ftyp", b"isom") + box(b"mdat", b"\0" * 100) + box(b"moov", b"\0" * 10)
+        self.assertEqual(
+            [(b"ftyp", 0, 12), (b"mdat", 12, 108), (b"moov", 120, 18)],
+            [(b.type, b.offset, b.size) for b in media.iter_boxes(data)]
+        )
+
+    def test_truncated(self):
+        # the mdat box extends past the end of what we've downloaded
+        data = box(b"ftyp", b"isom") + box(b"mdat", b"\0" * 100)[:50]
+        self.assertEqual([b"ftyp", b"mdat"], [b.type for b in media.iter_boxes(data)])
+
+    def test_large_size(self):
+        data = struct.pack(">I4sQ", 1, b"mdat", 1 << 33)
+        self.assertEqual((1 << 33, 16), media.parse_box_header(data)[2:])
+
+    def test_is_mp4(self):
+        self.assertTrue(media.is_mp4(box(b"ftyp", b"isom")))
+        self.assertFalse(media.is_mp4(b"\x1a\x45\xdf\xa3" + b"\0" * 12))
+
+    def test_is_faststart(self):
+        self.assertTrue(media.is_faststart(box(b"ftyp", b"isom") + box(b"moov", b"\0" * 10) + box(b"mdat")))
+        self.assertFalse(media.is_faststart(box(b"ftyp", b"isom") + box(b"mdat", b"\0" * 100) + box(b"moov")))
+        self.assertFalse(media.is_faststart(box(b"moov") + box(b"mdat")))
+
+
+class TestProbe(unittest.TestCase):
+
+    def probe(self, *streams: dict) -> media.Probe:
+        return media.Probe.from_ffprobe(dict(streams=list(streams)))
+
+    def test_web_compatible(self):
+        probe = self.probe(
+            dict(codec_type="audio", codec_name="aac"),
+            dict(codec_type="video", codec_name="h264", pix_fmt="yuv420p", width=1280, height=720)
+        )
+        self.assertEqual(media.Probe("h264", "yuv420p", 1280, 720, "aac"), probe)
+        self.assertTrue(probe.copy_video and probe.copy_audio)
+
+    def test_needs_transcode(self):
+        probe = self.probe(
+            dict(codec_type="video", codec_name="mjpeg", disposition=dict(attached_pic=1)),
+            dict(codec_type="video", codec_name="vp9", pix_fmt="yuv420p", width=640, height=360),
+            dict(codec_type="audio", codec_name="opus")
+        )
+        self.assertEqual("vp9", probe.video_codec)
+        self.assertFalse(probe.copy_video or probe.copy_audio)
+        self.assertFalse(self.probe(dict(codec_type="video", codec_name="h264", pix_fmt="yuv444p")).copy_video)
+
+    def test_no_audio(self):
+        self.assertTrue(self.probe(dict(codec_type="video", codec_name="gif")).copy_audio)
+        with self.assertRaises(ValueError):
+            self.probe(dict(codec_type="audio", codec_name="aac"))
@@ -0,0 +1,49 @@
+import itertools
+import threading
+import unittest
+
+from pool import ObjectPool
+
+
+class TestObjectPool(unittest.TestCase):
+
+    def setUp(self):
+        self.counter = itertools.count()
+        self.pool = ObjectPool(lambda: next(self.counter), size=2, max_uses=3, keep_on=(KeyError,))
+
+    def test_reuse(self):
+        for _ in range(3):
+            with self.pool.checkout() as obj:
+                self.assertEqual(0, obj)
+        # max_uses reached
+        with self.pool.checkout() as obj:
+            self.assertEqual(1, obj)
+        self.assertEqual(1, self.pool.stats()["recycled"])
+
+    def test_recycle_on_error(self):
+        with self.assertRaises(ValueError), self.pool.checkout():
+            raise ValueError()
+        with self.assertRaises(KeyError), self.pool.checkout():
+            raise KeyError()
+        with self.pool.checkout() as obj:
+            self.assertEqual(1, obj)
+
+    def test_bounded(self):
+        with self.pool.checkout() as first, self.pool.checkout() as second:
+            self.assertNotEqual(first, second)
+            self.assertEqual(2, self.pool.stats()["in_use"])
+            self.assertRaises(TimeoutError, self.pool.checkout(timeout=0.01).__enter__)
+
+    def test_waiter_gets_released_object(self):
+        waiter = self.pool.checkout(timeout=5)
+        results = []
+        with self.pool.checkout(), self.pool.checkout():
+            thread = threading.Thread(target=lambda: results.append(waiter.__enter__()))
+            thread.start()
+            while not self.pool.stats()["waiting"]:
+                pass
+        thread.join()
+        self.assertIn(results[0], (0, 1))
+        self.assertEqual(2, self.pool.stats()["created"])
+        waiter.__exit__(None, None, None)
+        self.assertEqual(2, len(self.pool.idle))
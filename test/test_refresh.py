@@ -0,0 +1,75 @@
+import dataclasses
+import time
+import unittest
+from unittest import mock
+
+import worker
+from model import UfysError, UfysRequest, UfysResponse
+
+
+def direct(url: str) -> UfysResponse:
+    return UfysResponse(
+        title="title", creator=None, site="site", video_url=url, width=16, height=9, reuploaded=False
+    )
+
+
+class TestRefresher(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.Worker(worker.ConfigStore(REFRESH_MIN_HITS=2, REFRESH_INTERVAL=3600))
+        self.refresher = self.worker.refresher
+        self.results = [direct("https://cdn/first.mp4")]
+        patcher = mock.patch.object(self.worker, "run_handlers", lambda _: list(self.results))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.req = UfysRequest(url="https://example.com/video")
+        self.key = self.req.key
+        self.worker.handle_request(UfysRequest(url="https://example.com/video"))
+
+    def expire_soon(self):
+        self.refresher.entries[self.key].expires = time.time() + 60
+
+    def hit(self, times: int = 2) -> list[UfysResponse | UfysError]:
+        for _ in range(times):
+            results = self.worker.handle_request(UfysRequest(url="https://example.com/video"))
+        return results
+
+    def schedule(self):
+        self.refresher.schedule()
+        self.refresher.executor.shutdown(wait=True)
+
+    def test_hot_entry_refreshed(self):
+        self.hit()
+        self.expire_soon()
+        self.results = [direct("https://cdn/second.mp4")]
+        self.schedule()
+        self.assertEqual("https://cdn/second.mp4", self.hit(1)[0].video_url)
+        self.assertGreater(self.refresher.entries[self.key].expires, time.time() + 60)
+
+    def test_cold_entry_not_refreshed(self):
+        self.hit(1)
+        self.expire_soon()
+        self.results = [direct("https://cdn/second.mp4")]
+        self.schedule()
+        self.assertEqual("https://cdn/first.mp4", self.hit(1)[0].video_url)
+
+    def test_failure_keeps_old_results(self):
+        self.hit()
+        self.expire_soon()
+        self.results = [UfysError(code="download-error")]
+        self.schedule()
+        self.assertEqual("https://cdn/first.mp4", self.hit(1)[0].video_url)
+        self.assertNotIn(self.key, self.refresher.refreshing)
+
+    def test_deferred_while_requests_queued(self):
+        self.hit()
+        self.expire_soon()
+        self.results = [direct("https://cdn/second.mp4")]
+        with mock.patch.object(self.worker.executor, "stats", lambda: dict(queued=1)):
+            self.schedule()
+        self.assertEqual("https://cdn/first.mp4", self.hit(1)[0].video_url)
+
+    def test_reuploads_not_tracked(self):
+        reupload = dataclasses.replace(direct("https://minio/upload.mp4"), reuploaded=True)
+        self.refresher.track(self.req, self.key, [reupload], time.time() + 3600)
+        self.assertNotIn(self.key, self.refresher.entries)
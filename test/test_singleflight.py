@@ -0,0 +1,119 @@
+import asyncio
+import threading
+import unittest
+from multiprocessing.pool import ThreadPool
+
+from singleflight import AsyncSingleFlight, SingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = 0
+
+    def slow(self, result=None, error: Exception = None):
+        self.calls += 1
+        self.release.wait(5)
+        if error is not None:
+            raise error
+        return result
+
+    def run_concurrently(self, func, count: int = 5):
+        def call(_):
+            try:
+                return self.flight.do("key", func, timeout=5)
+            except Exception as ex:
+                return ex
+
+        with ThreadPool(count) as pool:
+            pending = pool.map_async(call, range(count))
+            while self.flight.shared < count - 1:
+                pass
+            self.release.set()
+            return pending.get()
+
+    def test_shared_result(self):
+        results = self.run_concurrently(lambda: self.slow(result=42))
+        self.assertEqual([42] * 5, results)
+        self.assertEqual(1, self.calls)
+        self.assertEqual(0, self.flight.in_flight())
+
+    def test_shared_error(self):
+        error = ValueError("broken")
+        results = self.run_concurrently(lambda: self.slow(error=error))
+        self.assertEqual([error] * 5, results)
+        self.assertEqual(1, self.calls)
+
+    def test_timeout(self):
+        leader = threading.Thread(target=self.flight.do, args=("key", self.slow))
+        leader.start()
+        while not self.flight.in_flight():
+            pass
+        self.assertRaises(TimeoutError, self.flight.do, "key", self.slow, timeout=0.01)
+        self.release.set()
+        leader.join()
+
+
+class TestAsyncSingleFlight(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.flight = AsyncSingleFlight()
+        self.release = asyncio.Event()
+        self.calls = 0
+
+    async def slow(self, result=None, error: Exception = None):
+        self.calls += 1
+        await self.release.wait()
+        if error is not None:
+            raise error
+        return result
+
+    async def run_concurrently(self, func, count: int = 5):
+        tasks = [asyncio.ensure_future(self.flight.do("key", func, timeout=5)) for _ in range(count)]
+        while self.flight.shared < count - 1:
+            await asyncio.sleep(0)
+        self.release.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def test_shared_result(self):
+        self.assertEqual([42] * 5, await self.run_concurrently(lambda: self.slow(result=42)))
+        self.assertEqual(1, self.calls)
+        self.assertEqual(0, self.flight.in_flight())
+
+    async def test_shared_error(self):
+        error = ValueError("broken")
+        self.assertEqual([error] * 5, await self.run_concurrently(lambda: self.slow(error=error)))
+        self.assertEqual(1, self.calls)
+
+    async def test_timeout(self):
+        leader = asyncio.ensure_future(self.flight.do("key", self.slow))
+        await asyncio.sleep(0)
+        with self.assertRaises(TimeoutError):
+            await self.flight.do("key", self.slow, timeout=0.01)
+        self.release.set()
+        await leader
+        self.assertEqual(1, self.calls)
+
+    async def test_leader_cancelled(self):
+        leader = asyncio.ensure_future(self.flight.do("key", lambda: self.slow(result=42)))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(self.flight.do("key", lambda: self.slow(result=0), timeout=5))
+        await asyncio.sleep(0)
+        # e.g. the leader's client disconnected, the waiter still gets the result
+        leader.cancel()
+        self.release.set()
+        self.assertEqual(42, await waiter)
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(1, self.calls)
+
+    async def test_abandoned(self):
+        leader = asyncio.ensure_future(self.flight.do("key", self.slow))
+        await asyncio.sleep(0)
+        call = self.flight.calls["key"]
+        leader.cancel()
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        self.assertTrue(call.task.cancelled())
+        self.assertEqual(0, self.flight.in_flight())
@@ -0,0 +1,51 @@
+import socket
+import unittest
+from unittest import mock
+
+from minio import Minio
+from moto.server import ThreadedMotoServer
+
+from config import ConfigStore
+from storage import MinioConnection
+
+
+class TestMinioConnection(unittest.TestCase):
+
+    def setUp(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.config = ConfigStore(
+            MINIO_ENDPOINT=f"127.0.0.1:{self.port}",
+            MINIO_ACCESS_KEY="test",
+            MINIO_SECRET_KEY="test",
+            MINIO_BUCKET="test",
+            MINIO_SECURE=False,
+            MINIO_RETRY_INTERVAL=0
+        )
+
+    def test_reconnect(self):
+        connection = MinioConnection(self.config)
+        # nothing listening yet, e.g. minio starting up alongside us
+        self.assertIsNone(connection.get(wait=True))
+        self.assertEqual("timeout", connection.error)
+        server = ThreadedMotoServer(ip_address="127.0.0.1", port=self.port, verbose=False)
+        server.start()
+        self.addCleanup(server.stop)
+        Minio(self.config.MINIO_ENDPOINT, "test", "test", secure=False).make_bucket("test")
+        self.assertIsNotNone(connection.get(wait=True))
+        self.assertIsNone(connection.error)
+        connection.disconnect("timeout")
+        self.assertEqual("timeout", connection.error)
+        # requests don't wait for the reconnect
+        self.assertIsNone(connection.get())
+        with connection.lock:
+            self.assertIsNotNone(connection.get())
+
+    def test_retry_interval(self):
+        connection = MinioConnection(ConfigStore(MINIO_RETRY_INTERVAL=60))
+        self.assertIsNone(connection.get(wait=True))
+        self.assertEqual("configuration error", connection.error)
+        with mock.patch.object(connection, "connect") as connect:
+            self.assertIsNone(connection.get())
+        connect.assert_not_called()
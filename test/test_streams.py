@@ -0,0 +1,34 @@
+import io
+import unittest
+
+import streams
+
+
+class TestPrefetchStream(unittest.TestCase):
+
+    def test_roundtrip(self):
+        data = bytes(range(256)) * 1000
+        with streams.PrefetchStream(io.BytesIO(data), chunk_size=1000, buffer_size=4000) as stream:
+            parts = list(iter(lambda: stream.read(777), b""))
+        self.assertEqual(data, b"".join(parts))
+        self.assertEqual(len(data), stream.bytes_read)
+
+    def test_finish_error(self):
+        def finish():
+            raise IOError("producer failed")
+
+        with streams.PrefetchStream(io.BytesIO(b"partial"), finish=finish) as stream:
+            self.assertEqual(b"partial", stream.read(100))
+            self.assertRaises(IOError, stream.read, 100)
+
+    def test_close_stops_producer(self):
+        stream = streams.PrefetchStream(io.BytesIO(b"\0" * 100_000), chunk_size=10, buffer_size=10)
+        stream.read(10)
+        stream.close()
+        stream.thread.join(1)
+        self.assertFalse(stream.thread.is_alive())
+
+    def test_max_bytes(self):
+        with streams.PrefetchStream(io.BytesIO(b"\0" * 5000), chunk_size=1000, max_bytes=2500) as stream:
+            self.assertEqual(b"\0" * 2000, stream.read(1000) + stream.read(1000))
+            self.assertRaises(streams.LimitExceeded, stream.read, 1000)
@@ -0,0 +1,86 @@
+import unittest
+from unittest import mock
+
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import Status, StatusCode
+
+import telemetry
+from model import UfysRequest
+
+
+class TestFlattenAttributes(unittest.TestCase):
+
+    def test_nested(self):
+        self.assertEqual(
+            {"req.url": "https://example.com", "info.formats.0.height": 720, "info.live": False},
+            telemetry.flatten_attributes(dict(
+                req=UfysRequest(url="https://example.com"),
+                info=dict(formats=[dict(height=720, fragments=None)], live=False),
+                handler=object()
+            ))
+        )
+
+    def test_allowlist(self):
+        info = dict(id="abc", formats=[dict(url="https://cdn")] * 100)
+        self.assertEqual({"info.id": "abc"}, telemetry.flatten_attributes(dict(info=info), allow=("info.id",)))
+
+    def test_caps(self):
+        attributes = telemetry.flatten_attributes(dict(items=["x" * 1000] * 100), limit=10)
+        self.assertEqual(10, len(attributes))
+        self.assertEqual(telemetry.ATTRIBUTE_MAX_LENGTH, len(attributes["items.0"]))
+
+
+class TestTraceFunction(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        patcher = mock.patch("opentelemetry.trace.get_tracer", provider.get_tracer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def handle(req: UfysRequest, info: dict):
+        return info["id"]
+
+    def test_disabled(self):
+        self.assertEqual("abc", telemetry.trace_function(self.handle)(UfysRequest(url="x"), dict(id="abc")))
+        self.assertEqual((), self.exporter.get_finished_spans())
+
+    def test_bound_method(self):
+        class Handler:
+            def extract(self, url, download=True):
+                return url
+
+        with mock.patch.object(telemetry, "_enabled", True):
+            # decorated in the class body (self is a parameter) and wrapped at runtime (it isn't)
+            telemetry.trace_function(Handler.extract)(Handler(), "https://example.com", download=False)
+            telemetry.trace_function(Handler().extract)("https://example.com")
+        first, second = self.exporter.get_finished_spans()
+        self.assertEqual({"url": "https://example.com", "download": False}, dict(first.attributes))
+        self.assertEqual({"url": "https://example.com"}, dict(second.attributes))
+
+
+class TestTailSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(
+            telemetry.TailSamplingProcessor(SimpleSpanProcessor(self.exporter), min_duration=60)
+        )
+        self.tracer = provider.get_tracer(__name__)
+
+    def test_drop_fast(self):
+        with self.tracer.start_as_current_span("root"), self.tracer.start_as_current_span("child"):
+            pass
+        self.assertEqual((), self.exporter.get_finished_spans())
+
+    def test_keep_failed(self):
+        with self.tracer.start_as_current_span("root"):
+            with self.tracer.start_as_current_span("child") as child:
+                child.set_status(Status(StatusCode.ERROR))
+        self.assertEqual(["child", "root"], [span.name for span in self.exporter.get_finished_spans()])
@@ -0,0 +1,48 @@
+import http.server
+import threading
+import unittest
+
+import metrics
+import transport
+from config import ConfigStore
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *_):
+        pass
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/"
+
+    @staticmethod
+    def count(counter, client: str) -> float:
+        return counter.labels(client).collect()[0].samples[0].value
+
+    def test_connection_reuse(self):
+        session = transport.make_session(ConfigStore(), "test-reuse")
+        for _ in range(3):
+            self.assertEqual("ok", session.get(self.url).text)
+        self.assertEqual(3, self.count(metrics.HTTP_REQUESTS, "test-reuse"))
+        self.assertEqual(1, self.count(metrics.HTTP_CONNECTIONS, "test-reuse"))
+
+    def test_pool_sizes(self):
+        config = ConfigStore(HTTP_POOL_SIZES="127.0.0.1:1=4", HTTP_CONNECT_TIMEOUT="0", HTTP_READ_TIMEOUT="5")
+        session = transport.make_session(config, "test-pools")
+        self.assertEqual(4, session.get_adapter("https://127.0.0.1:1/path")._pool_maxsize)
+        adapter = session.get_adapter(self.url)
+        self.assertEqual((16, (None, 5.)), (adapter._pool_maxsize, adapter.timeout))
@@ -1,6 +1,14 @@
+import json
+import pathlib
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 import main
+import telemetry
+from model import UfysError, UfysResponse
 
 
 class TestWeb(unittest.TestCase):
@@ -9,3 +17,145 @@ class TestWeb(unittest.TestCase):
         self.app = main.APP.test_client()
 
     # TODO add flask tests
+
+
+class TestOverload(unittest.TestCase):
+
+    def setUp(self):
+        self.app = main.APP.test_client()
+
+    def test_retry_after(self):
+        overloaded = [UfysError(code="overloaded", message="too many requests in flight, try again later")]
+        with mock.patch.object(main.WORKER, "handle_request", lambda req: overloaded):
+            r = self.app.post("/video", json=dict(url="https://example.com"))
+        self.assertEqual(503, r.status_code)
+        self.assertEqual(str(main.WORKER.config.RETRY_AFTER), r.headers["Retry-After"])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.app = main.APP.test_client()
+
+    def test_metrics(self):
+        with telemetry.stage("probe"):
+            pass
+        main.WORKER.cache.get("not-cached")
+        r = self.app.get("/metrics")
+        self.assertEqual(200, r.status_code)
+        body = r.get_data(as_text=True)
+        self.assertIn('ufys_stage_duration_seconds_count{stage="probe"}', body)
+        self.assertIn('ufys_cache_lookups_total{tier="none"}', body)
+
+
+class TestHealth(unittest.TestCase):
+
+    def setUp(self):
+        self.app = main.APP.test_client()
+
+    def test_healthz(self):
+        self.assertEqual(200, self.app.get("/healthz").status_code)
+
+    def test_readyz(self):
+        main.WORKER.warmed_up.wait(30)
+        r = self.app.get("/readyz")
+        self.assertEqual(200, r.status_code)
+        # not configured in tests
+        self.assertEqual("configuration error", r.json["minio"])
+        with mock.patch.object(main.WORKER, "warmed_up", threading.Event()):
+            self.assertEqual(503, self.app.get("/readyz").status_code)
+
+
+class TestRequestLog(unittest.TestCase):
+
+    def setUp(self):
+        self.app = main.APP.test_client()
+
+    def test_log(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            log = pathlib.Path(tmp) / "requests.log"
+            with mock.patch.object(main.WORKER.config, "REQUEST_LOG", str(log)), \
+                    mock.patch.object(main.WORKER, "handle_request", lambda req: [UfysError(code="fake")]):
+                self.app.post("/video", json=dict(url="https://example.com/1"))
+                self.app.post("/video", json=dict(url="https://example.com/2"))
+            entries = [json.loads(line) for line in log.read_text().splitlines()]
+        self.assertEqual(
+            ["https://example.com/1", "https://example.com/2"], [entry["request"]["url"] for entry in entries]
+        )
+        self.assertLessEqual(entries[0]["time"], entries[1]["time"])
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.app = main.APP.test_client()
+        self.release = False
+
+    def handle_request(self, req):
+        while not self.release:
+            time.sleep(0.01)
+        return [UfysResponse(title=None, creator=None, site=None, video_url=req.url, width=1, height=1)]
+
+    def test_job_lifecycle(self):
+        notified = []
+        with (
+            mock.patch.object(main.WORKER, "handle_request", self.handle_request),
+            mock.patch.object(main.JOBS, "notify", lambda job_, url: notified.append(url)),
+            mock.patch.object(main.JOBS.config, "JOB_CALLBACK_HOSTS", "hooks")
+        ):
+            r = self.app.post("/jobs", json=dict(url="https://example.com/job", callback_url="https://hooks/a"))
+            self.assertEqual(202, r.status_code)
+            job = r.json
+            self.assertEqual("UfysJob", job["_class"])
+            # identical requests are deduplicated while the job is in flight, everyone still gets their callback
+            r = self.app.post("/jobs", json=dict(url="https://example.com/job", callback_url="https://hooks/b"))
+            self.assertEqual(job["id"], r.json["id"])
+            self.release = True
+            for _ in range(100):
+                job = self.app.get(f"/jobs/{job['id']}").json
+                if job["state"] == "done" and len(notified) == 2:
+                    break
+                time.sleep(0.01)
+        self.assertEqual("done", job["state"])
+        self.assertEqual(["https://hooks/a", "https://hooks/b"], notified)
+        self.assertEqual("https://example.com/job", job["results"][0]["video_url"])
+        self.assertEqual("UfysResponse", job["results"][0]["_class"])
+
+    def test_callback_hosts(self):
+        with mock.patch.object(main.JOBS.config, "JOB_CALLBACK_HOSTS", "hooks.example.com,.example.org"):
+            for callback_url in ("http://minio:9000/bucket", "http://hooks.example.com/a", "https://example.org.evil/"):
+                r = self.app.post("/jobs", json=dict(url="https://example.com/job", callback_url=callback_url))
+                self.assertEqual((400, "bad-callback"), (r.status_code, r.json[0]["code"]))
+            main.JOBS.check_callback("https://hooks.example.com/a")
+            main.JOBS.check_callback("https://hooks.example.org/a")
+
+    def test_unknown_job(self):
+        r = self.app.get("/jobs/nope")
+        self.assertEqual(404, r.status_code)
+        self.assertEqual("job-not-found", r.json[0]["code"])
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.app = main.APP.test_client()
+
+    @staticmethod
+    def handle_request(req):
+        # the first request finishes last
+        time.sleep(0.2 if req.url.endswith("0") else 0)
+        return [UfysResponse(title=None, creator=None, site=None, video_url=req.url, width=1, height=1)]
+
+    def test_ndjson_stream(self):
+        with mock.patch.object(main.WORKER, "handle_request", self.handle_request):
+            r = self.app.post("/videos", json=[dict(url=f"https://example.com/{i}") for i in range(3)])
+            lines = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+        self.assertEqual("application/x-ndjson", r.mimetype)
+        self.assertEqual(0, lines[-1]["index"])
+        self.assertEqual({0, 1, 2}, {line["index"] for line in lines})
+        for line in lines:
+            self.assertEqual("UfysBatchItem", line["_class"])
+            self.assertEqual(f"https://example.com/{line['index']}", line["results"][0]["video_url"])
+
+    def test_not_a_list(self):
+        self.assertEqual(400, self.app.post("/videos", json=dict(url="https://example.com")).status_code)
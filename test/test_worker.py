@@ -1,3 +1,4 @@
+import io
 import os
 import time
 
@@ -8,7 +9,7 @@ from minio import Minio
 
 import constants
 import worker
-from model import UfysRequest
+from model import UfysRequest, UfysResponse
 
 
 class TestWorker(unittest.TestCase):
@@ -70,5 +71,16 @@ class TestWorker(unittest.TestCase):
     @unittest.skipIf(os.environ.get("GITHUB_ACTIONS"), "github actions is banned from reddit")
     def test_minio_reupload(self):
         self.worker.handle_request(UfysRequest(url=constants.video_needs_reupload))
-        objects = self.worker.minio.list_objects(self.worker.config.MINIO_BUCKET)
-        self.assertEqual(len(list(objects)), 1)
+        objects = list(self.worker.minio.list_objects(self.worker.config.MINIO_BUCKET))
+        # the upload, and the index/ prefix pointing at it
+        self.assertEqual(1, len([obj for obj in objects if not obj.is_dir]))
+        self.assertEqual(["index/"], [obj.object_name for obj in objects if obj.is_dir])
+
+    def test_upload_index(self):
+        response = UfysResponse(
+            title="tïtle", creator=None, site="site", video_url=None, width=16, height=9, reuploaded=True
+        )
+        response.video_url = self.worker.reupload_stream(io.BytesIO(b"video"), "somehash")
+        self.worker.index_upload([self.worker.hash_index_key("somehash")], response)
+        self.assertEqual(response, self.worker.find_upload(self.worker.hash_index_key("somehash")))
+        self.assertIsNone(self.worker.find_upload(self.worker.hash_index_key("otherhash")))
@@ -0,0 +1,109 @@
+import unittest
+from unittest import mock
+
+import ffmpeg
+
+import worker
+from handlers.ytdl import YTDLRequestHandler
+from model import UfysError, UfysRequest, UfysResponse
+
+HLS = dict(url="https://cdn/master.m3u8", protocol="m3u8_native", vcodec="avc1.64001f", acodec="mp4a.40.2")
+
+
+class TestStreamingReupload(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.Worker(worker.ConfigStore(CANONICALIZE_EXTRACTORS=False))
+        self.handler, = (handler for handler in self.worker.handlers if isinstance(handler, YTDLRequestHandler))
+        self.streamed, self.downloaded = [], []
+        patcher = mock.patch.multiple(
+            self.handler,
+            reupload_ytdl_streaming=lambda req, info, formats, dim, *_: self.streamed.append(dim),
+            reupload_ytdl_download=lambda req, *_: self.downloaded.append(req.url)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reupload(self, fmt: dict):
+        self.handler.reupload_ytdl(UfysRequest(url="https://example.com/video"), dict(formats=[fmt]), fmt)
+
+    def test_listed_dimensions(self):
+        self.reupload(HLS | dict(width=1280, height=720))
+        self.assertEqual([(1280, 720)], self.streamed)
+
+    def test_probed_playlist(self):
+        with mock.patch.object(self.handler, "probe_playlist_dimensions", lambda fmt: (640, 360)):
+            self.reupload(HLS)
+        self.assertEqual([(640, 360)], self.streamed)
+
+    def test_failed_probe_downloads(self):
+        def probe(fmt):
+            raise ffmpeg.Error("ffprobe", None, b"invalid data")
+
+        with mock.patch.object(self.handler, "probe_playlist_dimensions", probe):
+            self.reupload(HLS)
+        self.assertEqual(([], ["https://example.com/video"]), (self.streamed, self.downloaded))
+
+    def test_nothing_fits(self):
+        req = UfysRequest(url="https://example.com/video", max_height=480)
+        formats = [HLS | dict(height=1080), dict(url="https://cdn/1080", protocol="http_dash_segments", height=1080)]
+        with self.assertRaises(UfysError) as ctx:
+            self.handler.reupload_ytdl(req, dict(formats=formats))
+        self.assertEqual("budget-exceeded", ctx.exception.code)
+        self.assertEqual(([], []), (self.streamed, self.downloaded))
+
+
+class TestVideoIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = worker.Worker(worker.ConfigStore(CANONICALIZE_EXTRACTORS=False, STREAMING_REUPLOAD=False))
+        self.handler, = (handler for handler in self.worker.handlers if isinstance(handler, YTDLRequestHandler))
+        self.uploads = dict(
+            (self.worker.video_index_key("Example", "id", variant), self.upload(height))
+            for variant, height in ((None, 1080), ("height360", 360))
+        )
+        self.downloaded = []
+        patcher = mock.patch.multiple(
+            self.handler,
+            reupload_ytdl_download=lambda req, index_keys, budget: self.downloaded.append(index_keys)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.worker, "find_upload", self.uploads.get)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def upload(height: int) -> UfysResponse:
+        return UfysResponse(
+            title=None, creator=None, site=None, video_url=f"https://minio/{height}.mp4", width=16, height=height
+        )
+
+    def reupload(self, max_height: int | None = None):
+        req = UfysRequest(url="https://example.com/video", max_height=max_height)
+        return self.handler.reupload_ytdl(req, dict(extractor_key="Example", id="id"))
+
+    def test_unlimited(self):
+        self.assertEqual(1080, self.reupload().height)
+
+    def test_same_request(self):
+        req = UfysRequest(url="https://example.com/video", max_height=480)
+        self.uploads[self.worker.hash_index_key(req.key)] = self.upload(480)
+        self.assertEqual(480, self.handler.reupload_ytdl(req, dict(extractor_key="Example", id="id")).height)
+
+    def test_per_budget(self):
+        self.assertEqual(360, self.reupload(max_height=360).height)
+        self.assertIsNone(self.reupload(max_height=480))
+        self.assertEqual([["index/Example/id@height480"]], self.downloaded)
+
+
+class TestSlots(unittest.TestCase):
+
+    def test_per_extractor(self):
+        config = worker.ConfigStore(HANDLER_CONCURRENCY="YTDLRequestHandler=4,YTDLRequestHandler:Youtube=1")
+        handler = YTDLRequestHandler(worker.Worker(config))
+        youtube = handler.slots_for(UfysRequest(url="https://www.youtube.com/watch?v=dQw4w9WgXcQ"))
+        self.assertIs(youtube, handler.slots_for(UfysRequest(url="https://youtu.be/jNQXAC9IVRw")))
+        vimeo = handler.slots_for(UfysRequest(url="https://vimeo.com/76979871"))
+        self.assertIsNot(youtube, vimeo)
+        self.assertEqual((1, 4), (youtube.free, vimeo.free))
@@ -0,0 +1,89 @@
+import httpx
+import requests
+import requests.adapters
+import urllib3.connectionpool
+from urllib3.util import Retry
+
+import metrics
+import util
+from config import ConfigStore
+
+USER_AGENT = "ufys/0.0.0 (https://github.com/jemand771/ufys)"
+
+
+def counting_pool(cls, client: str):
+    # new connections per client, compared to its requests that's how well keep-alive works
+    class CountingPool(cls):
+        def _new_conn(self):
+            metrics.HTTP_CONNECTIONS.labels(client).inc()
+            return super()._new_conn()
+
+    return CountingPool
+
+
+class TransportAdapter(requests.adapters.HTTPAdapter):
+    # requests has no default timeout (waits forever) and only retries nothing by default
+
+    def __init__(self, client: str, timeout: tuple[float | None, float | None], retries: int, pool_size: int):
+        self.client = client
+        self.timeout = timeout
+        super().__init__(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            # only failed connects are retried, everything else may have reached the server already
+            max_retries=Retry(total=retries, read=False, status=0, redirect=False)
+        )
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = dict(
+            http=counting_pool(urllib3.connectionpool.HTTPConnectionPool, self.client),
+            https=counting_pool(urllib3.connectionpool.HTTPSConnectionPool, self.client),
+        )
+
+    def send(self, request, timeout=None, **kwargs):
+        metrics.HTTP_REQUESTS.labels(self.client).inc()
+        return super().send(request, timeout=self.timeout if timeout is None else timeout, **kwargs)
+
+
+def timeouts(config: ConfigStore) -> tuple[float | None, float | None]:
+    # 0 -> no timeout
+    return config.HTTP_CONNECT_TIMEOUT or None, config.HTTP_READ_TIMEOUT or None
+
+
+def pool_sizes(config: ConfigStore) -> dict[str, int]:
+    return {host: int(size) for host, size in util.parse_mapping(config.HTTP_POOL_SIZES).items()}
+
+
+def make_session(config: ConfigStore, client: str) -> requests.Session:
+    # connections are pooled per host, hosts listed in HTTP_POOL_SIZES get a pool of their own size
+    session = requests.Session()
+    session.headers.update({"User-Agent": USER_AGENT})
+
+    def adapter(pool_size: int) -> TransportAdapter:
+        return TransportAdapter(client, timeouts(config), config.HTTP_RETRIES, pool_size)
+
+    session.mount("http://", adapter(config.HTTP_POOL_SIZE))
+    session.mount("https://", adapter(config.HTTP_POOL_SIZE))
+    for host, size in pool_sizes(config).items():
+        session.mount(f"http://{host}/", adapter(size))
+        session.mount(f"https://{host}/", adapter(size))
+    return session
+
+
+def make_async_client(config: ConfigStore) -> httpx.AsyncClient:
+    connect, read = timeouts(config)
+
+    def transport(pool_size: int) -> httpx.AsyncHTTPTransport:
+        return httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+            retries=config.HTTP_RETRIES
+        )
+
+    return httpx.AsyncClient(
+        headers={"User-Agent": USER_AGENT},
+        follow_redirects=True,
+        timeout=httpx.Timeout(None, connect=connect, read=read),
+        transport=transport(config.HTTP_POOL_SIZE),
+        mounts={f"all://{host}": transport(size) for host, size in pool_sizes(config).items()}
+    )
@@ -13,6 +13,23 @@ def dataclass_from_dict(cls, dictlike):
     )
 
 
+def coerce(value, type_):
+    if not isinstance(value, str) or type_ is str:
+        return value
+    if type_ is bool:
+        return value.lower() in ("1", "true", "yes", "on")
+    return type_(value)
+
+
+def parse_mapping(value: str) -> dict[str, str]:
+    # "key=value,other=value" -> dict, for config values
+    return {
+        key.strip(): value.strip()
+        for key, _, value
+        in (item.partition("=") for item in value.split(",") if item.strip())
+    }
+
+
 @contextlib.contextmanager
 def chdir(path):
     original = os.getcwd()
@@ -1,27 +1,49 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import copy
+import dataclasses
 import functools
+import io
+import itertools
 import mimetypes
-import multiprocessing.pool
 import pathlib
+import threading
+import time
+import typing
+import urllib.parse
 
+import httpx
 # noinspection PyPackageRequirements
 import minio
 import minio.commonconfig
+import minio.error
 import minio.lifecycleconfig
-import yt_dlp
+import requests
 from urllib3.exceptions import MaxRetryError
 
+import canonical
+import metrics
 import telemetry
+from breaker import CircuitBreaker
+from cache import ResultCache
 from config import ConfigStore
+from execution import BoundedExecutor, ProcessBackend, Slots
 from handlers.asciinema import AsciinemaRequestHandler
 from handlers.base import RequestHandler
 from handlers.instagram import InstagramRequestHandler
 from handlers.ytdl import YTDLRequestHandler
-from model import MinioNotConnected, UfysError, UfysRequest, UfysResponse
+from model import MinioNotConnected, UfysBatchItem, UfysError, UfysRequest, UfysResponse
+from refresh import Refresher
+from singleflight import AsyncSingleFlight, SingleFlight
+from storage import MinioConnection
 
 
 class Worker:
     config: ConfigStore
-    minio: "minio.Minio | None" = None
+    # errors that hint at a broken upstream rather than a broken request. download-error is left out, yt-dlp raises
+    # it for deleted, private or geo-blocked videos too, those are the negative cache's job
+    BREAKER_FAILURE_CODES = ("upstream-error", "implementation-error", "timeout")
 
     def __init__(self, config: ConfigStore = None):
         self.config = config or ConfigStore()
@@ -32,22 +54,10 @@ class Worker:
                 YTDLRequestHandler,
             ]
         ]
-        try:
-            self.minio = minio.Minio(
-                endpoint=self.config.MINIO_ENDPOINT,
-                access_key=self.config.MINIO_ACCESS_KEY,
-                secret_key=self.config.MINIO_SECRET_KEY,
-                secure=self.config.MINIO_SECURE
-            )
-            if not self.minio.bucket_exists(self.config.MINIO_BUCKET):
-                print(f"warning: bucket {config.MINIO_BUCKET} doesn't exist")
-                self.minio = None
-        except TypeError:
-            print("warning: minio not connected (configuration error)")
-        except AttributeError:
-            print("warning: minio not connected (bucket error)")
-        except MaxRetryError:
-            print("warning: minio not connected (timeout)")
+        # connected in the background by warm_up(), or by whatever needs minio first
+        self.storage = MinioConnection(self.config)
+        self.warmed_up = threading.Event()
+        self.warm_up_time: float | None = None
         # TODO set access policy
         # setting up anonymous access looks painful (json string), and only partially auto-configuring the bucket
         # might yield unexpected results. I'll either re-add this or remove it entirely
@@ -66,53 +76,484 @@ class Worker:
         #     )
         # try to extract using custom format extractor
 
-    @telemetry.trace_function
+        self.cache = ResultCache.for_worker(self)
+        self.refresher = Refresher(self)
+        self.inflight = SingleFlight()
+        self.inflight_async = AsyncSingleFlight()
+        self.batch_slots = threading.BoundedSemaphore(self.config.BATCH_CONCURRENCY)
+        self.breakers: dict[str, CircuitBreaker] = {}
+        self.breakers_lock = threading.Lock()
+        self.process_backend = ProcessBackend(self.config) if self.config.EXECUTION_BACKEND == "process" else None
+        self.executor = BoundedExecutor(
+            workers=self.config.EXECUTOR_WORKERS,
+            queue_size=self.config.EXECUTOR_QUEUE_SIZE,
+            queue_timeout=self.config.EXECUTOR_QUEUE_TIMEOUT
+        )
+
+    @metrics.track_requests
+    @telemetry.trace_function(attributes=("req.url",))
     def handle_request(self, req: UfysRequest) -> list[UfysResponse | UfysError]:
+        # handlers may rewrite the request url (e.g. for playlists), so pin the key first
+        self.canonicalize(req)
+        key = req.key
+        if (cached := self.cache.get(key)) is not None:
+            self.refresher.hit(key)
+            return cached
+        try:
+            return list(
+                self.inflight.do(
+                    key,
+                    functools.partial(self.run_and_cache, req, key),
+                    timeout=self.config.INFLIGHT_TIMEOUT
+                )
+            )
+        except TimeoutError:
+            return [UfysError(code="timeout", message="timed out waiting for an identical request to finish")]
+
+    @metrics.track_requests
+    @telemetry.trace_function(attributes=("req.url",))
+    async def handle_request_async(self, req: UfysRequest) -> list[UfysResponse | UfysError]:
+        # same as handle_request, for the asgi app. blocking parts (cache tiers, minio) run in threads
+        self.canonicalize(req)
+        key = req.key
+        if (cached := await asyncio.to_thread(self.cache.get, key)) is not None:
+            self.refresher.hit(key)
+            return cached
+        try:
+            return list(
+                await self.inflight_async.do(
+                    key,
+                    functools.partial(self.run_and_cache_async, req, key),
+                    timeout=self.config.INFLIGHT_TIMEOUT
+                )
+            )
+        except TimeoutError:
+            return [UfysError(code="timeout", message="timed out waiting for an identical request to finish")]
+
+    @telemetry.trace_function(attributes=("req.url",))
+    def canonicalize(self, req: UfysRequest):
+        if req.canonical_url is not None:
+            return
+        url = canonical.normalize_url(req.url)
+        for handler in sorted(self.handlers, key=lambda h: -h.priority):
+            if handler.can_handle(req) and (handler_url := handler.canonicalize(url)) is not None:
+                url = handler_url
+                break
+        req.canonical_url = url
+
+    def handle_batch(self, reqs: list[UfysRequest]) -> typing.Iterator[UfysBatchItem]:
+        executor = concurrent.futures.ThreadPoolExecutor(max(1, min(len(reqs), self.config.BATCH_CONCURRENCY)))
+        futures = {
+            executor.submit(contextvars.copy_context().run, self.handle_batch_item, req): index
+            for index, req in enumerate(reqs)
+        }
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield UfysBatchItem(index=futures[future], results=future.result())
+        finally:
+            # the client may have gone away, don't start what's left
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def handle_batch_item(self, req: UfysRequest) -> list[UfysResponse | UfysError]:
+        # shared by all batches, so one huge batch can't take over the whole worker
+        with self.batch_slots:
+            return self.handle_request(req)
+
+    def run_and_cache(self, req: UfysRequest, key: str) -> list[UfysResponse | UfysError]:
+        results = self.run_handlers(req)
+        self.refresher.track(req, key, results, self.cache.set(key, results))
+        return results
+
+    async def run_and_cache_async(self, req: UfysRequest, key: str) -> list[UfysResponse | UfysError]:
+        results = await self.run_handlers_async(req)
+        self.refresher.track(req, key, results, await asyncio.to_thread(self.cache.set, key, results))
+        return results
+
+    def run_handlers(self, req: UfysRequest) -> list[UfysResponse | UfysError]:
+        handlers_to_run = [handler for handler in self.handlers if handler.can_handle(req)]
+        if not handlers_to_run:
+            return [UfysError(code="no-handler", message="could not find a suitable handler for this request")]
+
+        if self.config.DISPATCH_MODE == "race":
+            return self.race_handlers(req, handlers_to_run)
+        futures = [self.submit_handler(handler, req) for handler in handlers_to_run]
+        concurrent.futures.wait(futures)
+        results = [self.handler_result(future) for future in futures]
 
+        successful_results = [result for result in results if isinstance(result, UfysResponse)]
+        return successful_results or results
+
+    async def run_handlers_async(self, req: UfysRequest) -> list[UfysResponse | UfysError]:
         handlers_to_run = [handler for handler in self.handlers if handler.can_handle(req)]
         if not handlers_to_run:
             return [UfysError(code="no-handler", message="could not find a suitable handler for this request")]
 
-        with multiprocessing.pool.ThreadPool(len(handlers_to_run)) as pool:
-            results = pool.map(functools.partial(self.dispatch_handler, req=req), handlers_to_run)
+        if self.config.DISPATCH_MODE == "race":
+            return await self.race_handlers_async(req, handlers_to_run)
+        results = await asyncio.gather(*(self.execute_handler_async(handler, req) for handler in handlers_to_run))
 
         successful_results = [result for result in results if isinstance(result, UfysResponse)]
         return successful_results or results
 
+    @staticmethod
+    def handler_tiers(handlers: list[RequestHandler]) -> list[list[RequestHandler]]:
+        # highest priority first
+        return [
+            list(tier)
+            for _, tier
+            in itertools.groupby(sorted(handlers, key=lambda h: -h.priority), key=lambda h: h.priority)
+        ]
+
+    def race_handlers(self, req: UfysRequest, handlers: list[RequestHandler]) -> list[UfysResponse | UfysError]:
+        # start the preferred handlers first and return as soon as any handler succeeds.
+        # lower priority handlers are hedged: they only start once the delay has passed or everything above failed
+        tiers = self.handler_tiers(handlers)
+        pending: dict[concurrent.futures.Future, tuple[RequestHandler, float]] = {}
+        errors = []
+        try:
+            for index, tier in enumerate(tiers):
+                for handler in tier:
+                    pending[self.submit_handler(handler, req)] = handler, time.monotonic()
+                hedge_at = time.monotonic() + self.config.DISPATCH_HEDGE_DELAY if index < len(tiers) - 1 else None
+                while pending:
+                    wake_at = [hedge_at] if hedge_at is not None else []
+                    wake_at += [started + handler.deadline for handler, started in pending.values() if handler.deadline]
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        timeout=max(0., min(wake_at) - time.monotonic()) if wake_at else None,
+                        return_when=concurrent.futures.FIRST_COMPLETED
+                    )
+                    for future in done:
+                        del pending[future]
+                        if isinstance(result := self.handler_result(future), UfysResponse):
+                            return [result]
+                        errors.append(result)
+                    for future, (handler, started) in list(pending.items()):
+                        if handler.deadline and time.monotonic() >= started + handler.deadline:
+                            # can't interrupt a running thread, the result is simply discarded
+                            future.cancel()
+                            del pending[future]
+                            errors.append(UfysError(
+                                code="timeout", message=f"{handler.__class__.__name__} exceeded its deadline"
+                            ))
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        break
+            return errors
+        finally:
+            # handlers that are still queued don't need to start anymore
+            for future in pending:
+                future.cancel()
+
+    async def race_handlers_async(
+            self, req: UfysRequest, handlers: list[RequestHandler]
+    ) -> list[UfysResponse | UfysError]:
+        # same as race_handlers, but handlers that missed their deadline or lost the race are actually cancelled
+        tiers = self.handler_tiers(handlers)
+        pending: dict[asyncio.Task, tuple[RequestHandler, float]] = {}
+        errors = []
+        try:
+            for index, tier in enumerate(tiers):
+                for handler in tier:
+                    task = asyncio.ensure_future(self.execute_handler_async(handler, copy.copy(req)))
+                    pending[task] = handler, time.monotonic()
+                hedge_at = time.monotonic() + self.config.DISPATCH_HEDGE_DELAY if index < len(tiers) - 1 else None
+                while pending:
+                    wake_at = [hedge_at] if hedge_at is not None else []
+                    wake_at += [started + handler.deadline for handler, started in pending.values() if handler.deadline]
+                    done, _ = await asyncio.wait(
+                        pending,
+                        timeout=max(0., min(wake_at) - time.monotonic()) if wake_at else None,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        del pending[task]
+                        if isinstance(result := task.result(), UfysResponse):
+                            return [result]
+                        errors.append(result)
+                    for task, (handler, started) in list(pending.items()):
+                        if handler.deadline and time.monotonic() >= started + handler.deadline:
+                            task.cancel()
+                            del pending[task]
+                            errors.append(UfysError(
+                                code="timeout", message=f"{handler.__class__.__name__} exceeded its deadline"
+                            ))
+                    if hedge_at is not None and time.monotonic() >= hedge_at:
+                        break
+            return errors
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def submit_handler(self, handler: RequestHandler, req: UfysRequest) -> concurrent.futures.Future:
+        try:
+            return self.executor.submit(self.execute_handler, handler, copy.copy(req), slots=handler.slots_for(req))
+        except UfysError as ex:
+            # rejected right away, make it look like any other failed handler
+            future = concurrent.futures.Future()
+            future.set_result(ex)
+            return future
+
+    @staticmethod
+    def handler_result(future: concurrent.futures.Future) -> UfysResponse | UfysError:
+        try:
+            return future.result()
+        except UfysError as ex:
+            # dropped by the executor after waiting too long
+            return ex
+
+    def execute_handler(self, handler: RequestHandler, req: UfysRequest) -> UfysResponse | UfysError:
+        breaker, breaker_key = self.breaker_for(handler, req)
+        if not breaker.allow():
+            return UfysError(code="circuit-open", message=f"{breaker_key} is failing, not trying it for now")
+        start = time.perf_counter()
+        if self.process_backend is not None:
+            result = self.process_backend.run(handler, req)
+        else:
+            result = self.dispatch_handler(handler, req)
+        self.observe_handler(handler, result, time.perf_counter() - start)
+        breaker.record(not isinstance(result, UfysError) or result.code not in self.BREAKER_FAILURE_CODES)
+        return result
+
+    async def execute_handler_async(self, handler: RequestHandler, req: UfysRequest) -> UfysResponse | UfysError:
+        if handler.handle_request_async is None or self.process_backend is not None:
+            # blocking handlers keep running on the executor
+            try:
+                return await asyncio.wrap_future(self.submit_handler(handler, req))
+            except UfysError as ex:
+                # dropped by the executor after waiting too long
+                return ex
+        breaker, breaker_key = self.breaker_for(handler, req)
+        if not breaker.allow():
+            return UfysError(code="circuit-open", message=f"{breaker_key} is failing, not trying it for now")
+        if (slots := handler.slots_for(req)) is not None and not await self.acquire_slot_async(slots):
+            metrics.EXECUTOR_SHED.labels("expired").inc()
+            return UfysError(code="overloaded", message="timed out waiting for a free worker")
+        start = time.perf_counter()
+        try:
+            result = await handler.handle_request_async(req)
+        except Exception as ex:
+            result = self.handler_error(ex)
+        finally:
+            if slots is not None:
+                slots.release()
+        self.observe_handler(handler, result, time.perf_counter() - start)
+        breaker.record(not isinstance(result, UfysError) or result.code not in self.BREAKER_FAILURE_CODES)
+        return result
+
+    async def acquire_slot_async(self, slots: Slots) -> bool:
+        # HANDLER_CONCURRENCY for native async handlers, with the same timeout the executor gives blocking ones.
+        # waits in the same line as blocking runs, woken by whichever thread releases the slot
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+        # whoever flips this first decides: the releasing thread (slot handed over) or us (gave up waiting)
+        settled = threading.Lock()
+
+        def waiter() -> bool:
+            if not settled.acquire(blocking=False):
+                return False
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(None))
+            return True
+
+        if slots.acquire(waiter):
+            return True
+        try:
+            await asyncio.wait_for(granted, self.config.EXECUTOR_QUEUE_TIMEOUT or None)
+            return True
+        except TimeoutError:
+            # the slot may have been handed over just now, then it's ours anyway
+            return not settled.acquire(blocking=False)
+        except asyncio.CancelledError:
+            if not settled.acquire(blocking=False):
+                slots.release()
+            raise
+
+    @staticmethod
+    def observe_handler(handler: RequestHandler, result: UfysResponse | UfysError, duration: float):
+        outcome = result.code if isinstance(result, UfysError) else "ok"
+        metrics.HANDLER_DURATION.labels(handler.__class__.__name__, outcome).observe(duration)
+
+    def breaker_for(self, handler: RequestHandler, req: UfysRequest) -> tuple[CircuitBreaker, str]:
+        breaker_key = handler.breaker_key(req)
+        with self.breakers_lock:
+            if (breaker := self.breakers.get(breaker_key)) is None:
+                breaker = self.breakers[breaker_key] = CircuitBreaker(
+                    threshold=self.config.BREAKER_THRESHOLD,
+                    cooldown=self.config.BREAKER_COOLDOWN
+                )
+        return breaker, breaker_key
+
     @staticmethod
     def dispatch_handler(handler: RequestHandler, req: UfysRequest) -> UfysResponse | UfysError:
         try:
             # TODO automatic retries
             return handler.handle_request(req)
-        except UfysError as e:
-            return e
-        # TODO should be part of ytdlhandler
-        except yt_dlp.utils.DownloadError:
-            return UfysError(code="download-error", message="yt-dlp failed to download this video")
-        except AssertionError:
+        except Exception as ex:
+            return Worker.handler_error(ex)
+
+    @staticmethod
+    def handler_error(ex: Exception) -> UfysError:
+        if isinstance(ex, UfysError):
+            return ex
+        if isinstance(ex, AssertionError):
             return UfysError(
                 code="assertion-error",
                 message="an unknown error, thought to be impossible, has occured"
             )
-        except Exception as ex:
-            return UfysError(
-                code="implementation-error",
-                message=f"handler crashed; this is probably an implementation issue ({str(ex)})"
-            )
+        if isinstance(ex, (requests.Timeout, httpx.TimeoutException)):
+            return UfysError(code="timeout", message=f"upstream didn't answer in time ({str(ex)})")
+        if isinstance(ex, (requests.ConnectionError, httpx.TransportError)):
+            return UfysError(code="upstream-error", message=f"couldn't reach upstream ({str(ex)})")
+        return UfysError(
+            code="implementation-error",
+            message=f"handler crashed; this is probably an implementation issue ({str(ex)})"
+        )
 
-    @telemetry.trace_function
-    def reupload(self, path: pathlib.Path, hash_: str):
-        if self.minio is None:
+    @telemetry.trace_function(attributes=("path", "hash_"))
+    def reupload(self, path: pathlib.Path, hash_: str, metadata: dict[str, str] | None = None):
+        if (client := self.minio) is None:
             raise MinioNotConnected()
         mime, _ = mimetypes.guess_type(path)
-        result = self.minio.fput_object(
-            bucket_name=self.config.MINIO_BUCKET,
-            object_name=hash_ + path.suffix,
-            file_path=str(path),
-            content_type=mime
-        )
+        try:
+            result = client.fput_object(
+                bucket_name=self.config.MINIO_BUCKET,
+                object_name=hash_ + path.suffix,
+                file_path=str(path),
+                content_type=mime,
+                metadata=metadata
+            )
+        except MaxRetryError:
+            self.storage.disconnect("timeout")
+            raise MinioNotConnected()
+        metrics.UPLOADED_BYTES.inc(path.stat().st_size)
+        return result.location or self.get_upload_location(result.object_name)
+
+    @telemetry.trace_function(attributes=("hash_", "suffix"))
+    def reupload_stream(
+        self, stream: typing.BinaryIO, hash_: str, suffix: str = ".mp4", metadata: dict[str, str] | None = None
+    ):
+        if (client := self.minio) is None:
+            raise MinioNotConnected()
+        mime, _ = mimetypes.guess_type(f"video{suffix}")
+        # unknown length -> multipart upload holding one part in memory at a time
+        try:
+            result = client.put_object(
+                bucket_name=self.config.MINIO_BUCKET,
+                object_name=hash_ + suffix,
+                data=stream,
+                length=-1,
+                content_type=mime,
+                metadata=metadata,
+                part_size=self.config.UPLOAD_PART_SIZE,
+                num_parallel_uploads=1
+            )
+        except MaxRetryError:
+            self.storage.disconnect("timeout")
+            raise MinioNotConnected()
+        # the handlers' streams count what went through them
+        metrics.UPLOADED_BYTES.inc(getattr(stream, "bytes_read", 0))
         return result.location or self.get_upload_location(result.object_name)
 
+    @staticmethod
+    def hash_index_key(hash_: str) -> str:
+        return f"index/hash/{hash_}"
+
+    @staticmethod
+    def video_index_key(extractor: str, id_: str, variant: str | None = None) -> str:
+        return f"index/{extractor}/{id_}" + (f"@{variant}" if variant else "")
+
+    @staticmethod
+    def upload_metadata(response: UfysResponse) -> dict[str, str]:
+        # object metadata travels as http headers, so it has to be ascii (and proxies tend to drop underscores)
+        return {
+            key.replace("_", "-"): urllib.parse.quote(str(value))
+            for key, value
+            in dataclasses.asdict(response).items()
+            if value is not None and key != "reuploaded"
+        }
+
+    @telemetry.trace_function
+    def find_upload(self, index_key: str) -> UfysResponse | None:
+        if (client := self.minio) is None:
+            return None
+        try:
+            stat = client.stat_object(self.config.MINIO_BUCKET, index_key)
+        except minio.error.S3Error:
+            return None
+        except MaxRetryError:
+            print("warning: upload index unavailable (timeout)")
+            self.storage.disconnect("timeout")
+            return None
+        metadata = {
+            key.lower().removeprefix("x-amz-meta-").replace("-", "_"): urllib.parse.unquote(value)
+            for key, value
+            in stat.metadata.items()
+            if key.lower().startswith("x-amz-meta-")
+        }
+        try:
+            return UfysResponse(
+                title=metadata.get("title"),
+                creator=metadata.get("creator"),
+                site=metadata.get("site"),
+                video_url=metadata["video_url"],
+                width=int(metadata["width"]),
+                height=int(metadata["height"]),
+                reuploaded=True
+            )
+        except (KeyError, ValueError):
+            return None
+
+    def find_reupload(self, req: UfysRequest) -> UfysResponse | None:
+        # this very request was reuploaded before. checked by handlers that are about to reupload, most requests
+        # end up as links and don't need the round trip
+        if not self.config.REUPLOAD_PREFLIGHT:
+            return None
+        return self.find_upload(self.hash_index_key(req.key))
+
+    @telemetry.trace_function
+    def index_upload(self, index_keys: list[str], response: UfysResponse):
+        # empty objects pointing at the upload, carrying everything needed to answer without downloading
+        if (client := self.minio) is None:
+            return
+        for index_key in index_keys:
+            try:
+                client.put_object(
+                    bucket_name=self.config.MINIO_BUCKET,
+                    object_name=index_key,
+                    data=io.BytesIO(b""),
+                    length=0,
+                    metadata=self.upload_metadata(response)
+                )
+            except (minio.error.S3Error, MaxRetryError) as ex:
+                print(f"warning: failed to index upload {index_key} ({ex})")
+
+    def warm_up(self):
+        # the slow parts of starting up: yt-dlp, its first instance and the minio connection.
+        # servers run this in the background, so they answer health checks while it's going on
+        start = time.monotonic()
+        for handler in self.handlers:
+            handler.warm_up()
+        self.storage.get(wait=True)
+        self.warm_up_time = time.monotonic() - start
+        self.warmed_up.set()
+
+    def start_warm_up(self) -> threading.Thread:
+        thread = threading.Thread(target=self.warm_up, name="warm-up", daemon=True)
+        thread.start()
+        return thread
+
+    def readiness(self) -> dict:
+        # ready once warmed up. without minio reuploads fail, but direct links still work
+        return dict(
+            ready=self.warmed_up.is_set(),
+            warm_up_time=self.warm_up_time,
+            minio=self.storage.error or "connected"
+        )
+
+    @property
+    def minio(self) -> "minio.Minio | None":
+        # None while minio is unreachable
+        return self.storage.get()
+
     def get_upload_location(self, object_name):
         protocol = "https" if self.config.MINIO_SECURE else "http"
         return f"{protocol}://{self.config.MINIO_ENDPOINT}/{self.config.MINIO_BUCKET}/{object_name}"